@@ -0,0 +1,433 @@
+#!/usr/bin/python
+"""Throughput and latency benchmark for the acquisition pipeline.
+
+Runs each stage of the pipeline against a fake SPI bus, sweeping the
+number of chips and the sample rate:
+
+    fifo_read     -- Icm20689SPI.read_fifo_batch: bus transfer and decode
+    fifo_points   -- Icm20689SPI.read_fifo_data: as above, into MpuDataPoints
+    serialize     -- PacketBatcher.make_packets and MpuDataPacket.serialize
+    queue_handoff -- DataCollectionThread to a SampleRingBuffer reader
+    udp_send      -- UdpNetworkSenderThread to a receiver on localhost
+    file_record   -- RecordingWriter, as used by Write2FileThread
+    ahrs_madgwick -- MadgwickFilter.update_batches over every chip's drain
+    ahrs_mahony   -- MahonyFilter.update_batches, with integral feedback
+
+Each result holds samples per second and the cost per sample. The FIFO
+stages also report percentiles of the time per drain, and queue_handoff
+those of the time from a drain to the consumer, and the AHRS stages
+how many times faster than the chips produce samples they run. Results
+are written as JSON, and can be saved as a baseline and compared against
+on a later run:
+
+    python benchmarks/bench_pipeline.py --output base.json
+    python benchmarks/bench_pipeline.py --baseline base.json
+
+A comparison exits with status 1 when any stage lost more than
+--tolerance of its baseline throughput.
+"""
+
+import argparse
+import json
+import os
+import platform
+import queue
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from icm20689 import DataCollectionThread, SampleRingBuffer, init_spi_chips
+from icm20689_data import count_samples
+from icm20689_filter import MadgwickFilter, MahonyFilter
+from icm20689_net import PacketBatcher, UdpNetworkSenderThread
+from icm20689_receiver import UdpPacketReceiver
+from icm20689_record import RecordingWriter
+from icm20689_regs import ICM20689Regs
+from icm20689_sim import SimulatedRig
+
+STAGES = ('fifo_read', 'fifo_points', 'serialize', 'queue_handoff', 'udp_send', 'file_record',
+          'ahrs_madgwick', 'ahrs_mahony')
+
+# First GPIO used as a chip select; chip n uses FIRST_CS_PIN + n
+FIRST_CS_PIN = 2
+
+class ManualClock(object):
+    """A clock that only moves when advanced, for deterministic FIFO fills."""
+
+    def __init__(self):
+        self._now = 0.0
+
+    def __call__(self):
+        return self._now
+
+    def advance(self, seconds):
+        self._now += seconds
+
+class ReplayChip(object):
+    """Fake chip for SimulatedRig that fills its FIFO from a fixed pattern.
+
+    Unlike SimulatedIcm20689 it does no signal generation, so reads cost
+    only the bus stand-in and the driver, and the rate is not limited to
+    what SMPLRT_DIV can select: frames arrive at rate per second of clock.
+    """
+
+    FIFO_FRAMES = 4096 // 12
+
+    def __init__(self, rate, clock = time.monotonic, seed = 0):
+        rng = np.random.default_rng(seed)
+        self._pattern = rng.integers(-32768, 32768, (self.FIFO_FRAMES, 6)).astype('>i2').tobytes()
+        self._rate = rate
+        self._clock = clock
+        self._epoch = clock()
+        self._consumed = 0
+        self._regs = bytearray(128)
+
+    def _available(self):
+        due = int((self._clock() - self._epoch) * self._rate)
+        # A full FIFO keeps only the newest frames
+        self._consumed = max(self._consumed, due - self.FIFO_FRAMES)
+        return due - self._consumed
+
+    def read_register(self, register):
+        return self.read_registers(register, 1)[0]
+
+    def read_registers(self, register, size):
+        if register == ICM20689Regs.FIFO_COUNTH.value:
+            count = self._available() * 12
+            return bytes([(count >> 8) & 0x1F, count & 0xFF])[:size]
+        if register == ICM20689Regs.FIFO_R_W.value:
+            frames = min(size // 12, self._available())
+            start = self._consumed % self.FIFO_FRAMES
+            data = (self._pattern[start * 12:] + self._pattern[:start * 12])[:frames * 12]
+            self._consumed += frames
+            return data + b'\xff' * (size - len(data))
+        return bytes(self._regs[register:register + size])
+
+    def write_register(self, register, value):
+        if register == ICM20689Regs.USER_CTRL.value and value & (1 << 2):
+            self._consumed += self._available()
+        self._regs[register] = value & 0xFF
+
+    def write_registers(self, register, values):
+        for i, value in enumerate(values):
+            self.write_register(register + i, value)
+
+def make_chips(chip_count, rate, clock = time.monotonic):
+    """Installs a fake bus with chip_count ReplayChips and returns the drivers."""
+    rig = SimulatedRig()
+    pins = [FIRST_CS_PIN + i for i in range(0, chip_count)]
+    for i, pin in enumerate(pins):
+        rig.chips[pin] = ReplayChip(rate, clock, seed=i)
+    rig.install()
+
+    chips = init_spi_chips(pins, sample_frequency=rate)
+    for chip in chips:
+        # SMPLRT_DIV cannot select more than 1 kHz, so tell the driver the
+        # rate the ReplayChip really runs at
+        chip.set_nominal_sample_frequency(rate)
+        chip.enable_fifo()
+    return chips
+
+def frames_per_drain(chip):
+    """Returns the frames DataCollectionThread finds per drain of chip."""
+    interval = DataCollectionThread(None, [chip]).drain_interval(chip)
+    return max(int(interval * chip.get_sample_frequency()), 1)
+
+def summarize(samples, seconds, latencies = None, name = 'latency_us'):
+    result = {
+        'samples': int(samples),
+        'seconds': seconds,
+        'samples_per_s': samples / seconds if seconds > 0 else 0.0,
+        'ns_per_sample': seconds * 1e9 / samples if samples else None,
+    }
+    if latencies is not None and len(latencies):
+        latencies = np.asarray(latencies) * 1e6
+        result[name] = {
+            'p50': float(np.percentile(latencies, 50)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),
+        }
+    return result
+
+def collect_drains(chips, clock, samples):
+    """Reads drains of every chip off the manual clock until samples are read.
+
+    Returns a list of drains, each the list of one SampleBatch per chip.
+    """
+    interval = frames_per_drain(chips[0]) / chips[0].get_sample_frequency()
+    drains = []
+    total = 0
+    while total < samples:
+        clock.advance(interval)
+        drain = [chip.read_fifo_batch() for chip in chips]
+        total += count_samples(drain)
+        drains.append(drain)
+    return drains
+
+def bench_fifo(chip_count, rate, options, read):
+    clock = ManualClock()
+    chips = make_chips(chip_count, rate, clock)
+    interval = frames_per_drain(chips[0]) / rate
+
+    samples = 0
+    elapsed = 0.0
+    drain_times = []
+    while samples < options.samples:
+        clock.advance(interval)
+        for chip in chips:
+            start = time.perf_counter()
+            data = read(chip)
+            spent = time.perf_counter() - start
+            elapsed += spent
+            drain_times.append(spent)
+            samples += len(data)
+
+    result = summarize(samples, elapsed, drain_times, 'drain_us')
+    result['frames_per_drain'] = frames_per_drain(chips[0])
+    return result
+
+def bench_fifo_read(chip_count, rate, options):
+    return bench_fifo(chip_count, rate, options, lambda chip: chip.read_fifo_batch())
+
+def bench_fifo_points(chip_count, rate, options):
+    return bench_fifo(chip_count, rate, options, lambda chip: chip.read_fifo_data())
+
+def bench_serialize(chip_count, rate, options):
+    clock = ManualClock()
+    drains = collect_drains(make_chips(chip_count, rate, clock), clock, options.samples)
+    batcher = PacketBatcher()
+
+    start = time.perf_counter()
+    size = 0
+    for drain in drains:
+        for packet in batcher.make_packets(drain):
+            size += len(packet.serialize())
+    elapsed = time.perf_counter() - start
+
+    result = summarize(sum(count_samples(drain) for drain in drains), elapsed)
+    result['bytes'] = size
+    return result
+
+def bench_file_record(chip_count, rate, options):
+    clock = ManualClock()
+    chips = make_chips(chip_count, rate, clock)
+    drains = collect_drains(chips, clock, options.samples)
+
+    with tempfile.TemporaryDirectory() as directory:
+        writer = RecordingWriter(directory, chips=[chip.describe() for chip in chips])
+        start = time.perf_counter()
+        for drain in drains:
+            for batch in drain:
+                writer.write(batch)
+        writer.close()
+        elapsed = time.perf_counter() - start
+        size = sum(os.path.getsize(path) for path in writer.paths)
+
+    result = summarize(sum(count_samples(drain) for drain in drains), elapsed)
+    result['bytes'] = size
+    return result
+
+def bench_ahrs(chip_count, rate, options, ahrs):
+    clock = ManualClock()
+    drains = collect_drains(make_chips(chip_count, rate, clock), clock, options.samples)
+
+    drain_times = []
+    start = time.perf_counter()
+    for drain in drains:
+        drain_start = time.perf_counter()
+        ahrs.update_batches(drain)
+        drain_times.append(time.perf_counter() - drain_start)
+    elapsed = time.perf_counter() - start
+
+    result = summarize(sum(count_samples(drain) for drain in drains), elapsed, drain_times, 'drain_us')
+    result['realtime'] = result['samples_per_s'] / (chip_count * rate)
+    return result
+
+def bench_ahrs_madgwick(chip_count, rate, options):
+    return bench_ahrs(chip_count, rate, options, MadgwickFilter())
+
+def bench_ahrs_mahony(chip_count, rate, options):
+    return bench_ahrs(chip_count, rate, options, MahonyFilter(ki=0.1))
+
+def bench_queue_handoff(chip_count, rate, options):
+    chips = make_chips(chip_count, rate)
+    ring = SampleRingBuffer()
+    reader = ring.subscribe()
+    thread = DataCollectionThread(ring, chips)
+
+    latencies = []
+    samples = 0
+    thread.start()
+    start = time.monotonic()
+    try:
+        while time.monotonic() - start < options.duration:
+            try:
+                batch = reader.get(timeout=.100)
+            except queue.Empty:
+                continue
+            # The newest sample of a batch is stamped when it is read
+            newest = batch.timestamp + (len(batch) - 1) * batch.sample_period
+            latencies.append(time.time() - newest)
+            samples += len(batch)
+        elapsed = time.monotonic() - start
+    finally:
+        thread.stop()
+        thread.join()
+
+    result = summarize(samples, elapsed, latencies)
+    result['offered_per_s'] = chip_count * rate
+    result['dropped'] = reader.dropped
+    return result
+
+def bench_udp_send(chip_count, rate, options):
+    clock = ManualClock()
+    drains = collect_drains(make_chips(chip_count, rate, clock), clock, options.samples)
+    expected = sum(count_samples(drain) for drain in drains)
+
+    with UdpPacketReceiver('127.0.0.1', 0) as receiver:
+        ip_addr, port = receiver.getsockname()
+        data_queue = queue.Queue()
+        sender = UdpNetworkSenderThread(data_queue, ip_addr, port)
+        sender.start()
+
+        start = time.perf_counter()
+        for drain in drains:
+            for batch in drain:
+                data_queue.put(batch)
+        # Wait for the receiver to see everything, or for the link to go quiet
+        while receiver.stats.samples < expected:
+            if not receiver.poll(.200):
+                break
+        elapsed = time.perf_counter() - start
+        sender.stop()
+        sender.join()
+
+        result = summarize(receiver.stats.samples, elapsed)
+        result['offered'] = expected
+        result['packets'] = receiver.stats.packets
+        result['dropped_packets'] = receiver.stats.dropped
+    return result
+
+BENCHMARKS = {
+    'fifo_read': bench_fifo_read,
+    'fifo_points': bench_fifo_points,
+    'serialize': bench_serialize,
+    'queue_handoff': bench_queue_handoff,
+    'udp_send': bench_udp_send,
+    'file_record': bench_file_record,
+    'ahrs_madgwick': bench_ahrs_madgwick,
+    'ahrs_mahony': bench_ahrs_mahony,
+}
+
+def result_key(result):
+    return (result['stage'], result['chips'], result['rate'])
+
+def compare(results, baseline, tolerance):
+    """Returns one entry per result that also appears in baseline.
+
+    A result regressed when its samples_per_s fell below (1 - tolerance)
+    of the baseline.
+    """
+    previous = dict((result_key(result), result) for result in baseline['results'])
+    comparison = []
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None or not old['samples_per_s']:
+            continue
+        ratio = result['samples_per_s'] / old['samples_per_s']
+        comparison.append({
+            'stage': result['stage'],
+            'chips': result['chips'],
+            'rate': result['rate'],
+            'baseline_samples_per_s': old['samples_per_s'],
+            'samples_per_s': result['samples_per_s'],
+            'ratio': ratio,
+            'regressed': ratio < 1.0 - tolerance,
+        })
+    return comparison
+
+def parse_list(text):
+    return [int(value) for value in text.split(',') if value]
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='comma separated stages to run (default: all)')
+    parser.add_argument('--chips', type=parse_list, default=[1, 2, 4, 8],
+                        help='comma separated chip counts (default: 1,2,4,8)')
+    parser.add_argument('--rates', type=parse_list, default=[100, 500, 1000, 2000, 4000],
+                        help='comma separated sample rates in Hz (default: 100,500,1000,2000,4000)')
+    parser.add_argument('--samples', type=int, default=20000,
+                        help='samples per run for the offline stages (default: 20000)')
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help='seconds per run for queue_handoff (default: 1.0)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per configuration, the fastest is reported (default: 3)')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--baseline', help='compare against results saved by an earlier run')
+    parser.add_argument('--tolerance', type=float, default=.20,
+                        help='fraction of baseline throughput that may be lost (default: 0.20)')
+    options = parser.parse_args(argv)
+
+    options.stages = [stage for stage in options.stages.split(',') if stage]
+    for stage in options.stages:
+        if stage not in BENCHMARKS:
+            parser.error("unknown stage %s, choose from %s" % (stage, ', '.join(STAGES)))
+    return options
+
+def main(argv = None):
+    options = parse_args(argv)
+
+    results = []
+    for stage in options.stages:
+        for chip_count in options.chips:
+            for rate in options.rates:
+                runs = [BENCHMARKS[stage](chip_count, rate, options) for i in range(0, options.repeat)]
+                # The fastest run is the least disturbed by the rest of the system
+                result = max(runs, key=lambda run: run['samples_per_s'])
+                result.update(stage=stage, chips=chip_count, rate=rate)
+                results.append(result)
+                print("%-14s %d chips %5d Hz: %12.0f samples/s" % (stage, chip_count, rate, result['samples_per_s']),
+                      file=sys.stderr)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+        },
+        'parameters': {
+            'samples': options.samples,
+            'duration': options.duration,
+            'repeat': options.repeat,
+        },
+        'results': results,
+    }
+
+    status = 0
+    if options.baseline:
+        with open(options.baseline) as f:
+            comparison = compare(results, json.load(f), options.tolerance)
+        report['comparison'] = comparison
+        for entry in comparison:
+            if entry['regressed']:
+                status = 1
+                print("REGRESSION %-14s %d chips %5d Hz: %0.0f%% of baseline" % (
+                    entry['stage'], entry['chips'], entry['rate'], entry['ratio'] * 100), file=sys.stderr)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
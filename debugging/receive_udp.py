@@ -1,21 +1,21 @@
 #!/usr/bin/python
 
-import socket
-#import struct
-import icm20689
 import time
+from icm20689_receiver import UdpPacketReceiver
 
 
-UDP_IP = '192.168.0.1'
-host = ''
+UDP_IP = ''
 UDP_PORT = 1025
-bufsize = 1024;
-#mpu = icm20689.Icm20689SPI(1, 0, 0, 25)
+REPORT_INTERVAL = 1.0
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP
-sock.bind((UDP_IP,UDP_PORT))
-
-while True:
-	data, addr = sock.recv(bufsize)
-	print("Message received")
-	time.sleep(.01)
+with UdpPacketReceiver(UDP_IP, UDP_PORT) as receiver:
+	last_report = time.time()
+	while True:
+		receiver.poll(REPORT_INTERVAL)
+		if time.time() - last_report >= REPORT_INTERVAL:
+			last_report = time.time()
+			print(receiver.stats)
+			for chip_id, stream in sorted(receiver.streams.items()):
+				timestamps, samples = stream.take()
+				if len(samples):
+					print("chip %d: %d samples, last %s" % (chip_id, len(samples), samples[-1]))
@@ -1,86 +1,114 @@
-import smbus
-import spidev
-import RPi.GPIO as GPIO
 from abc import ABC, abstractmethod
 from icm20689_regs import *
+from icm20689_data import *
+from icm20689_config import ChipConfig, INTERNAL_SAMPLE_FREQUENCY, sample_rate_divider
+from icm20689_metrics import METRICS
+from icm20689_record import RecordingWriter
+from icm20689_time import SampleClock
+from icm20689_thread import InterruptableThread
 import time
-import socket
-import struct
-import math
+import numpy as np
 import threading
-from queue import Empty, Queue
-import signal
-
-class Icm20689Data(ABC):
-
-    def __init__(self):
-        pass
-
-    @abstractmethod
-    def serialize(self):
-        pass
-
-class AccelerometerData(Icm20689Data):
-    def __init__(self, x_val, y_val, z_val):
-        self.x_val = x_val
-        self.y_val = y_val
-        self.z_val = z_val
-
-    def serialize(self):
-        return struct.pack('!ddd', self.x_val, self.y_val, self.z_val)
-
-    def __repr__(self):
-        return "%lf %lf %lf" % (self.x_val, self.y_val, self.z_val)
-
-class GyroData(Icm20689Data):
-    def __init__(self, x_val, y_val, z_val):
-        self.x_val = x_val
-        self.y_val = y_val
-        self.z_val = z_val
-
-    def serialize(self):
-        return struct.pack('!ddd', self.x_val, self.y_val, self.z_val)
-
-    def __repr__(self):
-        return "%lf %lf %lf" % (self.x_val, self.y_val, self.z_val)
-
-class MpuDataPoint(Icm20689Data):
-
-    def __init__(self, mpu_id, accel_data, gyro_data):
-        self._mpu_id = mpu_id
-        self._gyro_data = gyro_data
-        self._accel_data = accel_data
-
-    def serialize(self):
-        serialized_data = bytearray()
-        serialized_data += struct.pack('!i', self._mpu_id) + self._accel_data.serialize() + self._gyro_data.serialize()
-        return serialized_data
-
-    def __repr__(self):
-        return "id: %d\nGyro: %s\nAccell: %s\n\n" %(self._mpu_id, str(self._gyro_data), str(self._accel_data))
-
-class MpuDataPacket(Icm20689Data):
-
-    def __init__(self, data):
-        self._data = data
-
-    def serialize(self):
-        serialized_data = bytearray()
-        for point in self._data:
-            serialized_data += point.serialize()
-
-        return struct.pack('!i', len(self._data)) + serialized_data
+from queue import Empty, Full
+
+# Hardware bindings. They are imported on first use so that the data and
+# transport code can be used on machines without them, and can be
+# replaced with set_hardware_backend.
+spidev = smbus = GPIO = None
+
+# Transport classes live in icm20689_net and are loaded on first access
+_NET_NAMES = ('PacketBatcher', 'UdpNetworkSenderThread', 'TcpNetworkSenderThread')
+
+def __getattr__(name):
+    if name in _NET_NAMES:
+        import icm20689_net
+        return getattr(icm20689_net, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def set_hardware_backend(spidev_module = None, smbus_module = None, gpio_module = None):
+    """Replaces the modules used to talk to the hardware.
+
+    Pass stand-ins such as the ones provided by icm20689_sim to run the
+    drivers without a Raspberry Pi. Arguments left as None keep the current
+    module. Only chips created afterwards are affected.
+    """
+    global spidev, smbus, GPIO
+    if spidev_module is not None:
+        spidev = spidev_module
+    if smbus_module is not None:
+        smbus = smbus_module
+    if gpio_module is not None:
+        GPIO = gpio_module
+
+def _spidev():
+    global spidev
+    if spidev is None:
+        import spidev as spidev_module
+        spidev = spidev_module
+    return spidev
+
+def _smbus():
+    global smbus
+    if smbus is None:
+        import smbus as smbus_module
+        smbus = smbus_module
+    return smbus
+
+def _gpio():
+    global GPIO
+    if GPIO is None:
+        import RPi.GPIO as gpio_module
+        GPIO = gpio_module
+    return GPIO
 
 class Icm20689(ABC):
 
     # Global Variables
     GRAVITIY_MS2 = 9.80665
+    FIFO_MAX = 4096
+    # One FIFO frame holds the three accel and three gyro words
+    FIFO_FRAME_BYTES = 12
 
     def __init__(self, mpu_id):
         self._mpu_id = mpu_id
         self._gyro_range_cached = FS_SEL.FS_DEG_250
         self._accel_range_cached = AFS_SEL.FS_2G
+        self._calibration = (None, None)
         self._sample_frequency_cached = 1000 # Empirically closer to 1024
+        # Estimates the real rate from the FIFO drains
+        self._sample_clock = SampleClock(1.0 / self._sample_frequency_cached)
+        # Last value written to or read from each configuration register
+        self._shadow = {}
+        self._scale = None
+        self._update_scale()
+
+        self._fifo_fill = METRICS.gauge('fifo_fill_bytes', chip=mpu_id)
+        self._fifo_samples = METRICS.counter('fifo_samples', chip=mpu_id)
+        self._bus_ns = METRICS.histogram('bus_transfer_ns', chip=mpu_id)
+        self._decode_ns = METRICS.histogram('decode_ns', chip=mpu_id)
+        self._sample_rate = METRICS.gauge('sample_rate_hz', chip=mpu_id)
+
+    def get_mpu_id(self):
+        return self._mpu_id
+
+    def get_sample_frequency(self):
+        """Returns the sample frequency last set with set_sample_frequency."""
+        return self._sample_frequency_cached
+
+    def set_nominal_sample_frequency(self, sample_frequency):
+        """Tells the driver the rate the chip samples at, without writing to it.
+
+        set_sample_frequency and apply_config call this. Use it directly
+        when the rate comes from elsewhere, for example a replayed stream
+        faster than SMPLRT_DIV can select. The FIFO drain schedule and the
+        SampleClock's nominal period follow it.
+        """
+        self._sample_frequency_cached = sample_frequency
+        self._sample_clock.set_nominal_period(1.0 / sample_frequency)
+
+    def get_sample_clock(self):
+        """Returns the SampleClock that timestamps this chip's FIFO batches."""
+        return self._sample_clock
 
     # hardware communication methods
     @abstractmethod
@@ -91,12 +119,148 @@ class Icm20689(ABC):
     def write_byte_data(self, register, value):
         pass
 
+    def read_block_data(self, register, size):
+        """Reads size consecutive registers starting at register.
+
+        Transports that support burst reads override this so the whole block
+        is one bus transaction; this fallback reads one register at a time.
+        Returns the values as bytes.
+        """
+        return bytes([self.read_byte_data(ICM20689Regs(register.value + i)) for i in range(0, size)])
+
+    def write_block_data(self, register, values):
+        """Writes values to consecutive registers starting at register.
+
+        Transports that support burst writes override this so the whole
+        block is one bus transaction; this fallback writes one register at
+        a time.
+        """
+        for i, value in enumerate(values):
+            self.write_byte_data(ICM20689Regs(register.value + i), value)
+
+    def write_registers(self, values, verify = False):
+        """Writes {ICM20689Regs: value} through the shadow register cache.
+
+        Registers already holding the value, as far as the cache knows,
+        are skipped, and registers next to each other are written in one
+        burst. With verify the written registers are read back, and
+        IOError is raised if any of them differ.
+
+        Only for configuration registers: the cache does not know about
+        bits that clear themselves, or about a device reset, after which
+        clear_register_cache() must be called.
+        Returns the number of registers written.
+        """
+        changed = sorted((register.value, value & 0xFF) for register, value in values.items()
+                         if self._shadow.get(register.value) != value & 0xFF)
+        runs = []
+        for address, value in changed:
+            if runs and runs[-1][0] + len(runs[-1][1]) == address:
+                runs[-1][1].append(value)
+            else:
+                runs.append((address, [value]))
+
+        for address, run in runs:
+            self.write_block_data(ICM20689Regs(address), run)
+            self._shadow.update(zip(range(address, address + len(run)), run))
+
+        if verify:
+            mismatches = []
+            for address, run in runs:
+                read = self.read_block_data(ICM20689Regs(address), len(run))
+                for i, (wrote, value) in enumerate(zip(run, read)):
+                    if wrote != value:
+                        # Written again next time
+                        del self._shadow[address + i]
+                        mismatches.append("%s reads 0x%02x after writing 0x%02x" %
+                                          (ICM20689Regs(address + i).name, value, wrote))
+            if mismatches:
+                raise IOError("Chip %d register %s" % (self._mpu_id, ', '.join(mismatches)))
+        return len(changed)
+
+    def clear_register_cache(self):
+        """Forgets the register values, so the next write_registers writes everything."""
+        self._shadow = {}
+
+    def _read_config_register(self, register):
+        value = self.read_byte_data(register)
+        self._shadow[register.value] = value
+        return value
+
+    def apply_config(self, config, verify = False):
+        """Brings the chip's configuration registers to a ChipConfig.
+
+        Only registers that differ from the cached values are written, so
+        applying the same configuration again costs no bus transactions.
+        Returns the number of registers written.
+        """
+        written = self.write_registers(config.registers(), verify)
+        self._accel_range_cached = config.accel_range
+        self._gyro_range_cached = config.gyro_range
+        self._update_scale()
+        if config.actual_sample_frequency != self._sample_frequency_cached:
+            self.set_nominal_sample_frequency(config.actual_sample_frequency)
+        return written
+
+    def read_who_am_i(self):
+        return self.read_byte_data(ICM20689Regs.WHO_AM_I)
+
+    def read_offset_registers(self):
+        """Reads the accelerometer and gyroscope offset registers.
+
+        Returns (accel, gyro), each three signed ints for x, y and z. The
+        accelerometer values are the 15 bit offsets in ACCEL_OFFSET_STEP g,
+        without the reserved low bit; the gyroscope values are in
+        GYRO_OFFSET_STEP deg/s. Both are added to the sensor output.
+        """
+        accel = []
+        for register in ACCEL_OFFSET_REGISTERS:
+            high, low = self.read_block_data(register, 2)
+            self._shadow[register.value] = high
+            self._shadow[register.value + 1] = low
+            accel.append(SENSOR_WORD.unpack(bytes([high, low]))[0] >> 1)
+        data = self.read_block_data(ICM20689Regs.XG_OFFS_USRH, 6)
+        self._shadow.update(zip(range(ICM20689Regs.XG_OFFS_USRH.value, ICM20689Regs.XG_OFFS_USRH.value + 6), data))
+        return accel, list(SENSOR_VECTOR.unpack(data))
+
+    def write_offset_registers(self, accel = None, gyro = None, verify = False):
+        """Writes the offset registers, in the units of read_offset_registers.
+
+        accel, gyro -- three ints each, or None to leave them. Raises
+        ValueError for values the registers cannot hold.
+        The reserved low bit of the accelerometer registers is kept.
+        Returns the number of registers written.
+        """
+        values = {}
+        if accel is not None:
+            for register, value in zip(ACCEL_OFFSET_REGISTERS, accel):
+                if not -0x4000 <= value < 0x4000:
+                    raise ValueError("Accelerometer offset %d does not fit in 15 bits" % value)
+                low = self._shadow.get(register.value + 1)
+                if low is None:
+                    low = self._read_config_register(ICM20689Regs(register.value + 1))
+                word = ((int(value) << 1) & 0xFFFF) | (low & 0x01)
+                values[register] = word >> 8
+                values[ICM20689Regs(register.value + 1)] = word & 0xFF
+        if gyro is not None:
+            for axis, value in enumerate(gyro):
+                if not -0x8000 <= value < 0x8000:
+                    raise ValueError("Gyroscope offset %d does not fit in 16 bits" % value)
+                register = ICM20689Regs(ICM20689Regs.XG_OFFS_USRH.value + 2 * axis)
+                values[register] = (int(value) >> 8) & 0xFF
+                values[ICM20689Regs(register.value + 1)] = int(value) & 0xFF
+        return self.write_registers(values, verify)
+
     def read_word_data(self, register_high, register_low):
         """Read two i2c registers and combine them.
 
         register -- the first register to read from.
         Returns the combined read results.
         """
+        # Adjacent registers are read in one burst so the two halves match
+        if register_low.value == register_high.value + 1:
+            return SENSOR_WORD.unpack(self.read_block_data(register_high, 2))[0]
+
         # Read the data from the registers
         high = self.read_byte_data(register_high)
         low = self.read_byte_data(register_low)
@@ -108,6 +272,62 @@ class Icm20689(ABC):
         else:
             return value
 
+    def read_sensor_words(self):
+        """Reads the accelerometer, temperature and gyroscope output registers
+        in one 14 byte burst starting at ACCEL_XOUT_H.
+
+        Returns a tuple of seven raw signed values: ax, ay, az, temp, gx, gy, gz.
+        All of them come from the same sample.
+        """
+        return SENSOR_WORDS.unpack(self.read_block_data(ICM20689Regs.ACCEL_XOUT_H, SENSOR_WORDS.size))
+
+    def _convert_temp(self, raw_temp):
+        # Get the actual temperature using the formule given in the
+        # ICM-20689 Register Map and Descriptions revision 4.2, page 30
+        return {'temp': (raw_temp / 340.0) + 36.53}
+
+    def _convert_accel(self, x, y, z, g = False):
+        scale = self._scale_g if g else self._scale
+        ax, ay, az = scale.convert((x, y, z))
+        return {'ax': ax, 'ay': ay, 'az': az}
+
+    def _convert_gyro(self, x, y, z):
+        gx, gy, gz = self._scale.convert((x, y, z), 3)
+        return {'gx': gx, 'gy': gy, 'gz': gz}
+
+    def _update_scale(self):
+        """Rebuilds the conversion to physical units after a range or calibration change."""
+        accel_scale = self.GRAVITIY_MS2 / self._accel_range_cached.get_lsb_sensitivity()
+        gyro_scale = 1.0 / self._gyro_range_cached.get_lsb_sensitivity()
+        scale = self._scale
+        if scale is not None and scale.accel_scale == accel_scale and scale.gyro_scale == gyro_scale:
+            return
+        bias, gain = self._calibration
+        if bias is not None:
+            # Into counts at the current ranges
+            bias = bias / np.array([accel_scale] * 3 + [gyro_scale] * 3)
+        self._scale = SampleScale(accel_scale, gyro_scale, bias=bias, gain=gain)
+        self._scale_g = self._scale.with_units('g', 'deg/s')
+
+    def get_sample_scale(self, units = DEFAULT_UNITS):
+        """Returns the SampleScale converting this chip's raw samples into units.
+
+        units -- (accel unit, gyro unit), see ACCEL_UNITS and GYRO_UNITS.
+        """
+        return self._scale.with_units(*units)
+
+    def set_calibration(self, bias = None, gain = None):
+        """Sets the correction applied when converting samples.
+
+        bias -- 6 offsets in m/s^2 and deg/s, subtracted first
+        gain -- 6 factors applied after removing the bias
+        Either may be None for no correction. The bias is kept in
+        physical units, so it stays right when a range is changed.
+        """
+        self._calibration = (None if bias is None else np.array(bias, dtype=np.float64), gain)
+        self._scale = None
+        self._update_scale()
+
     # ICM-20689 Methods
 
     def get_temp(self):
@@ -117,11 +337,7 @@ class Icm20689(ABC):
         """
         raw_temp = self.read_word_data(ICM20689Regs.TEMP_OUT_H, ICM20689Regs.TEMP_OUT_L)
 
-        # Get the actual temperature using the formule given in the
-        # ICM-20689 Register Map and Descriptions revision 4.2, page 30
-        actual_temp = (raw_temp / 340.0) + 36.53
-
-        return {'temp': actual_temp}
+        return self._convert_temp(raw_temp)
 
     def set_accel_range(self, accel_range):
         """Sets the range of the accelerometer to range.
@@ -130,14 +346,9 @@ class Icm20689(ABC):
         pre-defined range is advised. Input integers corresponding to conversion
         of binary values in table of datasheet [0,1,2,3]
         """
-        # First change it to 0x00 to make sure we write the correct value later
-        self.write_byte_data(ICM20689Regs.ACCEL_CONFIG, 0x00)
-
-        # Write the new range to the ACCEL_CONFIG register
-        hex_mssg = int(bin(accel_range)[2:]+'000',2)
-        self.write_byte_data(ICM20689Regs.ACCEL_CONFIG, hex_mssg)
-
         self._accel_range_cached = AFS_SEL(accel_range)
+        self._update_scale()
+        self.write_registers({ICM20689Regs.ACCEL_CONFIG: self._accel_range_cached.value << 3})
 
     def read_accel_range(self, raw = False):
         """Reads the range the accelerometer is set to.
@@ -147,8 +358,9 @@ class Icm20689(ABC):
         If raw is False, it will return an integer: -1, 2, 4, 8 or 16. When it
         returns -1 something went wrong.
         """
-        raw_data = self.read_byte_data(ICM20689Regs.ACCEL_CONFIG)
+        raw_data = self._read_config_register(ICM20689Regs.ACCEL_CONFIG)
         self._accel_range_cached = AFS_SEL((raw_data >> 3) & 0x3)
+        self._update_scale()
         if raw:
             return raw_data
         else:
@@ -161,33 +373,25 @@ class Icm20689(ABC):
         pre-defined range is advised.
         """
 
-        internal_sample_freq = 1000
-        smplrt_div = int( (internal_sample_freq/samp_freq)-1)
-
-        # First change it to 0x00 to make sure we write the correct value later
-        self.write_byte_data(ICM20689Regs.SMPLRT_DIV, 0x00)
-
-        # Write the new range to the SMPLRT_DIV register
-        self.write_byte_data(ICM20689Regs.SMPLRT_DIV, smplrt_div)
+        smplrt_div = sample_rate_divider(samp_freq)
+        self.write_registers({ICM20689Regs.SMPLRT_DIV: smplrt_div})
 
-        self._sample_frequency_cached = samp_freq
+        # The divider only gives rates of 1 kHz / n
+        self.set_nominal_sample_frequency(INTERNAL_SAMPLE_FREQUENCY / (smplrt_div + 1))
 
     def read_sample_frequency(self, raw = False):
         """Reads the sample frequency the IMU is set to.
 
-        TODO: IMPLEMENT THIS STUFF in the comment
         If raw is True, it will return the raw value from the SMPLRT_DIV
         register
-        If raw is False, it will return an integer: -1, 2, 4, 8 or 16. When it
-        returns -1 something went wrong.
- set_gyro_range(self, gyro_range)        """
-
-        smplrt_div = self.read_byte_data(ICM20689Regs.SMPLRT_DIV)
+        If raw is False, it will return the sample frequency in Hz.
+        """
 
-        internal_sample_freq = 1000
-        sample_rate = internal_sample_freq/(smplrt_div+1)
+        smplrt_div = self._read_config_register(ICM20689Regs.SMPLRT_DIV)
+        if raw:
+            return smplrt_div
 
-        return sample_rate
+        return INTERNAL_SAMPLE_FREQUENCY / (smplrt_div + 1)
 
     def get_accel_data(self, g = False):
         """Gets and returns the X, Y and Z values from the accelerometer.
@@ -196,23 +400,9 @@ class Icm20689(ABC):
         If g is False, it will return the data in m/s^2
         Returns a dictionary with the measurement results.
         """
-        x = self.read_word_data(ICM20689Regs.ACCEL_XOUT_H, ICM20689Regs.ACCEL_XOUT_L)
-        y = self.read_word_data(ICM20689Regs.ACCEL_YOUT_H, ICM20689Regs.ACCEL_YOUT_L)
-        z = self.read_word_data(ICM20689Regs.ACCEL_ZOUT_H, ICM20689Regs.ACCEL_ZOUT_L)
+        x, y, z = SENSOR_VECTOR.unpack(self.read_block_data(ICM20689Regs.ACCEL_XOUT_H, SENSOR_VECTOR.size))
 
-        accel_scale_modifier = self._accel_range_cached.get_lsb_sensitivity()
-
-        x = x / accel_scale_modifier
-        y = y / accel_scale_modifier
-        z = z / accel_scale_modifier
-
-        if g:
-            return {'ax': x, 'ay': y, 'az': z}
-        else:
-            x = x * self.GRAVITIY_MS2
-            y = y * self.GRAVITIY_MS2
-            z = z * self.GRAVITIY_MS2
-            return {'ax': x, 'ay': y, 'az': z}
+        return self._convert_accel(x, y, z, g)
 
     def set_gyro_range(self, gyro_range):
         """Sets the range of the gyroscope to range.
@@ -221,15 +411,10 @@ class Icm20689(ABC):
         range is advised. Input integers corresponding to conversion of binary
         values in table of datasheet [0,1,2,3]
         """
-        # First change it to 0x00 to make sure we write the correct value later
-        self.write_byte_data(ICM20689Regs.GYRO_CONFIG, 0x00)
-
-        # Write the new range to the GYRO_CONFIG register
-        hex_mssg = int(bin(gyro_range)[2:]+'000',2)
-        self.write_byte_data(ICM20689Regs.GYRO_CONFIG, hex_mssg)
-
         # Change the cached range
         self._gyro_range_cached = FS_SEL(gyro_range)
+        self._update_scale()
+        self.write_registers({ICM20689Regs.GYRO_CONFIG: self._gyro_range_cached.value << 3})
 
     def read_gyro_range(self, raw = False):
         """Reads the range the gyroscope is set to.
@@ -239,8 +424,9 @@ class Icm20689(ABC):
         If raw is False, it will return 250, 500, 1000, 2000 or -1. If the
         returned value is equal to -1 something went wrong.
         """
-        raw_data = self.read_byte_data(ICM20689Regs.GYRO_CONFIG)
-
+        raw_data = self._read_config_register(ICM20689Regs.GYRO_CONFIG)
+        self._gyro_range_cached = FS_SEL((raw_data >> 3) & 0x3)
+        self._update_scale()
         if raw:
             return raw_data
         else:
@@ -251,34 +437,28 @@ class Icm20689(ABC):
 
         Returns the read values in a dictionary.
         """
-        x = self.read_word_data(ICM20689Regs.GYRO_XOUT_H, ICM20689Regs.GYRO_XOUT_L)
-        y = self.read_word_data(ICM20689Regs.GYRO_YOUT_H, ICM20689Regs.GYRO_YOUT_L)
-        z = self.read_word_data(ICM20689Regs.GYRO_ZOUT_H, ICM20689Regs.GYRO_ZOUT_L)
+        x, y, z = SENSOR_VECTOR.unpack(self.read_block_data(ICM20689Regs.GYRO_XOUT_H, SENSOR_VECTOR.size))
 
-        gyro_scale_modifier = self._gyro_range_cached.get_lsb_sensitivity()
+        return self._convert_gyro(x, y, z)
 
-        x = x / gyro_scale_modifier
-        y = y / gyro_scale_modifier
-        z = z / gyro_scale_modifier
+    def get_all_data(self):
+        """Reads and returns all the available data.
 
-        return {'gx': x, 'gy': y, 'gz': z}
+        The values come from a single burst read, so they all belong to the
+        same sample.
+        """
+        ax, ay, az, temp, gx, gy, gz = self.read_sensor_words()
 
-    def get_all_data(self):
-        """Reads and returns all the available data."""
-        temp = self.get_temp()
-        accel = self.get_accel_data()
-        gyro = self.get_gyro_data()
-
-        d1 = accel
-        d1.update(gyro)
-        d1.update(temp)
+        d1 = self._convert_accel(ax, ay, az)
+        d1.update(self._convert_gyro(gx, gy, gz))
+        d1.update(self._convert_temp(temp))
         return d1
 
     def get_fifo_count(self):
         return int(self.read_word_data(ICM20689Regs.FIFO_COUNTH, ICM20689Regs.FIFO_COUNTL) / 2)
 
     def set_fifo_enable(self, ):
-        self.write_byte_data(ICM20689Regs.FIFO_EN, FIFO_EN.ACCEL_FIFO_EN.value | FIFO_EN.XG_FIFO_EN.value | FIFO_EN.YG_FIFO_EN.value | FIFO_EN.ZG_FIFO_EN.value)
+        self.write_registers({ICM20689Regs.FIFO_EN: FIFO_EN.ACCEL_FIFO_EN.value | FIFO_EN.XG_FIFO_EN.value | FIFO_EN.YG_FIFO_EN.value | FIFO_EN.ZG_FIFO_EN.value})
 
     def enable_fifo(self):
         current = self.read_byte_data(ICM20689Regs.USER_CTRL)
@@ -286,69 +466,158 @@ class Icm20689(ABC):
         # Reset the FIFO buffer
         self.write_byte_data(ICM20689Regs.USER_CTRL, current | 1<<2)
         self.write_byte_data(ICM20689Regs.USER_CTRL, current | 1<<6)
+        self._sample_clock.reset()
 
-    def read_fifo_data(self):
-        data = []
+    def _get_fifo_data(self, count):
+        """Reads count words from the FIFO one register access at a time.
+
+        Returns the words as (N, 6) int16 frames. Transports that support
+        burst transfers override this.
+        """
+        start = time.perf_counter_ns()
+        raw_data = bytearray()
+        for i in range(0, count * 2):
+            raw_data.append(self.read_byte_data(ICM20689Regs.FIFO_R_W))
+        read = time.perf_counter_ns()
+        self._bus_ns.record(read - start)
+
+        raw_frames = decode_fifo_bytes(raw_data)
+        self._decode_ns.record(time.perf_counter_ns() - read)
+        return raw_frames
+
+    def get_accel_scale(self):
+        """Returns the factor converting raw accelerometer counts to m/s^2."""
+        return self._scale.accel_scale
+
+    def get_gyro_scale(self):
+        """Returns the factor converting raw gyroscope counts to deg/s."""
+        return self._scale.gyro_scale
+
+    def describe(self):
+        """Returns the chip's configuration as a JSON serializable dict."""
+        return {
+            'chip_id': self._mpu_id,
+            'sample_frequency': self._sample_frequency_cached,
+            'accel_range': self._accel_range_cached.name,
+            'gyro_range': self._gyro_range_cached.name,
+            'accel_scale': self.get_accel_scale(),
+            'gyro_scale': self.get_gyro_scale(),
+        }
+
+    def enable_interrupts(self, data_ready = True, fifo_overflow = True):
+        """Routes the data ready and/or FIFO overflow interrupts to the INT pin.
+
+        The pin is configured active high, push-pull, with a 50 us pulse per
+        event, and INT_STATUS is cleared by reading it.
+        """
+        enabled = 0
+        if data_ready:
+            enabled |= INT_ENABLE.DATA_RDY_EN
+        if fifo_overflow:
+            enabled |= INT_ENABLE.FIFO_OFLOW_EN
+        self.write_registers({ICM20689Regs.INT_PIN_CFG: 0x00, ICM20689Regs.INT_ENABLE: enabled})
+
+    def read_int_status(self):
+        """Reads (and thereby clears) the INT_STATUS register."""
+        return self.read_byte_data(ICM20689Regs.INT_STATUS)
+
+    def read_fifo_batch(self):
+        """Reads every complete frame currently held in the FIFO.
+
+        Returns a SampleBatch, which is empty when the FIFO holds less than
+        one frame. Its samples are timestamped by the chip's SampleClock.
+        """
+        start = time.perf_counter_ns()
         count = self.get_fifo_count()
-        if count > 128:
-            print ("Fifo count %d" % count)
-        gyro_scale_modifier = self._gyro_range_cached.get_lsb_sensitivity()
-        accel_scale_modifier = self._accel_range_cached.get_lsb_sensitivity() / self.GRAVITIY_MS2
-        for i in range(0, math.floor(count/6) - 1):
-            x = self.read_word_data(ICM20689Regs.FIFO_R_W, ICM20689Regs.FIFO_R_W)/accel_scale_modifier
-            y = self.read_word_data(ICM20689Regs.FIFO_R_W, ICM20689Regs.FIFO_R_W)/accel_scale_modifier
-            z = self.read_word_data(ICM20689Regs.FIFO_R_W, ICM20689Regs.FIFO_R_W)/accel_scale_modifier
-            g_x = self.read_word_data(ICM20689Regs.FIFO_R_W, ICM20689Regs.FIFO_R_W)/gyro_scale_modifier
-            g_y = self.read_word_data(ICM20689Regs.FIFO_R_W, ICM20689Regs.FIFO_R_W)/gyro_scale_modifier
-            g_z = self.read_word_data(ICM20689Regs.FIFO_R_W, ICM20689Regs.FIFO_R_W)/gyro_scale_modifier
-
-            data.append(MpuDataPoint(self._mpu_id, AccelerometerData(x, y, z), GyroData(g_x, g_y, g_z)))
-
-        return data
+        drain_time = self._sample_clock.now()
+        self._bus_ns.record(time.perf_counter_ns() - start)
+
+        count = min(count, self.FIFO_MAX // 2)
+        self._fifo_fill.set(count * 2)
+        if count * 2 + self.FIFO_FRAME_BYTES > self.FIFO_MAX:
+            # Samples were lost, so the count no longer tracks the chip's clock
+            self._sample_clock.reset()
+
+        frames = count // 6
+        if frames:
+            raw_frames = self._get_fifo_data(frames * 6)
+            self._fifo_samples.inc(len(raw_frames))
+        else:
+            # Nothing to read, so no bus transaction
+            raw_frames = decode_fifo_bytes(b'')
+
+        timestamp, sample_period = self._sample_clock.stamp(drain_time, len(raw_frames))
+        self._sample_rate.set(1.0 / sample_period)
+
+        scale = self._scale
+        return SampleBatch(self._mpu_id, timestamp, sample_period, raw_frames, scale.accel_scale, scale.gyro_scale,
+                           scale if scale.calibrated else None)
+
+    def read_fifo_array(self):
+        """Reads every complete frame currently held in the FIFO.
+
+        Returns an (N, 6) float array with ax, ay, az in m/s^2 followed by
+        gx, gy, gz in degrees per second.
+        """
+        return self.read_fifo_batch().to_array()
+
+    def read_fifo_data(self):
+        return self.read_fifo_batch().to_points()
 
 class Icm20689I2C(Icm20689):
 
     def __init__(self, mpu_id, bus, chip_select):
         super(Icm20689I2C, self).__init__(mpu_id)
-        self._bus = smbus.SMBus(bus)
+        self._gpio = _gpio()
+        self._bus = _smbus().SMBus(bus)
         self._address = 0x69
         self._chip_select = chip_select
 
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self._chip_select, GPIO.OUT)
+        self._gpio.setmode(self._gpio.BCM)
+        self._gpio.setup(self._chip_select, self._gpio.OUT)
 
         # Wake up the ICM-20689 since it starts in sleep mode
         self.write_byte_data(ICM20689Regs.PWR_MGMT_1, 0x00)
 
     # I2C communication methods
     def read_byte_data(self, register):
-        GPIO.output(self._chip_select, 1)
+        self._gpio.output(self._chip_select, 1)
         ret_val = self._bus.read_byte_data(self._address, register.value)
-        GPIO.output(self._chip_select, 0)
+        self._gpio.output(self._chip_select, 0)
         return ret_val
 
     def write_byte_data(self, register, value):
-        GPIO.output(self._chip_select, 1)
+        self._gpio.output(self._chip_select, 1)
         self._bus.write_byte_data(self._address, register.value, value)
-        GPIO.output(self._chip_select, 0)
+        self._gpio.output(self._chip_select, 0)
 
+    def read_block_data(self, register, size):
+        self._gpio.output(self._chip_select, 1)
+        ret_val = self._bus.read_i2c_block_data(self._address, register.value, size)
+        self._gpio.output(self._chip_select, 0)
+        return bytes(ret_val)
 
-class Icm20689SPI(Icm20689):
+    def write_block_data(self, register, values):
+        self._gpio.output(self._chip_select, 1)
+        self._bus.write_i2c_block_data(self._address, register.value, list(values))
+        self._gpio.output(self._chip_select, 0)
 
-    FIFO_MAX = 4096
+
+class Icm20689SPI(Icm20689):
 
     def __init__(self, mpu_id, bus, device, chip_select):
         super(Icm20689SPI, self).__init__(mpu_id)
-        self._bus =  spidev.SpiDev()
+        self._gpio = _gpio()
+        self._bus = _spidev().SpiDev()
         self._bus.open(bus, device)
         self._bus.max_speed_hz = 2000000
         self._bus.mode = 0b11
         self._chip_select = chip_select
 
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setwarnings(False)
-        GPIO.setup(self._chip_select, GPIO.OUT)
-        GPIO.output(self._chip_select, 1)
+        self._gpio.setmode(self._gpio.BCM)
+        self._gpio.setwarnings(False)
+        self._gpio.setup(self._chip_select, self._gpio.OUT)
+        self._gpio.output(self._chip_select, 1)
         # Wake up the ICM-20689 since it starts in sleep mode
         self.write_byte_data(ICM20689Regs.PWR_MGMT_1, 0x00)
 
@@ -361,181 +630,471 @@ class Icm20689SPI(Icm20689):
         else:
             self._bus.max_speed_hz = 2000000
 
-        GPIO.output(self._chip_select, 0)
+        self._gpio.output(self._chip_select, 0)
         response = self._bus.xfer([ register.value | 0x80, 0x00 ])
         # Perform SPI read
-        GPIO.output(self._chip_select, 1)
+        self._gpio.output(self._chip_select, 1)
         return response[1]
 
     def write_byte_data(self, register, value):
         self._bus.max_speed_hz = 2000000
-        GPIO.output(self._chip_select, 0)
+        self._gpio.output(self._chip_select, 0)
         # Perform SPI Write
         self._bus.xfer( [ register.value,  value ])
 
-        GPIO.output(self._chip_select, 1)
+        self._gpio.output(self._chip_select, 1)
 
     def _bulk_transfer(self, register, size):
         xfer_data = [ 0 ] * (size + 1)
         xfer_data[0] = register.value | 0x80
 
-        GPIO.output(self._chip_select, 0)
+        self._gpio.output(self._chip_select, 0)
         response = self._bus.xfer(xfer_data)
-        GPIO.output(self._chip_select, 1)
+        self._gpio.output(self._chip_select, 1)
 
         return response[1:]
 
-    def _transform_raw_data(self, raw_data):
-        data_points = []
-
-        for i in range(0, len(raw_data), 2):
-            value = (raw_data[i] << 8) + raw_data[i+1]
+    def read_block_data(self, register, size):
+        return bytes(self._bulk_transfer(register, size))
 
-            if (value >= 0x8000):
-                data_points.append(-((65535 - value) + 1))
-            else:
-                data_points.append(value)
-        return data_points
+    def write_block_data(self, register, values):
+        self._bus.max_speed_hz = 2000000
+        self._gpio.output(self._chip_select, 0)
+        self._bus.xfer([register.value] + list(values))
+        self._gpio.output(self._chip_select, 1)
 
     def _get_fifo_data(self, count):
+        start = time.perf_counter_ns()
         raw_data = self._bulk_transfer(ICM20689Regs.FIFO_R_W, count * 2)
+        read = time.perf_counter_ns()
+        self._bus_ns.record(read - start)
+
+        raw_frames = decode_fifo_bytes(raw_data)
+        self._decode_ns.record(time.perf_counter_ns() - read)
+        return raw_frames
+
+class SampleRingBuffer(object):
+    """Preallocated single-producer, multi-consumer ring of sample batches.
+
+    The producer copies each batch once into a fixed-size slot; every
+    consumer gets its own RingReader cursor and receives SampleBatch views
+    of those slots, so one acquisition stream feeds several sinks without
+    per-sink copies and without unbounded memory growth.
+
+    With overflow='overwrite' the producer never waits and readers that
+    fall more than slots - 2 batches behind skip ahead, counting the lost
+    slots in their dropped counter. With overflow='block' put() waits for
+    the slowest reader instead. Readers must finish with a view before the
+    producer wraps around to its slot.
+
+    put(), get() and empty() match queue.Queue closely enough for the
+    sender and writer threads to use a ring and its readers in place of a
+    Queue.
+    """
+
+    def __init__(self, slots = 256, slot_samples = 341, overflow = 'overwrite', name = 'samples'):
+        """slot_samples -- samples per slot; larger batches span several
+        slots. The default holds a full 4 KB FIFO.
+        name -- labels the ring's metrics.
+        """
+        if overflow not in ('overwrite', 'block'):
+            raise ValueError("overflow must be 'overwrite' or 'block', not %r" % (overflow,))
+        if slots < 3:
+            raise ValueError("slots must be at least 3")
+        self._slots = slots
+        self._slot_samples = slot_samples
+        self._overflow = overflow
+        self._frames = np.zeros((slots, slot_samples, 6), dtype='>i2')
+        self._counts = [0] * slots
+        self._headers = [None] * slots
+        self._write_seq = 0
+        self._readers = []
+        self._next_reader = 0
+        self._cond = threading.Condition()
+        self._name = name
+        self._dropped_samples = METRICS.counter('ring_dropped_samples', ring=name)
+        self.dropped = 0
+
+    @property
+    def slots(self):
+        return self._slots
+
+    def subscribe(self):
+        """Returns a new reader that sees every batch put from now on."""
+        with self._cond:
+            reader = RingReader(self, self._write_seq, self._next_reader)
+            self._next_reader += 1
+            self._readers.append(reader)
+        return reader
+
+    def unsubscribe(self, reader):
+        with self._cond:
+            self._readers.remove(reader)
+            self._cond.notify_all()
+
+    def _has_room(self):
+        if not self._readers:
+            return True
+        # Keep the slot a reader was handed last intact while it uses the view
+        return self._write_seq - min(reader._cursor for reader in self._readers) < self._slots - 1
+
+    def put(self, batch, block = True, timeout = None):
+        """Publishes a batch, splitting it over as many slots as needed.
+
+        In 'block' mode a full ring waits for the slowest reader for up to
+        timeout seconds, then raises Full and counts the rest of the batch
+        as dropped.
+        """
+        while len(batch):
+            part = batch[:self._slot_samples]
+            batch = batch[self._slot_samples:]
+
+            if self._overflow == 'block':
+                with self._cond:
+                    if not self._cond.wait_for(self._has_room, timeout if block else 0):
+                        self.dropped += len(part) + len(batch)
+                        self._dropped_samples.inc(len(part) + len(batch))
+                        raise Full
+
+            slot = self._write_seq % self._slots
+            self._frames[slot, :len(part)] = part.raw
+            self._counts[slot] = len(part)
+            self._headers[slot] = (part.chip_id, part.timestamp, part.sample_period, part.accel_scale, part.gyro_scale,
+                                   part.scale)
+
+            with self._cond:
+                self._write_seq += 1
+                self._cond.notify_all()
+
+    def _view(self, seq):
+        slot = seq % self._slots
+        chip_id, timestamp, sample_period, accel_scale, gyro_scale, scale = self._headers[slot]
+        return SampleBatch(chip_id, timestamp, sample_period, self._frames[slot, :self._counts[slot]],
+                           accel_scale, gyro_scale, scale)
+
+class RingReader(object):
+    """A consumer cursor into a SampleRingBuffer."""
+
+    def __init__(self, ring, cursor, reader_id = 0):
+        self._ring = ring
+        self._cursor = cursor
+        self._depth = METRICS.gauge('ring_depth', ring=ring._name, reader=reader_id)
+        self._dropped_slots = METRICS.counter('ring_dropped_slots', ring=ring._name, reader=reader_id)
+        self.dropped = 0
+
+    def qsize(self):
+        return self._ring._write_seq - self._cursor
+
+    def empty(self):
+        return self._ring._write_seq == self._cursor
+
+    def get(self, block = True, timeout = None):
+        """Returns the next batch as a view into the ring.
+
+        Raises Empty if no batch arrives within timeout seconds.
+        """
+        ring = self._ring
+        if ring._write_seq == self._cursor:
+            if not block:
+                raise Empty
+            with ring._cond:
+                if not ring._cond.wait_for(lambda: ring._write_seq != self._cursor, timeout):
+                    raise Empty
+
+        with ring._cond:
+            # The oldest slot may be in the middle of being overwritten, and
+            # the one after it must survive the next put while the view is
+            # in use, as _has_room keeps it in block mode
+            lag = ring._write_seq - self._cursor
+            self._depth.set(lag)
+            if ring._overflow == 'overwrite' and lag > ring._slots - 2:
+                # Overwritten before this reader got to them
+                self.dropped += lag - (ring._slots - 2)
+                self._dropped_slots.inc(lag - (ring._slots - 2))
+                self._cursor = ring._write_seq - (ring._slots - 2)
+            batch = ring._view(self._cursor)
+            self._cursor += 1
+            ring._cond.notify_all()
+
+        return batch
+
+    def close(self):
+        self._ring.unsubscribe(self)
+
+def drain_interval(chip, target_fill = .25, min_interval = .002, max_interval = .050):
+    """Returns the seconds it takes chip to fill target_fill of its FIFO.
+
+    The result is kept between min_interval and max_interval.
+    """
+    target_frames = target_fill * chip.FIFO_MAX / chip.FIFO_FRAME_BYTES
+    interval = target_frames / chip.get_sample_frequency()
+    return min(max(interval, min_interval), max_interval)
 
-        return self._transform_raw_data(raw_data)
-
-    def read_fifo_data(self):
-        data = []
-        count = self.get_fifo_count()
-
-        count = min(count, Icm20689SPI.FIFO_MAX)
-
-        if count > 128:
-            print ("Fifo count %d" % count)
-
-        if count == 0:
-            return data
-
-        data_points = self._get_fifo_data(math.floor(count/6) * 6)
+class DataCollectionThread(InterruptableThread):
+    """Drains the chips' FIFOs on a per-chip schedule.
+
+    Each chip is drained when its FIFO is expected to reach target_fill of
+    its capacity, given its sample rate and frame size, but never less
+    often than every max_interval seconds (which bounds latency) or more
+    often than every wait_sleep seconds. Between drains the thread sleeps
+    until the earliest deadline. The largest fill seen per chip is kept in
+    fifo_high_water (bytes). A drain that found a full FIFO is counted in
+    fifo_overflows; its frames are dropped and the FIFO is reset, as in
+    InterruptCollectionThread, to resync frame alignment.
+    """
+
+    def __init__(self, queue, chips, wait_sleep=.002, target_fill=.25, max_interval=.050):
+        super(DataCollectionThread, self).__init__()
+        self._queue = queue
+        self._chips = chips
+        self._wait_sleep = wait_sleep
+        self._target_fill = target_fill
+        self._max_interval = max_interval
+        self.fifo_high_water = dict((chip.get_mpu_id(), 0) for chip in chips)
+        self.fifo_overflows = dict((chip.get_mpu_id(), 0) for chip in chips)
+        self._overflow_counters = dict((chip.get_mpu_id(), METRICS.counter('fifo_overflows', chip=chip.get_mpu_id()))
+                                       for chip in chips)
 
-        gyro_scale_modifier = self._gyro_range_cached.get_lsb_sensitivity()
-        accel_scale_modifier = self._accel_range_cached.get_lsb_sensitivity() / self.GRAVITIY_MS2
+    def drain_interval(self, chip):
+        """Returns the seconds it takes chip to fill target_fill of its FIFO."""
+        return drain_interval(chip, self._target_fill, self._wait_sleep, self._max_interval)
 
-        for i in range(0, len(data_points), 6):
-            g_x = data_points[i+3]/gyro_scale_modifier
-            g_y = data_points[i+4]/gyro_scale_modifier
-            g_z = data_points[i+5]/gyro_scale_modifier
-            x = data_points[i+0]/accel_scale_modifier
-            y = data_points[i+1]/accel_scale_modifier
-            z = data_points[i+2]/accel_scale_modifier
+    def run(self):
+        for chip in self._chips:
+            chip.enable_fifo()
 
-            data.append(MpuDataPoint(self._mpu_id, AccelerometerData(x, y, z), GyroData(g_x, g_y, g_z)))
+        start = time.monotonic()
+        deadlines = [start + self.drain_interval(chip) for chip in self._chips]
 
-        return data
+        while not self.stopped():
+            now = time.monotonic()
+            for i, chip in enumerate(self._chips):
+                if deadlines[i] > now:
+                    continue
+
+                batch = chip.read_fifo_batch()
+                deadlines[i] = now + self.drain_interval(chip)
+
+                fill = len(batch) * chip.FIFO_FRAME_BYTES
+                chip_id = chip.get_mpu_id()
+                if fill > self.fifo_high_water[chip_id]:
+                    self.fifo_high_water[chip_id] = fill
+                if fill + chip.FIFO_FRAME_BYTES > chip.FIFO_MAX:
+                    # The oldest bytes were overwritten, so the frames read
+                    # are misaligned; reset the FIFO to resync and drop them
+                    self.fifo_overflows[chip_id] += 1
+                    self._overflow_counters[chip_id].inc()
+                    chip.enable_fifo()
+                    continue
+
+                if len(batch):
+                    self._queue.put(batch)
+
+            self._stop_event.wait(max(min(deadlines) - time.monotonic(), 0))
+
+class EdgeSource(object):
+    """Collects edge events from interrupt pins for InterruptCollectionThread.
+
+    Implementations call _on_edge(pin) from whatever context detects the
+    edge; wait() hands the pending edges to the acquisition thread.
+    """
 
-class InterruptableThread(threading.Thread):
     def __init__(self):
-        super(InterruptableThread, self).__init__(daemon=True)
-        self._stop_event = threading.Event()
+        self._cond = threading.Condition()
+        self._pending = {}
 
-    def stop(self):
-        self._stop_event.set()
+    def add_pin(self, pin):
+        pass
 
-    def stopped(self):
-        return self._stop_event.is_set()
+    def close(self):
+        pass
 
-class UdpNetworkSenderThread(InterruptableThread):
-    def __init__(self, queue, ip_addr='192.168.0.200', port = 1025):
-        super(UdpNetworkSenderThread, self).__init__()
-        self._data_queue = queue
-        self._ip_addr = ip_addr
-        self._port = port
+    def _on_edge(self, pin):
+        with self._cond:
+            self._pending[pin] = self._pending.get(pin, 0) + 1
+            self._cond.notify()
 
-    def run(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        while not self.stopped():
-            try:
-                data = self._data_queue.get(timeout=1)
-                try:
-                    time.sleep(.100)
-                    while not self._data_queue.empty():
-                        data.extend(self._data_queue.get(block=False))
-                except Empty:
-                    pass
-                print ("Sending data with %d points" % len(data))
-                packet = MpuDataPacket(data)
-                sock.sendto(packet.serialize(), (self._ip_addr, self._port))
-            except Empty:
-                pass
-
-class TcpNetworkSenderThread(InterruptableThread):
-    # NOTE: This is functional but currently clunky.
-    def __init__(self, queue, ip_addr='192.168.0.200', port = 1025):
-        super(TcpNetworkSenderThread, self).__init__()
-        self._data_queue = queue
-        self._ip_addr = ip_addr
-        self._port = port
+    def wait(self, timeout = None):
+        """Waits up to timeout seconds for at least one edge.
 
-    def run(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((self._ip_addr, self._port))
-        while not self.stopped():
-            try:
-                data = self._data_queue.get(timeout=1)
-                try:
-                    time.sleep(.100)
-                    while not self._data_queue.empty():
-                        data.extend(self._data_queue.get(block=False))
-                except Empty:
-                    pass
-                print ("Sending data with %d points" % len(data))
-                packet = MpuDataPacket(data)
-                sock.sendto(packet.serialize(), (self._ip_addr, self._port))
-            except Empty:
-                pass
+        Returns a dictionary of pin to the number of edges seen since the
+        previous call, which is empty on timeout.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending, timeout)
+            fired = self._pending
+            self._pending = {}
+        return fired
 
-class DataCollectionThread(InterruptableThread):
-    def __init__(self, queue, chips, wait_sleep=.005):
-        super(DataCollectionThread, self).__init__()
+class GpioEdgeSource(EdgeSource):
+    """Edge source backed by RPi.GPIO rising edge detection."""
+
+    def __init__(self):
+        super(GpioEdgeSource, self).__init__()
+        self._gpio = _gpio()
+        self._pins = []
+
+    def add_pin(self, pin):
+        self._gpio.setmode(self._gpio.BCM)
+        self._gpio.setup(pin, self._gpio.IN)
+        self._gpio.add_event_detect(pin, self._gpio.RISING, callback=self._on_edge)
+        self._pins.append(pin)
+
+    def close(self):
+        for pin in self._pins:
+            self._gpio.remove_event_detect(pin)
+        self._pins = []
+
+class SimulatedEdgeSource(EdgeSource):
+    """Edge source driven by calls to trigger(), for tests and benchmarks."""
+
+    def trigger(self, pin, count = 1):
+        for i in range(0, count):
+            self._on_edge(pin)
+
+class InterruptCollectionThread(InterruptableThread):
+    """Drains FIFOs when the chips signal new data on their INT pins.
+
+    Each chip raises its INT pin on every new sample (DATA_RDY) and on FIFO
+    overflow. The thread sleeps on the edge source and reads a chip's FIFO
+    once frames_per_drain samples have been signalled, which is derived
+    from max_latency and the chip's sample rate unless given. If no edge
+    arrives for max_interval seconds the chip is drained anyway, so missed
+    edges cannot stall it. A drain first reads INT_STATUS; on overflow the
+    FIFO contents can no longer be split into whole frames, so the FIFO is
+    reset to resync frame alignment and the overflow is counted.
+    """
+
+    def __init__(self, queue, chips, int_pins, edge_source = None, frames_per_drain = None, max_latency = .010, max_interval = .100):
+        """int_pins -- the GPIO pin wired to each chip's INT output, in the
+        same order as chips.
+        """
+        super(InterruptCollectionThread, self).__init__()
+        if len(int_pins) != len(chips):
+            raise ValueError("Need one INT pin per chip")
         self._queue = queue
         self._chips = chips
-        self._wait_sleep = wait_sleep
+        self._int_pins = list(int_pins)
+        self._edge_source = edge_source if edge_source is not None else GpioEdgeSource()
+        self._frames_per_drain = frames_per_drain
+        self._max_latency = max_latency
+        self._max_interval = max_interval
+        self.fifo_overflows = dict((chip.get_mpu_id(), 0) for chip in chips)
+        self._overflow_counters = dict((chip.get_mpu_id(), METRICS.counter('fifo_overflows', chip=chip.get_mpu_id()))
+                                       for chip in chips)
+
+    def _drain_threshold(self, chip):
+        if self._frames_per_drain is not None:
+            return self._frames_per_drain
+        return max(1, int(self._max_latency * chip.get_sample_frequency()))
+
+    def _drain(self, chip):
+        if chip.read_int_status() & INT_STATUS.FIFO_OFLOW_INT:
+            self.fifo_overflows[chip.get_mpu_id()] += 1
+            self._overflow_counters[chip.get_mpu_id()].inc()
+            chip.enable_fifo()
+            return
+
+        batch = chip.read_fifo_batch()
+        if len(batch):
+            self._queue.put(batch)
 
     def run(self):
-        for chip in self._chips:
+        for chip, pin in zip(self._chips, self._int_pins):
             chip.enable_fifo()
-
-        while not self.stopped():
-            for chip in self._chips:
-                data = chip.read_fifo_data()
-                self._queue.put(data)
-            time.sleep(self._wait_sleep)
+            chip.enable_interrupts()
+            self._edge_source.add_pin(pin)
+
+        chip_by_pin = dict(zip(self._int_pins, range(0, len(self._chips))))
+        thresholds = [self._drain_threshold(chip) for chip in self._chips]
+        pending = [0] * len(self._chips)
+        deadlines = [time.monotonic() + self._max_interval] * len(self._chips)
+
+        try:
+            while not self.stopped():
+                fired = self._edge_source.wait(max(min(deadlines) - time.monotonic(), 0))
+                for pin, count in fired.items():
+                    if pin in chip_by_pin:
+                        pending[chip_by_pin[pin]] += count
+
+                now = time.monotonic()
+                for i, chip in enumerate(self._chips):
+                    if pending[i] >= thresholds[i] or deadlines[i] <= now:
+                        self._drain(chip)
+                        pending[i] = 0
+                        deadlines[i] = now + self._max_interval
+        finally:
+            self._edge_source.close()
 
 class Write2FileThread(InterruptableThread):
-    def __init__(self, queue, sampNum = 0):
+    """Records queued batches to binary recording files.
+
+    See icm20689_record for the file format. Files are written to
+    directory and a new one is started every max_bytes or max_seconds.
+    The thread stops after duration seconds, or when stopped if duration
+    is None.
+
+    chips -- the chips being recorded, whose configuration goes into the
+    file headers.
+    """
+
+    def __init__(self, queue, directory = '.', prefix = 'imu', chips = None, duration = None,
+                 max_bytes = 256 * 1024 * 1024, max_seconds = None, buffer_size = 1 << 20):
         super(Write2FileThread, self).__init__()
         self._data_queue = queue
-        self._sampNum = sampNum
+        self._writer = RecordingWriter(directory, prefix, [chip.describe() for chip in chips or []],
+                                       max_bytes=max_bytes, max_seconds=max_seconds, buffer_size=buffer_size)
+        self._duration = duration
+        self._queue_depth = METRICS.gauge('queue_depth', consumer='file_writer')
+        self._samples_written = METRICS.counter('file_samples_written')
+
+    @property
+    def paths(self):
+        """The files written so far."""
+        return list(self._writer.paths)
 
     def run(self):
-        f = open("temp.txt","w+")
-        start = time.time()
-        while time.time() - start < 3600:
-            try:
-                data = self._data_queue.get(timeout=1)
-                retTime = time.time()-start
+        start = time.monotonic()
+        try:
+            while not self.stopped():
+                if self._duration is not None and time.monotonic() - start >= self._duration:
+                    break
                 try:
-                    time.sleep(.100)
-                    while not self._data_queue.empty():
-                        data.extend(self._data_queue.get(block=False))
+                    batch = self._data_queue.get(timeout=.5)
                 except Empty:
-                    pass
-                print ("%d   Writing data with %d points" % (self._sampNum, len(data)))
-                for x in range(0, len(data)):
-                    self._sampNum += 1
-                    f.write("%d %0.4f %d %d %d %d %d %d \r" % (self._sampNum, retTime, data[x]._accel_data.x_val, data[x]._accel_data.y_val, data[x]._accel_data.z_val, data[x]._gyro_data.x_val, data[x]._gyro_data.y_val, data[x]._gyro_data.z_val))
-            except Empty:
-                pass
-        f.write("%d recorded in %0.4f seconds\r" % (self._sampNum, time.time()-start))
-        f.close()
+                    continue
+                self._queue_depth.set(self._data_queue.qsize())
+                self._writer.write(batch)
+                self._samples_written.inc(len(batch))
+        finally:
+            self._writer.close()
+
+def init_spi_chips(gpios, sample_frequency = 100, accel_range = AFS_SEL.FS_8G, gyro_range = FS_SEL.FS_DEG_2000,
+                   bus = 0, device = 0, first_id = 1, config = None, verify = False, profiles = None):
+    """Creates and configures one Icm20689SPI per chip select pin.
+
+    gpios -- the GPIO pins wired to the chips' CS lines. Chip ids are
+    assigned from first_id in the order of the list.
+    bus, device -- the spidev the chips are connected to.
+    config -- a ChipConfig applied to every chip; by default one made
+    from sample_frequency, accel_range and gyro_range.
+    verify -- read the configuration back, see Icm20689.write_registers.
+    profiles -- a ProfileStore whose calibration profiles are applied.
+    Returns the list of chips with their FIFOs set up for accel and gyro.
+    """
+    if config is None:
+        config = ChipConfig(sample_frequency, accel_range, gyro_range)
+
+    chips = []
+    for i, gpio in enumerate(gpios):
+        # Define IMU transmission mode (i.e. SPI, I2C, or W2F)
+        chip = Icm20689SPI(first_id + i, bus, device, gpio)
+        chip.apply_config(config, verify)
+        if profiles is not None:
+            profiles.apply(chip, verify=verify)
+        # Add chip to the list
+        chips.append(chip)
+    return chips
 
 THREAD_SET = []
 
@@ -546,31 +1105,27 @@ def quit_handler(signal, frame):
 
 
 if __name__ == "__main__":
+    import signal
+    from icm20689_net import UdpNetworkSenderThread
+    from icm20689_metrics import MetricsServer
+
     # Ignore some initilization warnings
-    GPIO.setwarnings(False)
+    _gpio().setwarnings(False)
 
     # Close leftover threads
     signal.signal(signal.SIGINT, quit_handler)
 
     # Initialize the chips with CS pins connected to the following pins GPIO pins on RasPi
-    chips = []
     GPIOS = [22, 23, 24, 25]
-    for i, gpio in enumerate(GPIOS):
-        # Define IMU transmission mode (i.e. SPI, I2C, or W2F)
-        chip = Icm20689SPI(i+1, 0, 0, gpio)
-        chip.set_fifo_enable()
-        chip.write_byte_data(ICM20689Regs.CONFIG, 1)
-        # Alter imu recording settings
-        chip.set_sample_frequency(100)
-        chip.set_accel_range(AFS_SEL.FS_8G.value)
-        chip.set_gyro_range(FS_SEL.FS_DEG_2000.value)
-        # Add chip to the list
-        chips.append(chip)
+    chips = init_spi_chips(GPIOS)
+
+    # Serve the pipeline metrics at http://127.0.0.1:9100/metrics
+    MetricsServer(('127.0.0.1', 9100)).start()
 
     # Set up simultaneous threads for data collection and transmission
-    queue = Queue()
-    THREAD_SET.append(UdpNetworkSenderThread(queue))
-    THREAD_SET.append(DataCollectionThread(queue, chips))
+    ring = SampleRingBuffer()
+    THREAD_SET.append(UdpNetworkSenderThread(ring.subscribe()))
+    THREAD_SET.append(DataCollectionThread(ring, chips))
 
     # Execute threads
     for thread in THREAD_SET:
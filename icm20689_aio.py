@@ -0,0 +1,345 @@
+import asyncio
+import logging
+import signal
+import socket
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from icm20689 import drain_interval, init_spi_chips
+from icm20689_metrics import METRICS
+from icm20689_net import PacketBatcher, TcpNetworkSenderThread
+from icm20689_record import RecordingWriter
+
+logger = logging.getLogger(__name__)
+
+class AsyncSink(ABC):
+    """Base class for consumers driven by an AsyncAcquisitionRuntime.
+
+    Each sink owns a bounded asyncio.Queue of SampleBatch objects. When a
+    sink falls behind, the oldest batches are dropped rather than letting
+    the queue grow. Subclasses implement write(data) for a list of batches
+    and may override start() and close(). Each write gets every batch
+    queued by then.
+    """
+
+    def __init__(self, max_queued = 1024):
+        self._max_queued = max_queued
+        self._queue = asyncio.Queue(max_queued)
+        sink = type(self).__name__
+        self._queue_depth = METRICS.gauge('queue_depth', consumer=sink)
+        self._dropped_counter = METRICS.counter('sink_dropped_batches', sink=sink)
+        self.dropped_batches = 0
+
+    def offer(self, batch):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped_batches += 1
+            self._dropped_counter.inc()
+        self._queue.put_nowait(batch)
+        self._queue_depth.set(self._queue.qsize())
+
+    async def _collect(self):
+        data = [await self._queue.get()]
+        while not self._queue.empty():
+            data.append(self._queue.get_nowait())
+        return data
+
+    async def start(self):
+        pass
+
+    @abstractmethod
+    async def write(self, data):
+        pass
+
+    async def close(self):
+        pass
+
+    async def run(self):
+        # A queue belongs to the loop it was first used on
+        self._queue = asyncio.Queue(self._max_queued)
+        await self.start()
+        try:
+            while True:
+                await self.write(await self._collect())
+        finally:
+            await self.close()
+
+class AsyncPacketSink(AsyncSink):
+    """Base class for sinks that send MpuDataPackets.
+
+    Batches are gathered with a PacketBatcher, so each write gets up to
+    max_bytes of data, or what arrived within max_latency seconds.
+    """
+
+    def __init__(self, max_bytes, max_latency, max_queued = 1024):
+        super(AsyncPacketSink, self).__init__(max_queued)
+        self._batcher = PacketBatcher(max_bytes, max_latency)
+
+    async def _collect(self):
+        pending = self._batcher.begin(await self._queue.get())
+        while True:
+            remaining = pending.remaining()
+            if remaining <= 0:
+                break
+            # asyncio.wait rather than wait_for: on 3.11 wait_for can swallow a
+            # cancel that races with the get, leaving run() waiting forever.
+            getter = asyncio.ensure_future(self._queue.get())
+            try:
+                done, _ = await asyncio.wait((getter,), timeout = remaining)
+            finally:
+                getter.cancel()
+            if not done:
+                break
+            pending.add(getter.result())
+        return pending.data
+
+class AsyncUdpSink(AsyncPacketSink):
+    def __init__(self, ip_addr='192.168.0.200', port = 1025, max_bytes = PacketBatcher.MTU_PAYLOAD, max_latency = .005, max_queued = 1024):
+        super(AsyncUdpSink, self).__init__(max_bytes, max_latency, max_queued)
+        self._address = (ip_addr, port)
+        self._transport = None
+        self._packets_sent = METRICS.counter('net_packets_sent', transport='async_udp')
+        self._bytes_sent = METRICS.counter('net_bytes_sent', transport='async_udp')
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=self._address)
+
+    async def write(self, data):
+        for packet in self._batcher.make_packets(data):
+            payload = packet.serialize()
+            self._transport.sendto(payload)
+            self._packets_sent.inc()
+            self._bytes_sent.inc(len(payload))
+
+    async def close(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+class AsyncTcpSink(AsyncPacketSink):
+    """Sends length-prefixed frames like TcpNetworkSenderThread.
+
+    Backpressure comes from awaiting the stream writer's drain(), and a lost
+    connection is retried with exponential backoff while new batches keep
+    replacing the oldest ones in the queue.
+    """
+
+    def __init__(self, ip_addr='192.168.0.200', port = 1025, max_bytes = 65536, max_latency = .005, max_queued = 1024,
+                 nodelay = True, reconnect_delay = .1, max_reconnect_delay = 10.0):
+        super(AsyncTcpSink, self).__init__(max_bytes, max_latency, max_queued)
+        self._address = (ip_addr, port)
+        self._nodelay = nodelay
+        self._reconnect_delay = reconnect_delay
+        self._max_reconnect_delay = max_reconnect_delay
+        self._writer = None
+        self._packets_sent = METRICS.counter('net_packets_sent', transport='async_tcp')
+        self._bytes_sent = METRICS.counter('net_bytes_sent', transport='async_tcp')
+
+    async def _connect(self):
+        delay = self._reconnect_delay
+        while self._writer is None:
+            try:
+                _, self._writer = await asyncio.open_connection(*self._address)
+            except OSError as e:
+                logger.warning("TCP connect to %s:%d failed (%s), retrying in %0.1f s", self._address[0], self._address[1], e, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self._max_reconnect_delay)
+
+        sock = self._writer.get_extra_info('socket')
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self._nodelay else 0)
+
+    async def write(self, data):
+        await self._connect()
+        for packet in self._batcher.make_packets(data):
+            payload = packet.serialize()
+            self._writer.write(TcpNetworkSenderThread.FRAME_PREFIX.pack(len(payload)))
+            self._writer.write(payload)
+            self._packets_sent.inc()
+            self._bytes_sent.inc(TcpNetworkSenderThread.FRAME_PREFIX.size + len(payload))
+        try:
+            await self._writer.drain()
+        except OSError as e:
+            logger.warning("TCP connection to %s:%d lost (%s)", self._address[0], self._address[1], e)
+            self._writer.close()
+            self._writer = None
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+class AsyncFileSink(AsyncSink):
+    """Records batches to binary recording files, doing the I/O in an executor.
+
+    Takes the same recording options as Write2FileThread; see
+    icm20689_record for the file format. The batches queued while the
+    previous write ran are written together.
+    """
+
+    def __init__(self, directory = '.', prefix = 'imu', chips = None, max_bytes = 256 * 1024 * 1024, max_seconds = None,
+                 max_queued = 4096):
+        super(AsyncFileSink, self).__init__(max_queued)
+        self._writer = RecordingWriter(directory, prefix, [chip.describe() for chip in chips or []],
+                                       max_bytes=max_bytes, max_seconds=max_seconds)
+        self._executor = None
+
+    @property
+    def paths(self):
+        return list(self._writer.paths)
+
+    async def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _write(self, data):
+        for batch in data:
+            self._writer.write(batch)
+
+    async def write(self, data):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._write, data)
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._writer.close)
+        self._executor.shutdown(wait=False)
+        self._executor = None
+
+class AsyncAcquisitionRuntime(object):
+    """Runs FIFO polling and all sinks on a single event loop.
+
+    The bus transactions are blocking, so each polling round runs on one
+    dedicated reader thread through run_in_executor; everything else (fan
+    out, packet building, network and file output) happens on the loop.
+    Adding a sink adds a task, not a thread. Each chip is drained on the
+    schedule of DataCollectionThread, with the same wait_sleep,
+    target_fill and max_interval options.
+
+    If polling or a sink fails, for example with an IOError on the bus,
+    the failure is logged, everything is stopped and run() raises it.
+    FIFO overflows are counted per chip in fifo_overflows.
+    """
+
+    def __init__(self, chips, sinks = None, wait_sleep = .002, target_fill = .25, max_interval = .050):
+        self._chips = chips
+        self._sinks = list(sinks or [])
+        self._wait_sleep = wait_sleep
+        self._target_fill = target_fill
+        self._max_interval = max_interval
+        self._reader = None
+        self._stop_event = None
+        self._failure = None
+        self.fifo_overflows = dict((chip.get_mpu_id(), 0) for chip in chips)
+        self._overflow_counters = dict((chip.get_mpu_id(), METRICS.counter('fifo_overflows', chip=chip.get_mpu_id()))
+                                       for chip in chips)
+
+    def add_sink(self, sink):
+        self._sinks.append(sink)
+
+    def drain_interval(self, chip):
+        """Returns the seconds it takes chip to fill target_fill of its FIFO."""
+        return drain_interval(chip, self._target_fill, self._wait_sleep, self._max_interval)
+
+    def _drain(self, chips):
+        batches = []
+        for chip in chips:
+            batch = chip.read_fifo_batch()
+            if (len(batch) + 1) * chip.FIFO_FRAME_BYTES > chip.FIFO_MAX:
+                # The frames of an overflowed FIFO are misaligned; reset it
+                # to resync and drop them, as DataCollectionThread does
+                self.fifo_overflows[chip.get_mpu_id()] += 1
+                self._overflow_counters[chip.get_mpu_id()].inc()
+                chip.enable_fifo()
+            elif len(batch):
+                batches.append(batch)
+        return batches
+
+    def _enable(self):
+        for chip in self._chips:
+            chip.enable_fifo()
+
+    async def _poll(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._reader, self._enable)
+        start = time.monotonic()
+        deadlines = [start + self.drain_interval(chip) for chip in self._chips]
+
+        while not self._stop_event.is_set():
+            now = time.monotonic()
+            due = []
+            for i, chip in enumerate(self._chips):
+                if deadlines[i] <= now:
+                    due.append(chip)
+                    deadlines[i] = now + self.drain_interval(chip)
+            if due:
+                for batch in await loop.run_in_executor(self._reader, self._drain, due):
+                    for sink in self._sinks:
+                        sink.offer(batch)
+            await asyncio.sleep(max(min(deadlines) - time.monotonic(), 0))
+
+    def stop(self):
+        if self._stop_event is not None:
+            self._stop_event.set()
+
+    def _task_done(self, task):
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.error("%s failed: %r", task.get_name(), task.exception())
+        if self._failure is None:
+            self._failure = task.exception()
+        self.stop()
+
+    async def run(self):
+        """Runs until stop() is called or SIGINT is received.
+
+        Raises the first exception of the polling or sink tasks. The
+        runtime can be run again afterwards.
+        """
+        loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self._failure = None
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fifo-reader')
+        try:
+            loop.add_signal_handler(signal.SIGINT, self.stop)
+        except (NotImplementedError, RuntimeError):
+            # Not on the main thread, or no signal support on this platform
+            pass
+
+        tasks = [asyncio.ensure_future(sink.run()) for sink in self._sinks]
+        for sink, task in zip(self._sinks, tasks):
+            task.set_name(type(sink).__name__)
+        tasks.append(asyncio.ensure_future(self._poll()))
+        tasks[-1].set_name('FIFO polling')
+        for task in tasks:
+            task.add_done_callback(self._task_done)
+        try:
+            await self._stop_event.wait()
+        finally:
+            logger.info('Stopping tasks')
+            for task in tasks:
+                task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            self._reader.shutdown(wait=True)
+            self._reader = None
+            try:
+                loop.remove_signal_handler(signal.SIGINT)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        if self._failure is None:
+            # A sink may also fail while closing
+            failures = [result for result in results
+                        if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError)]
+            if failures:
+                self._failure = failures[0]
+        if self._failure is not None:
+            raise self._failure
+
+if __name__ == "__main__":
+    # Initialize the chips with CS pins connected to the following pins GPIO pins on RasPi
+    GPIOS = [22, 23, 24, 25]
+    chips = init_spi_chips(GPIOS)
+
+    logging.basicConfig(level=logging.INFO)
+    runtime = AsyncAcquisitionRuntime(chips, [AsyncUdpSink()])
+    asyncio.run(runtime.run())
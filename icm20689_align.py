@@ -0,0 +1,192 @@
+import math
+from queue import Empty
+import numpy as np
+from icm20689_thread import InterruptableThread
+from icm20689_metrics import METRICS
+
+def interpolate(times, data, grid, method = 'linear'):
+    """Interpolates one chip's samples at the grid times.
+
+    times -- (N,) increasing sample times
+    data -- (N, K) samples
+    grid -- (T,) times to interpolate at
+    method -- 'linear', or 'cubic' for a cubic Hermite curve through the
+    samples with slopes from central differences. Unlike a spline it only
+    looks at the two samples either side, so the result does not change
+    as more samples arrive.
+    Returns (T, K) values, NaN where grid is outside times.
+    """
+    out = np.full((len(grid), data.shape[1]), np.nan)
+    if len(times) < 2:
+        return out
+
+    i = np.searchsorted(times, grid, side='right') - 1
+    # A grid time equal to the last sample falls in the last interval
+    i[(i == len(times) - 1) & (grid == times[-1])] -= 1
+    valid = (i >= 0) & (i < len(times) - 1)
+    i = i[valid]
+    t0 = times[i]
+    h = times[i + 1] - t0
+    s = ((grid[valid] - t0) / h)[:, np.newaxis]
+    y0 = data[i]
+    y1 = data[i + 1]
+
+    if method == 'linear':
+        out[valid] = y0 + s * (y1 - y0)
+    elif method == 'cubic':
+        slopes = np.gradient(data, times, axis=0)
+        h = h[:, np.newaxis]
+        s2 = s * s
+        s3 = s2 * s
+        out[valid] = ((2 * s3 - 3 * s2 + 1) * y0 + (s3 - 2 * s2 + s) * h * slopes[i]
+                      + (3 * s2 - 2 * s3) * y1 + (s3 - s2) * h * slopes[i + 1])
+    else:
+        raise ValueError("method must be 'linear' or 'cubic', not %r" % (method,))
+    return out
+
+class ChipAligner(object):
+    """Resamples the batches of several free-running chips onto one time grid.
+
+    Batches are added as they arrive, in any order across chips. pop()
+    returns the grid times that every chip's samples now cover, with one
+    (T, chips, 6) array of samples in m/s^2 and deg/s, chips in the order
+    of chip_ids. The grid is every 1 / rate seconds, at whole multiples
+    of the period.
+
+    A chip that stops delivering would hold everything up, so no grid
+    time waits longer than max_latency seconds behind the newest sample
+    of any chip; a chip with no samples for it by then gets NaN there.
+    Cubic interpolation needs one sample past a grid time more than
+    linear does.
+    """
+
+    def __init__(self, chip_ids, rate, method = 'linear', max_latency = .1):
+        if method not in ('linear', 'cubic'):
+            raise ValueError("method must be 'linear' or 'cubic', not %r" % (method,))
+        self._chip_ids = list(chip_ids)
+        self._columns = dict((chip_id, i) for i, chip_id in enumerate(self._chip_ids))
+        self._period = 1.0 / rate
+        self._method = method
+        self._max_latency = max_latency
+        self._pending = [[] for chip_id in self._chip_ids]
+        self._times = [np.empty(0) for chip_id in self._chip_ids]
+        self._data = [np.empty((0, 6)) for chip_id in self._chip_ids]
+        self._next = None
+
+        self._frames = METRICS.counter('align_frames')
+        self._missing = [METRICS.counter('align_missing_samples', chip=chip_id) for chip_id in self._chip_ids]
+
+    @property
+    def chip_ids(self):
+        return list(self._chip_ids)
+
+    @property
+    def period(self):
+        return self._period
+
+    def add(self, batch):
+        """Queues a SampleBatch. Raises ValueError for a chip not being aligned."""
+        column = self._columns.get(batch.chip_id)
+        if column is None:
+            raise ValueError("Chip %d is not being aligned" % batch.chip_id)
+        if len(batch):
+            self._pending[column].append(batch)
+
+    def _collect(self):
+        for column, pending in enumerate(self._pending):
+            if not pending:
+                continue
+            times = [self._times[column]] + [batch.timestamps() for batch in pending]
+            data = [self._data[column]] + [batch.to_array() for batch in pending]
+            self._pending[column] = []
+            times = np.concatenate(times)
+            data = np.concatenate(data)
+            # Keep the times increasing should batches overlap
+            keep = np.concatenate(([True], np.diff(times) > 0))
+            self._times[column] = times[keep]
+            self._data[column] = data[keep]
+
+    def pop(self, flush = False):
+        """Returns (times, frames) for the grid times that are ready.
+
+        times is (T,) and frames (T, chips, 6); T is 0 when nothing is
+        ready. With flush, everything up to the newest sample is returned,
+        as at the end of a recording.
+        """
+        self._collect()
+        # Samples a chip needs past a grid time: one for linear, two for cubic
+        margin = 1 if self._method == 'linear' else 2
+        chips = [times for times in self._times if len(times) > margin]
+        if not chips:
+            return np.empty(0), np.empty((0, len(self._chip_ids), 6))
+        newest = max(times[-1] for times in chips)
+
+        if self._next is None:
+            if len(chips) < len(self._chip_ids) and not flush and newest - min(t[0] for t in chips) < self._max_latency:
+                return np.empty(0), np.empty((0, len(self._chip_ids), 6))
+            self._next = int(math.ceil(max(times[margin - 1] for times in chips) / self._period))
+
+        if flush:
+            horizon = newest
+        else:
+            ready = [times[-margin] if len(times) > margin else -np.inf for times in self._times]
+            horizon = max(min(ready), newest - self._max_latency)
+        last = int(math.floor(horizon / self._period))
+        if last < self._next:
+            return np.empty(0), np.empty((0, len(self._chip_ids), 6))
+
+        grid = np.arange(self._next, last + 1) * self._period
+        frames = np.empty((len(grid), len(self._chip_ids), 6))
+        for column in range(0, len(self._chip_ids)):
+            times = self._times[column]
+            frames[:, column] = interpolate(times, self._data[column], grid, self._method)
+            missing = np.count_nonzero(np.isnan(frames[:, column, 0]))
+            if missing:
+                self._missing[column].inc(missing)
+
+            # Keep the samples the next grid time is interpolated from
+            start = np.searchsorted(times, (last + 1) * self._period, side='right') - margin
+            if start > 0:
+                self._times[column] = times[start:]
+                self._data[column] = self._data[column][start:]
+
+        self._next = last + 1
+        self._frames.inc(len(grid))
+        return grid, frames
+
+class AlignmentThread(InterruptableThread):
+    """Feeds a ChipAligner from a queue of batches.
+
+    Every time frames are ready, (times, frames) as returned by
+    ChipAligner.pop() is put on out_queue. Batches of chips the aligner
+    does not know are skipped and counted in unknown_batches.
+    """
+
+    def __init__(self, queue, out_queue, aligner):
+        super(AlignmentThread, self).__init__()
+        self._queue = queue
+        self._out_queue = out_queue
+        self._aligner = aligner
+        self._unknown_counter = METRICS.counter('align_unknown_batches')
+        self.unknown_batches = 0
+
+    def _add(self, batch):
+        try:
+            self._aligner.add(batch)
+        except ValueError:
+            self.unknown_batches += 1
+            self._unknown_counter.inc()
+
+    def run(self):
+        while not self.stopped():
+            try:
+                self._add(self._queue.get(timeout=.1))
+                # Take whatever else has arrived before resampling
+                while True:
+                    self._add(self._queue.get(block=False))
+            except Empty:
+                pass
+
+            times, frames = self._aligner.pop()
+            if len(times):
+                self._out_queue.put((times, frames))
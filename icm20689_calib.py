@@ -0,0 +1,268 @@
+"""Bias and scale calibration with per-chip profiles.
+
+Calibration captures raw samples through the FIFO while the chip is
+still, either in one position or in each of six positions with one axis
+pointing up or down. The gyroscope bias is the mean rate; the
+accelerometer bias and per-axis gain come from a least squares fit of
+the position means to a sphere of 1 g.
+
+As much of the bias as the offset registers can hold is moved into
+them, so the chip delivers corrected samples. What is left, the part
+of the bias below one register step and the accelerometer gains, goes
+into the chip's SampleScale, where it is folded into the multiply and
+add that already converts every sample.
+
+Profiles are kept as JSON files in a directory, one per WHO_AM_I and
+chip id, and applied again at start up:
+
+    store = ProfileStore('calibration')
+    profile = calibrate_still(chip, gravity = (0, 0, 1))
+    store.save(profile)
+    ...
+    store.apply(chip)
+"""
+
+import json
+import os
+import time
+import numpy as np
+from icm20689_data import ACCEL_UNITS
+from icm20689_regs import ACCEL_OFFSET_STEP, GYRO_OFFSET_STEP
+
+# Orientations of the six position calibration: gravity in the chip
+# frame, in g, with a description for the person turning the chip
+SIX_POSITIONS = (
+    ((1, 0, 0), '+X axis up'),
+    ((-1, 0, 0), '-X axis up'),
+    ((0, 1, 0), '+Y axis up'),
+    ((0, -1, 0), '-Y axis up'),
+    ((0, 0, 1), '+Z axis up'),
+    ((0, 0, -1), '-Z axis up'),
+)
+
+def capture(chip, seconds, settle = .05):
+    """Collects seconds of samples from the chip's FIFO.
+
+    The FIFO is reset and the first settle seconds are dropped. The
+    FIFO is drained at a quarter of its capacity so no frame is lost.
+    Returns an (N, 6) float64 array of raw counts.
+    """
+    rate = chip.get_sample_frequency()
+    wanted = max(int(round(seconds * rate)), 1)
+    interval = .25 * (chip.FIFO_MAX // chip.FIFO_FRAME_BYTES) / rate
+
+    chip.enable_fifo()
+    time.sleep(settle)
+    chip.read_fifo_batch()
+    frames = []
+    count = 0
+    while count < wanted:
+        time.sleep(min(interval, (wanted - count) / rate))
+        raw = chip.read_fifo_batch().raw
+        frames.append(raw)
+        count += len(raw)
+    return np.concatenate(frames)[:wanted].astype(np.float64)
+
+def fit_accel(means, one_g):
+    """Fits accelerometer bias and gain to still readings in several orientations.
+
+    means -- (P, 3) mean raw readings, P >= 6, in orientations spread
+    over both directions of every axis
+    one_g -- the nominal counts per g
+    Solves x^2 a + x d = 1 for the axis aligned ellipsoid through the
+    readings in one linear least squares step, so that
+
+        (raw - bias) * gain / one_g
+
+    has a length of 1 g. Returns (bias, gain), three values each.
+    Raises ValueError when the orientations do not determine the fit.
+    """
+    means = np.asarray(means, dtype=np.float64) / one_g
+    if means.ndim != 2 or means.shape[1] != 3 or len(means) < 6:
+        raise ValueError("At least 6 orientations are needed, got %d" % len(means))
+    design = np.hstack((means * means, means))
+    solution, residuals, rank, singular = np.linalg.lstsq(design, np.ones(len(means)), rcond=None)
+    if rank < 6:
+        raise ValueError("The orientations do not determine the accelerometer fit")
+    a = solution[:3]
+    bias = -solution[3:] / (2 * a)
+    radius = 1.0 + np.dot(a, bias * bias)
+    k = a / radius
+    if (k <= 0).any():
+        raise ValueError("The readings do not lie on an ellipsoid; was the chip still?")
+    return bias * one_g, np.sqrt(k)
+
+class CalibrationProfile(object):
+    """The calibration of one chip.
+
+    accel_offsets, gyro_offsets -- the offset register values the
+    profile was made for, as returned by Icm20689.read_offset_registers,
+    or None when the registers are not used
+    accel_bias, gyro_bias -- the bias left with those register values,
+    in g and deg/s
+    accel_gain -- factors for the accelerometer axes after removing the
+    bias
+
+    Biases are kept in physical units so the profile holds whatever
+    ranges the chip is configured for.
+    """
+
+    def __init__(self, who_am_i, chip_id, accel_offsets = None, gyro_offsets = None, accel_bias = (0.0, 0.0, 0.0),
+                 gyro_bias = (0.0, 0.0, 0.0), accel_gain = (1.0, 1.0, 1.0), method = None, created = None):
+        self.who_am_i = who_am_i
+        self.chip_id = chip_id
+        self.accel_offsets = None if accel_offsets is None else [int(value) for value in accel_offsets]
+        self.gyro_offsets = None if gyro_offsets is None else [int(value) for value in gyro_offsets]
+        self.accel_bias = [float(value) for value in accel_bias]
+        self.gyro_bias = [float(value) for value in gyro_bias]
+        self.accel_gain = [float(value) for value in accel_gain]
+        self.method = method
+        self.created = time.time() if created is None else created
+
+    def correction(self, accel_offsets, gyro_offsets):
+        """Returns (bias, gain) for Icm20689.set_calibration, None where there is nothing to correct.
+
+        accel_offsets, gyro_offsets -- the chip's offset registers now;
+        a difference from the profile's values is made up in the bias.
+        """
+        accel_bias = np.array(self.accel_bias)
+        gyro_bias = np.array(self.gyro_bias)
+        if self.accel_offsets is not None:
+            accel_bias += (np.array(accel_offsets) - self.accel_offsets) * ACCEL_OFFSET_STEP
+        if self.gyro_offsets is not None:
+            gyro_bias += (np.array(gyro_offsets) - self.gyro_offsets) * GYRO_OFFSET_STEP
+
+        bias = np.concatenate((accel_bias / ACCEL_UNITS['g'], gyro_bias))
+        gain = np.concatenate((self.accel_gain, np.ones(3)))
+        return (bias if bias.any() else None), (gain if (gain != 1.0).any() else None)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+    def __repr__(self):
+        return "CalibrationProfile(who_am_i=0x%02x, chip_id=%r, method=%r)" % (self.who_am_i, self.chip_id, self.method)
+
+def _register_offsets(current, bias, step, limit):
+    """Returns the offset register values cancelling bias, clamped to +-limit."""
+    return [int(min(max(value - round(error / step), -limit), limit - 1)) for value, error in zip(current, bias)]
+
+def make_profile(chip, accel_bias = None, accel_gain = None, gyro_bias = None, hardware = True, method = None):
+    """Builds a profile from biases measured with the chip's current offset registers.
+
+    accel_bias, gyro_bias -- three values each in raw counts, or None
+    when not measured
+    accel_gain -- three factors, or None
+    hardware -- move as much of the bias as fits into the offset registers
+    The profile is not applied; see apply_profile.
+    """
+    accel_offsets, gyro_offsets = chip.read_offset_registers()
+    accel_bias = np.zeros(3) if accel_bias is None else np.asarray(accel_bias) * chip.get_accel_scale() / chip.GRAVITIY_MS2
+    gyro_bias = np.zeros(3) if gyro_bias is None else np.asarray(gyro_bias) * chip.get_gyro_scale()
+
+    if hardware:
+        new_accel = _register_offsets(accel_offsets, accel_bias, ACCEL_OFFSET_STEP, 0x4000)
+        new_gyro = _register_offsets(gyro_offsets, gyro_bias, GYRO_OFFSET_STEP, 0x8000)
+        # The bias left once the registers hold the new values
+        accel_bias = accel_bias + (np.array(new_accel) - accel_offsets) * ACCEL_OFFSET_STEP
+        gyro_bias = gyro_bias + (np.array(new_gyro) - gyro_offsets) * GYRO_OFFSET_STEP
+        accel_offsets, gyro_offsets = new_accel, new_gyro
+
+    return CalibrationProfile(chip.read_who_am_i(), chip.get_mpu_id(), accel_offsets, gyro_offsets, accel_bias,
+                              gyro_bias, accel_gain if accel_gain is not None else (1.0, 1.0, 1.0), method)
+
+def apply_profile(chip, profile, hardware = True, verify = False):
+    """Applies a profile to the chip.
+
+    With hardware the profile's offset register values are written, and
+    verify reads them back. The bias they leave, together with the gains,
+    is set with Icm20689.set_calibration.
+    """
+    if hardware:
+        chip.write_offset_registers(profile.accel_offsets, profile.gyro_offsets, verify)
+    accel_offsets, gyro_offsets = chip.read_offset_registers()
+    chip.set_calibration(*profile.correction(accel_offsets, gyro_offsets))
+
+def calibrate_still(chip, seconds = 2.0, gravity = None, hardware = True, verify = False):
+    """Calibrates a chip held still in one position and applies the result.
+
+    The gyroscope bias is always measured. When gravity, its direction
+    in the chip frame in g, is given the accelerometer bias is measured
+    as well, e.g. gravity = (0, 0, 1) for a chip lying flat face up.
+    Returns the CalibrationProfile.
+    """
+    raw = capture(chip, seconds)
+    mean = raw.mean(axis=0)
+    accel_bias = None
+    if gravity is not None:
+        accel_bias = mean[:3] - np.asarray(gravity, dtype=np.float64) * chip.GRAVITIY_MS2 / chip.get_accel_scale()
+
+    profile = make_profile(chip, accel_bias, None, mean[3:], hardware, 'still')
+    apply_profile(chip, profile, hardware, verify)
+    return profile
+
+def prompt_position(index, description):
+    input("Position %d of %d: turn the chip with its %s, hold it still and press enter" %
+          (index + 1, len(SIX_POSITIONS), description))
+
+def calibrate_six_position(chip, seconds = 2.0, wait = prompt_position, hardware = True, verify = False):
+    """Calibrates a chip held still in each of SIX_POSITIONS and applies the result.
+
+    wait -- called with the position index and description, returns once
+    the chip is in place
+    Fits the accelerometer bias and gain with fit_accel; the gyroscope
+    bias is the mean over every position.
+    Returns the CalibrationProfile.
+    """
+    means = np.empty((len(SIX_POSITIONS), 6))
+    for index, (gravity, description) in enumerate(SIX_POSITIONS):
+        wait(index, description)
+        means[index] = capture(chip, seconds).mean(axis=0)
+
+    accel_bias, accel_gain = fit_accel(means[:, :3], chip.GRAVITIY_MS2 / chip.get_accel_scale())
+    profile = make_profile(chip, accel_bias, accel_gain, means[:, 3:].mean(axis=0), hardware, 'six_position')
+    apply_profile(chip, profile, hardware, verify)
+    return profile
+
+class ProfileStore(object):
+    """Keeps calibration profiles as JSON files in a directory.
+
+    Each chip has one file, named from its WHO_AM_I value and chip id.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, who_am_i, chip_id):
+        return os.path.join(self.directory, "icm_%02x_chip%d.json" % (who_am_i, chip_id))
+
+    def save(self, profile):
+        """Writes a profile, replacing any earlier one for the same chip."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(profile.who_am_i, profile.chip_id)
+        # Write then rename so a crash never leaves half a profile
+        with open(path + '.tmp', 'w') as profile_file:
+            json.dump(profile.to_dict(), profile_file, indent=2)
+        os.replace(path + '.tmp', path)
+        return path
+
+    def load(self, who_am_i, chip_id):
+        """Returns the chip's CalibrationProfile, or None if there is none."""
+        try:
+            with open(self.path(who_am_i, chip_id)) as profile_file:
+                return CalibrationProfile.from_dict(json.load(profile_file))
+        except FileNotFoundError:
+            return None
+
+    def apply(self, chip, hardware = True, verify = False):
+        """Applies the stored profile for chip, see apply_profile.
+
+        Returns the profile, or None when the chip has none.
+        """
+        profile = self.load(chip.read_who_am_i(), chip.get_mpu_id())
+        if profile is not None:
+            apply_profile(chip, profile, hardware, verify)
+        return profile
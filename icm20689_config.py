@@ -0,0 +1,58 @@
+from icm20689_regs import *
+
+# Rate the sample rate divider counts down from, in Hz
+INTERNAL_SAMPLE_FREQUENCY = 1000
+
+def sample_rate_divider(sample_frequency):
+    """Returns the SMPLRT_DIV value giving the slowest rate at or above sample_frequency.
+
+    The rate is 1 kHz / (SMPLRT_DIV + 1), so 300 Hz gives 333 Hz; requests
+    outside 1000 / 256 Hz to 1 kHz get the nearest end of that range.
+    """
+    return min(max(int(INTERNAL_SAMPLE_FREQUENCY / sample_frequency) - 1, 0), 255)
+
+class ChipConfig(object):
+    """The configuration registers of a chip, as one value applied with Icm20689.apply_config.
+
+    sample_frequency -- in Hz; the chip runs at the slowest 1 kHz / n
+    at or above it, see sample_rate_divider.
+    accel_range, gyro_range -- AFS_SEL and FS_SEL members or their values.
+    dlpf -- DLPF_CFG, the gyro and temperature low pass filter setting.
+    fifo_enable -- the FIFO_EN bits; accel and gyro by default, which
+    makes the 12 byte frames the drivers decode.
+    int_pin_cfg, int_enable -- INT_PIN_CFG and INT_ENABLE.
+
+    Registers that are next to each other, such as SMPLRT_DIV through
+    ACCEL_CONFIG, are written in one burst.
+    """
+
+    def __init__(self, sample_frequency = 100, accel_range = AFS_SEL.FS_8G, gyro_range = FS_SEL.FS_DEG_2000, dlpf = 1,
+                 fifo_enable = FIFO_EN.ACCEL_FIFO_EN | FIFO_EN.XG_FIFO_EN | FIFO_EN.YG_FIFO_EN | FIFO_EN.ZG_FIFO_EN,
+                 int_pin_cfg = 0x00, int_enable = 0x00):
+        self.sample_frequency = sample_frequency
+        self.accel_range = AFS_SEL(accel_range)
+        self.gyro_range = FS_SEL(gyro_range)
+        self.dlpf = dlpf
+        self.fifo_enable = int(fifo_enable)
+        self.int_pin_cfg = int(int_pin_cfg)
+        self.int_enable = int(int_enable)
+
+    @property
+    def actual_sample_frequency(self):
+        """The rate the chip will run at, 1 kHz / (SMPLRT_DIV + 1)."""
+        return INTERNAL_SAMPLE_FREQUENCY / (sample_rate_divider(self.sample_frequency) + 1)
+
+    def registers(self):
+        """Returns the configuration as {ICM20689Regs: value}."""
+        return {
+            ICM20689Regs.SMPLRT_DIV: sample_rate_divider(self.sample_frequency),
+            ICM20689Regs.CONFIG: self.dlpf & 0x7,
+            ICM20689Regs.GYRO_CONFIG: self.gyro_range.value << 3,
+            ICM20689Regs.ACCEL_CONFIG: self.accel_range.value << 3,
+            ICM20689Regs.FIFO_EN: self.fifo_enable,
+            ICM20689Regs.INT_PIN_CFG: self.int_pin_cfg,
+            ICM20689Regs.INT_ENABLE: self.int_enable,
+        }
+
+    def __repr__(self):
+        return "ChipConfig(%s)" % ', '.join("%s=%r" % item for item in sorted(vars(self).items()))
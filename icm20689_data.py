@@ -0,0 +1,463 @@
+import math
+import struct
+from abc import ABC, abstractmethod
+import numpy as np
+
+__all__ = ['decode_fifo_bytes', 'scale_fifo_data', 'SENSOR_WORD', 'SENSOR_VECTOR', 'SENSOR_WORDS',
+           'ACCEL_UNITS', 'GYRO_UNITS', 'DEFAULT_UNITS', 'SI_UNITS', 'CALIBRATION', 'SampleScale', 'Icm20689Data', 'AccelerometerData', 'GyroData', 'MpuDataPoint', 'SampleBatch',
+           'count_samples', 'MpuDataPacket']
+
+def decode_fifo_bytes(raw_data):
+    """Reinterprets raw FIFO bytes as signed 16-bit sample frames.
+
+    raw_data -- the bytes read from FIFO_R_W, either a bytes-like object or a
+    list of byte values as returned by spidev.
+    Returns an (N, 6) big-endian int16 array holding one frame per row in the
+    FIFO order ax, ay, az, gx, gy, gz. A trailing partial frame is dropped.
+    """
+    if not isinstance(raw_data, (bytes, bytearray, memoryview)):
+        raw_data = bytes(raw_data)
+    frames = len(raw_data) // 12
+    return np.frombuffer(raw_data, dtype='>i2', count=frames * 6).reshape(frames, 6)
+
+def scale_fifo_data(raw_frames, accel_scale, gyro_scale):
+    """Converts raw (N, 6) FIFO frames to physical units.
+
+    accel_scale -- multiplier applied to the three accelerometer columns.
+    gyro_scale -- multiplier applied to the three gyroscope columns.
+    Returns an (N, 6) float64 array.
+    """
+    scale = np.array([accel_scale] * 3 + [gyro_scale] * 3)
+    return np.multiply(raw_frames, scale, dtype=np.float64)
+
+# Factors from m/s^2 and deg/s to each supported unit
+ACCEL_UNITS = {'m/s^2': 1.0, 'g': 1.0 / 9.80665}
+GYRO_UNITS = {'deg/s': 1.0, 'rad/s': math.pi / 180.0}
+
+# (accel unit, gyro unit) pairs: the drivers' default and SI
+DEFAULT_UNITS = ('m/s^2', 'deg/s')
+SI_UNITS = ('m/s^2', 'rad/s')
+
+# The scale and offset vectors of a calibrated SampleScale, as carried in
+# packet and recording blocks
+CALIBRATION = struct.Struct('!12d')
+
+class SampleScale(object):
+    """Converts raw sample counts to physical units with one multiply and add.
+
+    Holds a 6 element scale and offset vector, for the FIFO column order
+    ax, ay, az, gx, gy, gz, such that
+
+        value = raw * scale + offset
+
+    accel_scale, gyro_scale -- counts to m/s^2 and deg/s, as for SampleBatch
+    units -- the (accel unit, gyro unit) to convert to, from ACCEL_UNITS
+    and GYRO_UNITS
+    bias -- optional calibration offsets per column, in raw counts
+    gain -- optional calibration factors per column, applied after
+    removing the bias
+
+    A chip builds its scale when its ranges change, and consumers ask
+    for their units with with_units(), which caches the result.
+    """
+
+    # Scales rebuilt by from_vectors, so decoding a stream of blocks
+    # reuses one object per chip
+    _from_vectors = {}
+
+    def __init__(self, accel_scale, gyro_scale, units = DEFAULT_UNITS, bias = None, gain = None):
+        accel_unit, gyro_unit = units
+        if accel_unit not in ACCEL_UNITS:
+            raise ValueError("Unknown accelerometer unit %r" % (accel_unit,))
+        if gyro_unit not in GYRO_UNITS:
+            raise ValueError("Unknown gyroscope unit %r" % (gyro_unit,))
+        self.accel_scale = accel_scale
+        self.gyro_scale = gyro_scale
+        self.units = (accel_unit, gyro_unit)
+        self.bias = np.zeros(6) if bias is None else np.asarray(bias, dtype=np.float64).copy()
+        self.gain = np.ones(6) if gain is None else np.asarray(gain, dtype=np.float64).copy()
+
+        unit_scale = np.array([accel_scale * ACCEL_UNITS[accel_unit]] * 3 + [gyro_scale * GYRO_UNITS[gyro_unit]] * 3)
+        self.scale = unit_scale * self.gain
+        self.offset = -self.bias * self.scale
+        self.calibrated = bool(self.bias.any() or (self.gain != 1.0).any())
+        # The same vectors as floats, for converting single readings
+        self._scale_list = self.scale.tolist()
+        self._offset_list = self.offset.tolist()
+        self._by_units = {self.units: self}
+
+    def with_units(self, accel_unit = 'm/s^2', gyro_unit = 'deg/s'):
+        """Returns the same conversion, calibration included, into other units."""
+        units = (accel_unit, gyro_unit)
+        scale = self._by_units.get(units)
+        if scale is None:
+            scale = self._by_units[units] = SampleScale(self.accel_scale, self.gyro_scale, units, self.bias, self.gain)
+        return scale
+
+    @classmethod
+    def from_vectors(cls, accel_scale, gyro_scale, scale, offset):
+        """Rebuilds a conversion into the default units from its scale and offset vectors.
+
+        Used when decoding batches whose calibration travelled with them
+        through a packet, recording or shared ring.
+        """
+        key = (accel_scale, gyro_scale, tuple(scale), tuple(offset))
+        result = cls._from_vectors.get(key)
+        if result is None:
+            unit_scale = np.array([accel_scale] * 3 + [gyro_scale] * 3)
+            scale = np.asarray(scale, dtype=np.float64)
+            if len(cls._from_vectors) >= 256:
+                cls._from_vectors.clear()
+            result = cls._from_vectors[key] = cls(accel_scale, gyro_scale, DEFAULT_UNITS,
+                                                  -np.asarray(offset, dtype=np.float64) / scale, scale / unit_scale)
+        return result
+
+    def pack_vectors(self):
+        """Returns the scale and offset vectors of the default units as a CALIBRATION record."""
+        scale = self.with_units(*DEFAULT_UNITS)
+        return CALIBRATION.pack(*scale._scale_list, *scale._offset_list)
+
+    def with_calibration(self, bias = None, gain = None):
+        """Returns the conversion with other calibration offsets and factors."""
+        return SampleScale(self.accel_scale, self.gyro_scale, self.units, bias, gain)
+
+    def apply(self, raw_frames, out = None):
+        """Converts (N, 6) raw frames; returns an (N, 6) float64 array."""
+        out = np.multiply(raw_frames, self.scale, out=out, dtype=np.float64)
+        if self.calibrated:
+            out += self.offset
+        return out
+
+    def convert(self, values, first = 0):
+        """Converts a few raw readings given as numbers, starting at column first.
+
+        Returns a list of floats; used for the register snapshot paths,
+        where a NumPy call would cost more than the arithmetic.
+        """
+        return [value * scale + offset
+                for value, scale, offset in zip(values, self._scale_list[first:], self._offset_list[first:])]
+
+# Big-endian signed register words: one value, one x/y/z vector, and the
+# accel, temp and gyro block starting at ACCEL_XOUT_H
+SENSOR_WORD = struct.Struct('>h')
+SENSOR_VECTOR = struct.Struct('>3h')
+SENSOR_WORDS = struct.Struct('>7h')
+
+class Icm20689Data(ABC):
+
+    __slots__ = ()
+
+    def __init__(self):
+        pass
+
+    @abstractmethod
+    def serialize(self):
+        pass
+
+class AccelerometerData(Icm20689Data):
+
+    __slots__ = ('x_val', 'y_val', 'z_val')
+
+    def __init__(self, x_val, y_val, z_val):
+        self.x_val = x_val
+        self.y_val = y_val
+        self.z_val = z_val
+
+    def serialize(self):
+        return struct.pack('!ddd', self.x_val, self.y_val, self.z_val)
+
+    def __repr__(self):
+        return "%lf %lf %lf" % (self.x_val, self.y_val, self.z_val)
+
+class GyroData(Icm20689Data):
+
+    __slots__ = ('x_val', 'y_val', 'z_val')
+
+    def __init__(self, x_val, y_val, z_val):
+        self.x_val = x_val
+        self.y_val = y_val
+        self.z_val = z_val
+
+    def serialize(self):
+        return struct.pack('!ddd', self.x_val, self.y_val, self.z_val)
+
+    def __repr__(self):
+        return "%lf %lf %lf" % (self.x_val, self.y_val, self.z_val)
+
+class MpuDataPoint(Icm20689Data):
+
+    __slots__ = ('_mpu_id', '_gyro_data', '_accel_data')
+
+    def __init__(self, mpu_id, accel_data, gyro_data):
+        self._mpu_id = mpu_id
+        self._gyro_data = gyro_data
+        self._accel_data = accel_data
+
+    def serialize(self):
+        serialized_data = bytearray()
+        serialized_data += struct.pack('!i', self._mpu_id) + self._accel_data.serialize() + self._gyro_data.serialize()
+        return serialized_data
+
+    def __repr__(self):
+        return "id: %d\nGyro: %s\nAccell: %s\n\n" %(self._mpu_id, str(self._gyro_data), str(self._accel_data))
+
+class SampleBatch(Icm20689Data):
+    """A run of consecutive FIFO samples from one chip, stored column-wise.
+
+    The samples are kept as the raw (N, 6) int16 frames read from the FIFO
+    together with the scale factors that turn them into m/s^2 and deg/s, so
+    a whole FIFO drain is a single object instead of one MpuDataPoint per
+    sample. Slicing returns a new batch that shares the same buffer.
+
+    scale -- optional SampleScale of the chip, carrying its calibration.
+    Packets, recordings and rings carry a calibrated scale along with the
+    frames, so the batches they return convert the same way.
+    """
+
+    __slots__ = ('chip_id', 'timestamp', 'sample_period', 'raw', 'accel_scale', 'gyro_scale', 'scale')
+
+    # Layout of one sample in the legacy MpuDataPoint wire format
+    POINT_DTYPE = np.dtype([('id', '>i4'), ('accel', '>f8', (3,)), ('gyro', '>f8', (3,))])
+
+    def __init__(self, chip_id, timestamp, sample_period, raw, accel_scale, gyro_scale, scale = None):
+        self.chip_id = chip_id
+        self.timestamp = timestamp
+        self.sample_period = sample_period
+        self.raw = raw
+        self.accel_scale = accel_scale
+        self.gyro_scale = gyro_scale
+        self.scale = scale
+
+    @classmethod
+    def concatenate(cls, batches):
+        """Joins consecutive batches from the same chip into one batch.
+
+        The result takes its timestamp and sample period from the first batch.
+        Raises ValueError when the batches come from different chips or were
+        recorded with different range settings.
+        """
+        first = batches[0]
+        for batch in batches[1:]:
+            if batch.chip_id != first.chip_id:
+                raise ValueError("Cannot concatenate batches from chips %d and %d" % (first.chip_id, batch.chip_id))
+            if batch.accel_scale != first.accel_scale or batch.gyro_scale != first.gyro_scale:
+                raise ValueError("Cannot concatenate batches with different scale factors")
+
+        raw = np.concatenate([batch.raw for batch in batches])
+        return cls(first.chip_id, first.timestamp, first.sample_period, raw, first.accel_scale, first.gyro_scale,
+                   first.scale)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, _, step = index.indices(len(self.raw))
+            return SampleBatch(self.chip_id, self.timestamp + start * self.sample_period, self.sample_period * step,
+                               self.raw[index], self.accel_scale, self.gyro_scale, self.scale)
+
+        row = self.get_scale().convert(self.raw[index].tolist())
+        return MpuDataPoint(self.chip_id, AccelerometerData(*row[:3]), GyroData(*row[3:]))
+
+    @property
+    def accel(self):
+        """The accelerometer columns as an (N, 3) float array in m/s^2."""
+        if self.scale is None or not self.scale.calibrated:
+            return self.raw[:, :3] * self.accel_scale
+        return self.to_array()[:, :3]
+
+    @property
+    def gyro(self):
+        """The gyroscope columns as an (N, 3) float array in deg/s."""
+        if self.scale is None or not self.scale.calibrated:
+            return self.raw[:, 3:] * self.gyro_scale
+        return self.to_array()[:, 3:]
+
+    @property
+    def calibrated(self):
+        """True when the conversion includes a calibration correction."""
+        return self.scale is not None and self.scale.calibrated
+
+    def get_scale(self, units = DEFAULT_UNITS):
+        """Returns the SampleScale converting this batch into units."""
+        scale = self.scale if self.scale is not None else SampleScale(self.accel_scale, self.gyro_scale)
+        return scale.with_units(*units)
+
+    def timestamps(self):
+        """Returns the estimated sample times as an (N,) float array."""
+        return self.timestamp + np.arange(len(self.raw)) * self.sample_period
+
+    def to_array(self, units = DEFAULT_UNITS):
+        """Returns the scaled samples as an (N, 6) float array.
+
+        units -- (accel unit, gyro unit), m/s^2 and deg/s by default.
+        """
+        if self.scale is None and units == DEFAULT_UNITS:
+            return scale_fifo_data(self.raw, self.accel_scale, self.gyro_scale)
+        return self.get_scale(units).apply(self.raw)
+
+    def to_points(self):
+        """Expands the batch into the legacy list of MpuDataPoint objects."""
+        return [self[i] for i in range(len(self.raw))]
+
+    def serialize(self):
+        points = np.empty(len(self.raw), dtype=self.POINT_DTYPE)
+        points['id'] = self.chip_id
+        points['accel'] = self.accel
+        points['gyro'] = self.gyro
+        return points.tobytes()
+
+    def __repr__(self):
+        return "SampleBatch(id: %d, %d samples from %0.4f)" % (self.chip_id, len(self.raw), self.timestamp)
+
+def count_samples(data):
+    """Returns the number of samples held by a list of points and batches."""
+    return sum(len(item) if isinstance(item, SampleBatch) else 1 for item in data)
+
+class MpuDataPacket(Icm20689Data):
+    """A group of samples sent to the PC as one message.
+
+    Packets made of SampleBatch objects use the versioned binary format:
+
+        header  -- magic, version, flags, block count, sequence number
+        block   -- chip id, block flags, sample count, base timestamp,
+                   sample period, accel scale, gyro scale, then with
+                   BLOCK_CALIBRATED the CALIBRATION vectors, then the raw
+                   big-endian int16 FIFO frames (12 bytes per sample)
+
+    all in network byte order. Version 1 blocks have no flags and no
+    calibration, and are still decoded. Packets holding MpuDataPoint
+    objects fall back to the legacy format of a sample count followed by
+    52 bytes of doubles per sample.
+    """
+
+    __slots__ = ('_data', 'sequence')
+
+    MAGIC = b'ICMP'
+    VERSION = 2
+    HEADER = struct.Struct('!4sBBHI')
+    BLOCK_HEADER = struct.Struct('!HHIdddd')
+    BLOCK_HEADER_V1 = struct.Struct('!HIdddd')
+    FRAME_BYTES = 12
+    # Block flags
+    BLOCK_CALIBRATED = 0x1
+
+    def __init__(self, data, sequence = 0):
+        """data -- a list of SampleBatch and/or MpuDataPoint objects.
+
+        sequence -- the packet sequence number, wrapped to 32 bits.
+        """
+        self._data = data
+        self.sequence = sequence & 0xFFFFFFFF
+
+    @property
+    def data(self):
+        return self._data
+
+    def is_legacy(self):
+        """Returns True when the packet has to use the legacy format."""
+        return not all(isinstance(item, SampleBatch) for item in self._data)
+
+    def packed_size(self):
+        """Returns the number of bytes serialize() will produce."""
+        if self.is_legacy():
+            return 4 + count_samples(self._data) * SampleBatch.POINT_DTYPE.itemsize
+
+        return self.HEADER.size + sum(self.block_header_size(batch) + len(batch) * self.FRAME_BYTES for batch in self._data)
+
+    @classmethod
+    def block_header_size(cls, batch):
+        """Returns the bytes of a batch's block before its frames."""
+        return cls.BLOCK_HEADER.size + CALIBRATION.size if batch.calibrated else cls.BLOCK_HEADER.size
+
+    def serialize_into(self, buffer, offset = 0):
+        """Packs the packet into a preallocated writable buffer.
+
+        buffer -- a bytearray (or other writable buffer) with at least
+        packed_size() bytes free after offset.
+        Returns the number of bytes written.
+        """
+        if self.is_legacy():
+            serialized_data = self.serialize_legacy()
+            buffer[offset:offset + len(serialized_data)] = serialized_data
+            return len(serialized_data)
+
+        start = offset
+        self.HEADER.pack_into(buffer, offset, self.MAGIC, self.VERSION, 0, len(self._data), self.sequence)
+        offset += self.HEADER.size
+
+        for batch in self._data:
+            count = len(batch)
+            calibrated = batch.calibrated
+            self.BLOCK_HEADER.pack_into(buffer, offset, batch.chip_id, self.BLOCK_CALIBRATED if calibrated else 0, count,
+                                        batch.timestamp, batch.sample_period, batch.accel_scale, batch.gyro_scale)
+            offset += self.BLOCK_HEADER.size
+            if calibrated:
+                buffer[offset:offset + CALIBRATION.size] = batch.scale.pack_vectors()
+                offset += CALIBRATION.size
+
+            if count:
+                payload = np.frombuffer(buffer, dtype='>i2', count=count * 6, offset=offset)
+                payload.reshape(count, 6)[...] = batch.raw
+            offset += count * self.FRAME_BYTES
+
+        return offset - start
+
+    def serialize(self):
+        buffer = bytearray(self.packed_size())
+        self.serialize_into(buffer)
+        return buffer
+
+    def serialize_legacy(self):
+        serialized_data = b''.join([item.serialize() for item in self._data])
+
+        return struct.pack('!i', count_samples(self._data)) + serialized_data
+
+    @classmethod
+    def deserialize(cls, buffer):
+        """Decodes a packet in the versioned format.
+
+        buffer -- a bytes-like object holding exactly one packet. The raw
+        frames of the returned batches are read-only views into it, so it
+        must not be reused while they are alive.
+        Returns an MpuDataPacket whose data is a list of SampleBatch.
+        Raises ValueError if the buffer is not a valid packet.
+        """
+        if len(buffer) < cls.HEADER.size:
+            raise ValueError("Packet too short: %d bytes" % len(buffer))
+
+        magic, version, _, block_count, sequence = cls.HEADER.unpack_from(buffer, 0)
+        if magic != cls.MAGIC:
+            raise ValueError("Bad packet magic %r" % (magic,))
+        if version not in (1, cls.VERSION):
+            raise ValueError("Unsupported packet version %d" % version)
+        block_header = cls.BLOCK_HEADER if version == cls.VERSION else cls.BLOCK_HEADER_V1
+
+        offset = cls.HEADER.size
+        batches = []
+        for i in range(0, block_count):
+            if offset + block_header.size > len(buffer):
+                raise ValueError("Packet truncated in block %d header" % i)
+            if version == cls.VERSION:
+                chip_id, flags, count, timestamp, sample_period, accel_scale, gyro_scale = block_header.unpack_from(buffer, offset)
+            else:
+                flags = 0
+                chip_id, count, timestamp, sample_period, accel_scale, gyro_scale = block_header.unpack_from(buffer, offset)
+            offset += block_header.size
+
+            scale = None
+            if flags & cls.BLOCK_CALIBRATED:
+                if offset + CALIBRATION.size > len(buffer):
+                    raise ValueError("Packet truncated in block %d calibration" % i)
+                vectors = CALIBRATION.unpack_from(buffer, offset)
+                scale = SampleScale.from_vectors(accel_scale, gyro_scale, vectors[:6], vectors[6:])
+                offset += CALIBRATION.size
+
+            if offset + count * cls.FRAME_BYTES > len(buffer):
+                raise ValueError("Packet truncated in block %d payload" % i)
+            raw = np.frombuffer(buffer, dtype='>i2', count=count * 6, offset=offset).reshape(count, 6)
+            offset += count * cls.FRAME_BYTES
+
+            batches.append(SampleBatch(chip_id, timestamp, sample_period, raw, accel_scale, gyro_scale, scale))
+
+        return cls(batches, sequence)
@@ -0,0 +1,467 @@
+from abc import ABC, abstractmethod
+import numpy as np
+
+def solve_recurrence(a, b, y0, max_decay = 20.0):
+    """Solves y[k] = a[k] * y[k-1] + b[k] for every k, with y[-1] = y0.
+
+    a -- (N,) factors in (0, 1]
+    b -- (N, M) inputs
+    y0 -- (M,) initial state
+    Returns y as an (N, M) array.
+
+    Written out, y[k] = P[k] * (y0 + sum(b[j] / P[j] for j <= k)) where
+    P[k] is the product of a[0..k], which turns the loop into a cumulative
+    product and a cumulative sum. The products shrink geometrically, so the
+    samples are taken in runs over which P falls by at most exp(-max_decay)
+    to keep 1 / P well inside the float range; each run costs a handful of
+    array operations.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    y = np.empty_like(b)
+    previous = np.array(y0, dtype=np.float64)
+
+    log_a = np.log(a)
+    decay = -np.cumsum(log_a)
+    start = 0
+    while start < len(a):
+        base = decay[start - 1] if start else 0.0
+        end = max(int(np.searchsorted(decay, base + max_decay, 'right')), start + 1)
+
+        run = decay[start:end] - base
+        weights = np.exp(run)[:, np.newaxis]
+        y[start:end] = (previous + np.cumsum(b[start:end] * weights, axis=0)) / weights
+        previous = y[end - 1]
+        start = end
+    return y
+
+def accel_tilt(accel):
+    """Returns (N, 2) roll and pitch in degrees from (N, 3) accelerometer samples.
+
+    Roll is the rotation about X and pitch about Y, taking Z as up when the
+    chip lies flat. Both are only meaningful while the chip is not
+    accelerating, and roll becomes undefined near +-90 degrees of pitch.
+    """
+    ax = accel[:, 0]
+    ay = accel[:, 1]
+    az = accel[:, 2]
+    tilt = np.empty((len(accel), 2))
+    tilt[:, 0] = np.arctan2(ay, az)
+    tilt[:, 1] = np.arctan2(-ax, np.sqrt(ay * ay + az * az))
+    return np.degrees(tilt, out=tilt)
+
+class ComplementaryFilter(object):
+    """Fuses gyroscope and accelerometer samples into roll, pitch and yaw.
+
+    Each step integrates the gyroscope rate over the real time since the
+    previous sample and blends the result with the accelerometer tilt:
+
+        angle = alpha * (angle + rate * dt) + (1 - alpha) * accel_angle
+        alpha = time_constant / (time_constant + dt)
+
+    so the gyroscope dominates over periods shorter than time_constant
+    seconds and the accelerometer corrects drift over longer ones. Yaw has
+    no accelerometer reference and is the integrated Z rate, which drifts.
+    Body rates are used as Euler angle rates, which holds for moderate
+    tilt; use the quaternion filters for large angles.
+
+    The state is the last angles and sample time, so a filter can run over
+    a recording or a live stream indefinitely. filter() and update() take
+    whole arrays of samples and are vectorized throughout.
+    """
+
+    def __init__(self, time_constant = 0.5):
+        self._time_constant = time_constant
+        self._angles = None
+        self._last_time = None
+
+    @property
+    def time_constant(self):
+        return self._time_constant
+
+    @property
+    def angles(self):
+        """The latest roll, pitch and yaw in degrees, or None before any sample."""
+        return None if self._angles is None else self._angles.copy()
+
+    def reset(self):
+        self._angles = None
+        self._last_time = None
+
+    def filter(self, timestamps, samples):
+        """Filters (N,) sample times and (N, 6) samples in m/s^2 and deg/s.
+
+        Returns (N, 3) roll, pitch and yaw in degrees. The first sample the
+        filter sees sets its roll and pitch from the accelerometer.
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        samples = np.asarray(samples, dtype=np.float64)
+        if len(timestamps) == 0:
+            return np.empty((0, 3))
+
+        tilt = accel_tilt(samples[:, :3])
+        if self._angles is None:
+            self._angles = np.array([tilt[0, 0], tilt[0, 1], 0.0])
+            self._last_time = timestamps[0]
+
+        dt = np.diff(timestamps, prepend=self._last_time)
+        # Batches are stamped when read, so their edges may overlap slightly
+        np.maximum(dt, 0.0, out=dt)
+        alpha = self._time_constant / (self._time_constant + dt)
+
+        rates = samples[:, 3:] * dt[:, np.newaxis]
+        angles = np.empty((len(timestamps), 3))
+        inputs = alpha[:, np.newaxis] * rates[:, :2] + (1.0 - alpha)[:, np.newaxis] * tilt
+        angles[:, :2] = solve_recurrence(alpha, inputs, self._angles[:2])
+        angles[:, 2] = self._angles[2] + np.cumsum(rates[:, 2])
+
+        self._angles = angles[-1].copy()
+        self._last_time = timestamps[-1]
+        return angles
+
+    def update(self, batch):
+        """Filters a SampleBatch; returns (N, 3) roll, pitch and yaw in degrees."""
+        return self.filter(batch.timestamps(), batch.to_array())
+
+def quaternion_to_euler(q):
+    """Converts (N, 4) w, x, y, z quaternions to (N, 3) roll, pitch, yaw in degrees.
+
+    The angles are the Z-Y-X (yaw, then pitch, then roll) rotation from
+    the chip frame to the reference frame.
+    """
+    q = np.asarray(q, dtype=np.float64)
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    euler = np.empty((len(q), 3))
+    euler[:, 0] = np.arctan2(2.0 * (w * x + y * z), 1.0 - 2.0 * (x * x + y * y))
+    euler[:, 1] = np.arcsin(np.clip(2.0 * (w * y - z * x), -1.0, 1.0))
+    euler[:, 2] = np.arctan2(2.0 * (w * z + x * y), 1.0 - 2.0 * (y * y + z * z))
+    return np.degrees(euler, out=euler)
+
+def quaternion_to_matrix(q):
+    """Converts (N, 4) w, x, y, z quaternions to (N, 3, 3) rotation matrices.
+
+    Each matrix rotates vectors from the chip frame to the reference frame.
+    """
+    q = np.asarray(q, dtype=np.float64)
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    m = np.empty((len(q), 3, 3))
+    m[:, 0, 0] = 1.0 - 2.0 * (y * y + z * z)
+    m[:, 0, 1] = 2.0 * (x * y - w * z)
+    m[:, 0, 2] = 2.0 * (x * z + w * y)
+    m[:, 1, 0] = 2.0 * (x * y + w * z)
+    m[:, 1, 1] = 1.0 - 2.0 * (x * x + z * z)
+    m[:, 1, 2] = 2.0 * (y * z - w * x)
+    m[:, 2, 0] = 2.0 * (x * z - w * y)
+    m[:, 2, 1] = 2.0 * (y * z + w * x)
+    m[:, 2, 2] = 1.0 - 2.0 * (x * x + y * y)
+    return m
+
+def euler_to_quaternion(euler):
+    """Converts (N, 3) roll, pitch, yaw in degrees to (N, 4) w, x, y, z quaternions."""
+    half = np.radians(np.asarray(euler, dtype=np.float64)) / 2.0
+    cr, cp, cy = np.cos(half[:, 0]), np.cos(half[:, 1]), np.cos(half[:, 2])
+    sr, sp, sy = np.sin(half[:, 0]), np.sin(half[:, 1]), np.sin(half[:, 2])
+    q = np.empty((len(half), 4))
+    q[:, 0] = cr * cp * cy + sr * sp * sy
+    q[:, 1] = sr * cp * cy - cr * sp * sy
+    q[:, 2] = cr * sp * cy + sr * cp * sy
+    q[:, 3] = cr * cp * sy - sr * sp * cy
+    return q
+
+def _rotation_matrices(gyro, dt):
+    """Returns the matrices that advance quaternions by gyroscope rates.
+
+    gyro -- (..., 3) rates in rad/s
+    dt -- (...) time steps in seconds
+    Returns (..., 4, 4) matrices M such that M @ q is q rotated by the
+    rate over the step, q x exp(gyro * dt / 2). The rotation is exact for
+    a rate that is constant over the step.
+    """
+    angle = np.sqrt(np.einsum('...i,...i->...', gyro, gyro)) * dt
+    half = angle / 2.0
+    # sin(angle / 2) / |gyro|, written to stay finite as the rate goes to zero
+    scale = np.where(angle > 1e-12, np.sin(half) / np.where(angle > 1e-12, angle, 1.0) * dt, dt / 2.0)
+    c = np.cos(half)
+    x = gyro[..., 0] * scale
+    y = gyro[..., 1] * scale
+    z = gyro[..., 2] * scale
+
+    # Right multiplication by the quaternion (c, x, y, z)
+    m = np.empty(gyro.shape[:-1] + (4, 4))
+    m[..., 0, 0] = c
+    m[..., 0, 1] = -x
+    m[..., 0, 2] = -y
+    m[..., 0, 3] = -z
+    m[..., 1, 0] = x
+    m[..., 1, 1] = c
+    m[..., 1, 2] = z
+    m[..., 1, 3] = -y
+    m[..., 2, 0] = y
+    m[..., 2, 1] = -z
+    m[..., 2, 2] = c
+    m[..., 2, 3] = x
+    m[..., 3, 0] = z
+    m[..., 3, 1] = y
+    m[..., 3, 2] = -x
+    m[..., 3, 3] = c
+    return m
+
+def _unit_rows(v):
+    """Returns v with its last axis scaled to unit length; zero vectors stay zero."""
+    norm = np.sqrt(np.einsum('...i,...i->...', v, v))
+    return v / np.where(norm == 0.0, 1.0, norm)[..., np.newaxis]
+
+class QuaternionFilter(ABC):
+    """Base class of the quaternion orientation filters.
+
+    A filter keeps a separate state per chip id: the orientation
+    quaternion (w, x, y, z), the time of the last sample and whatever else
+    the algorithm needs. A chip's first sample sets its roll and pitch
+    from the accelerometer, with yaw 0.
+
+    The update is a nonlinear recurrence, so samples are stepped through
+    one at a time. Everything that does not depend on the state, such as
+    the gyroscope rotation of each step and the normalized accelerometer
+    readings, is computed for the whole batch beforehand, leaving a few
+    array operations per step. Each step covers all the chips being
+    updated together: update_batches() filters one drain of every chip in
+    a single pass, so adding chips costs little. Batches of different
+    lengths are padded with zero time steps, which leave the state
+    unchanged.
+
+    Subclasses set STATE_SIZE and implement _step().
+    """
+
+    # Values kept per chip; the first four are the quaternion
+    STATE_SIZE = 4
+
+    def __init__(self):
+        self._states = {}
+        self._last_times = {}
+
+    def quaternion(self, chip_id):
+        """The chip's latest orientation as (w, x, y, z), or None."""
+        state = self._states.get(chip_id)
+        return None if state is None else state[:4].copy()
+
+    def reset(self, chip_id = None):
+        if chip_id is None:
+            self._states = {}
+            self._last_times = {}
+        else:
+            self._states.pop(chip_id, None)
+            self._last_times.pop(chip_id, None)
+
+    def _initial_state(self, samples):
+        tilt = accel_tilt(samples[:1, :3])
+        state = np.zeros(self.STATE_SIZE)
+        state[:4] = euler_to_quaternion([[tilt[0, 0], tilt[0, 1], 0.0]])[0]
+        return state
+
+    def _measurements(self, gravity):
+        """Precomputes what _step() needs from (..., 3) unit accelerometer readings."""
+        return gravity
+
+    @abstractmethod
+    def _step(self, state, rotation, measurement, dt):
+        """Advances (C, STATE_SIZE) states by one sample each, in place.
+
+        rotation -- (C, 4, 4) gyroscope rotation of the step, see
+        _rotation_matrices
+        measurement -- the step's part of what _measurements() returned
+        dt -- (C,) time step for the accelerometer correction in seconds,
+        zero where there is no accelerometer reading
+        """
+        pass
+
+    def filter_many(self, chip_ids, timestamps, samples):
+        """Filters several chips' samples together.
+
+        chip_ids -- one id per chip
+        timestamps, samples -- one (N,) and (N, 6) array per chip, samples
+        in m/s^2 and deg/s
+        Returns one (N, 4) quaternion array per chip.
+        """
+        lengths = [len(t) for t in timestamps]
+        steps = max(lengths) if lengths else 0
+        if steps == 0:
+            return [np.empty((0, 4)) for length in lengths]
+
+        chips = len(chip_ids)
+        state = np.zeros((chips, self.STATE_SIZE))
+        state[:, 0] = 1.0
+        gyro = np.zeros((steps, chips, 3))
+        accel = np.zeros((steps, chips, 3))
+        dt = np.zeros((steps, chips))
+        for i, chip_id in enumerate(chip_ids):
+            n = lengths[i]
+            if n == 0:
+                continue
+            chip_samples = np.asarray(samples[i], dtype=np.float64)
+            chip_times = np.asarray(timestamps[i], dtype=np.float64)
+            if chip_id not in self._states:
+                self._states[chip_id] = self._initial_state(chip_samples)
+                self._last_times[chip_id] = chip_times[0]
+            state[i] = self._states[chip_id]
+            accel[:n, i] = chip_samples[:, :3]
+            gyro[:n, i] = np.radians(chip_samples[:, 3:])
+            dt[:n, i] = np.diff(chip_times, prepend=self._last_times[chip_id])
+            self._last_times[chip_id] = chip_times[-1]
+        # Batches are stamped when read, so their edges may overlap slightly
+        np.maximum(dt, 0.0, out=dt)
+
+        rotation = _rotation_matrices(gyro, dt)
+        measurements = self._measurements(_unit_rows(accel))
+        correction_dt = dt * accel.any(axis=-1)
+        quaternions = np.empty((steps, chips, 4))
+        for k in range(0, steps):
+            self._step(state, rotation[k], measurements[k], correction_dt[k])
+            quaternions[k] = state[:, :4]
+
+        for i, chip_id in enumerate(chip_ids):
+            if lengths[i]:
+                self._states[chip_id] = state[i].copy()
+        return [quaternions[:lengths[i], i] for i in range(0, chips)]
+
+    def filter(self, timestamps, samples, chip_id = 0):
+        """Filters (N,) times and (N, 6) samples of one chip; returns (N, 4) quaternions."""
+        return self.filter_many([chip_id], [timestamps], [samples])[0]
+
+    def update(self, batch):
+        """Filters a SampleBatch; returns (N, 4) quaternions."""
+        return self.filter(batch.timestamps(), batch.to_array(), batch.chip_id)
+
+    def update_batches(self, batches):
+        """Filters one SampleBatch per chip together; returns their quaternions.
+
+        Several batches of the same chip are filtered in order.
+        """
+        results = [None] * len(batches)
+        pending = list(range(0, len(batches)))
+        while pending:
+            # One batch per chip per pass keeps each chip's samples in order
+            seen = set()
+            group = []
+            for i in pending:
+                if batches[i].chip_id not in seen:
+                    seen.add(batches[i].chip_id)
+                    group.append(i)
+            pending = [i for i in pending if i not in group]
+
+            quaternions = self.filter_many([batches[i].chip_id for i in group],
+                                           [batches[i].timestamps() for i in group],
+                                           [batches[i].to_array() for i in group])
+            for i, q in zip(group, quaternions):
+                results[i] = q
+        return results
+
+def _quadratic_forms(*forms):
+    """Stacks (4, 4) matrices A_k into P such that (q @ P)[:, 4k:4k+4] = A_k q."""
+    return np.concatenate([np.asarray(form, dtype=np.float64).T for form in forms], axis=1)
+
+# Gravity in the chip frame predicted by a unit quaternion, v_k = q^T A_k q
+_GRAVITY_FORMS = (
+    [[0, 0, -1, 0], [0, 0, 0, 1], [-1, 0, 0, 0], [0, 1, 0, 0]],
+    [[0, 1, 0, 0], [1, 0, 0, 0], [0, 0, 0, 1], [0, 0, 1, 0]],
+    [[1, 0, 0, 0], [0, -1, 0, 0], [0, 0, -1, 0], [0, 0, 0, 1]],
+)
+
+def _advance(q, rotation, correction):
+    """q = rotation @ q - correction, renormalized, in place."""
+    q[:] = np.matmul(rotation, q[:, :, np.newaxis])[:, :, 0] - correction
+    q /= np.sqrt(np.einsum('ij,ij->i', q, q))[:, np.newaxis]
+
+class MadgwickFilter(QuaternionFilter):
+    """Madgwick's gradient descent orientation filter, IMU (no magnetometer) form.
+
+    beta -- gain of the accelerometer correction in rad/s; larger values
+    correct gyroscope drift faster but let linear acceleration disturb
+    the estimate more.
+
+    See S. Madgwick, "An efficient orientation filter for inertial and
+    inertial/magnetic sensor arrays", 2010.
+    """
+
+    def __init__(self, beta = 0.1):
+        super(MadgwickFilter, self).__init__()
+        self.beta = beta
+
+    # Predicted gravity, then the rows of Madgwick's Jacobian halved: the
+    # first two are the gradients of the gravity forms, the last that of
+    # 1 - 2 (x^2 + y^2), the form the paper uses for the z component
+    _FORMS = _quadratic_forms(*(_GRAVITY_FORMS + _GRAVITY_FORMS[:2] + (np.diag([0, -2, -2, 0]),)))
+
+    def _step(self, state, rotation, measurement, dt):
+        q = state[:, :4]
+        forms = np.matmul(q, self._FORMS).reshape(-1, 6, 4)
+
+        # Objective: gravity predicted by q minus the measured direction,
+        # and its gradient, the Jacobian transposed times the objective
+        f = np.matmul(forms[:, :3], q[:, :, np.newaxis])[:, :, 0] - measurement
+        step = np.matmul(f[:, np.newaxis, :], forms[:, 3:])[:, 0, :]
+        norm = np.sqrt(np.einsum('ij,ij->i', step, step))
+        step *= (self.beta * dt / np.maximum(norm, 1e-300))[:, np.newaxis]
+
+        _advance(q, rotation, step)
+
+class MahonyFilter(QuaternionFilter):
+    """Mahony's nonlinear complementary filter on SO(3), IMU form.
+
+    The error between the measured and the predicted gravity direction
+    feeds back into the gyroscope rates through a proportional gain kp
+    and an integral gain ki, the integral estimating the gyroscope bias.
+
+    See R. Mahony, T. Hamel and J.-M. Pflimlin, "Nonlinear complementary
+    filters on the special orthogonal group", 2008.
+    """
+
+    # The quaternion and the integral of the error
+    STATE_SIZE = 7
+
+    def __init__(self, kp = 1.0, ki = 0.0):
+        super(MahonyFilter, self).__init__()
+        self.kp = kp
+        self.ki = ki
+
+    def bias(self, chip_id):
+        """The integral feedback, an estimate of minus the gyro bias in rad/s."""
+        state = self._states.get(chip_id)
+        return None if state is None else state[4:].copy()
+
+    _FORMS = _quadratic_forms(*_GRAVITY_FORMS)
+
+    # q x (0, v) as (q @ _PRODUCT).reshape(4, 3) @ v
+    _PRODUCT = np.array([
+        [[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]],
+        [[-1, 0, 0], [0, 0, 0], [0, 0, -1], [0, 1, 0]],
+        [[0, -1, 0], [0, 0, 1], [0, 0, 0], [-1, 0, 0]],
+        [[0, 0, -1], [0, -1, 0], [1, 0, 0], [0, 0, 0]],
+    ], dtype=np.float64).reshape(4, 12)
+
+    def _measurements(self, gravity):
+        # Cross product matrices, so that the error is one matrix product
+        skew = np.zeros(gravity.shape + (3,))
+        skew[..., 0, 1] = -gravity[..., 2]
+        skew[..., 0, 2] = gravity[..., 1]
+        skew[..., 1, 0] = gravity[..., 2]
+        skew[..., 1, 2] = -gravity[..., 0]
+        skew[..., 2, 0] = -gravity[..., 1]
+        skew[..., 2, 1] = gravity[..., 0]
+        return skew
+
+    def _step(self, state, rotation, measurement, dt):
+        q = state[:, :4]
+
+        # Error between the measured and the predicted gravity direction
+        v = np.matmul(np.matmul(q, self._FORMS).reshape(-1, 3, 4), q[:, :, np.newaxis])
+        error = np.matmul(measurement, v)[:, :, 0]
+        feedback = self.kp * error
+        if self.ki > 0:
+            integral = state[:, 4:]
+            integral += self.ki * dt[:, np.newaxis] * error
+            feedback += integral
+
+        # The feedback rate as a first order correction, -(q x (0, feedback)) * dt / 2
+        feedback *= (-0.5 * dt)[:, np.newaxis]
+        correction = np.matmul(np.matmul(q, self._PRODUCT).reshape(-1, 4, 3), feedback[:, :, np.newaxis])[:, :, 0]
+        _advance(q, rotation, correction)
@@ -0,0 +1,298 @@
+import json
+import sys
+import threading
+import time
+
+class Counter(object):
+    """A value that only goes up, such as packets sent or samples dropped."""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount = 1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+class Gauge(object):
+    """A value that is set to the latest reading, keeping the largest seen."""
+
+    __slots__ = ('value', 'max')
+
+    def __init__(self):
+        self.value = 0
+        self.max = 0
+
+    def set(self, value):
+        self.value = value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return {'value': self.value, 'max': self.max}
+
+class Histogram(object):
+    """Log-linear histogram of non-negative integers, in the style of HdrHistogram.
+
+    Values below 2 * SUB_BUCKETS are counted exactly. Above that every
+    power of two is split into SUB_BUCKETS linear buckets, so a recorded
+    value is known to within 1/SUB_BUCKETS (about 6 %) over the whole
+    64 bit range while record() stays a couple of integer operations and
+    the memory a fixed list of about a thousand counts.
+    """
+
+    SUB_BUCKET_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * ((64 - self.SUB_BUCKET_BITS) * self.SUB_BUCKETS + 2 * self.SUB_BUCKETS)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    @classmethod
+    def bucket_index(cls, value):
+        shift = max(value.bit_length() - cls.SUB_BUCKET_BITS - 1, 0)
+        return shift * cls.SUB_BUCKETS + (value >> shift)
+
+    @classmethod
+    def bucket_value(cls, index):
+        """Returns the smallest value counted in bucket index."""
+        shift = max((index >> cls.SUB_BUCKET_BITS) - 1, 0)
+        return (index - shift * cls.SUB_BUCKETS) << shift
+
+    def record(self, value):
+        value = int(value)
+        if value < 0:
+            value = 0
+        self.counts[self.bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def percentile(self, percent):
+        """Returns the value below which percent of the recorded values fall."""
+        if self.count == 0:
+            return 0
+        rank = max(int(round(percent / 100.0 * self.count)), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                # The middle of the bucket is within half a bucket of any value in it
+                middle = (self.bucket_value(index) + self.bucket_value(index + 1) - 1) // 2
+                return min(max(middle, self.min), self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min if self.min is not None else 0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+        }
+
+class MetricsRegistry(object):
+    """Named counters, gauges and histograms, optionally labelled.
+
+    Metrics are created on first use and the same object is returned for
+    the same name and labels, so hot paths look their metrics up once and
+    keep the handles:
+
+        decode_ns = METRICS.histogram('decode_ns', chip=1)
+        decode_ns.record(time.perf_counter_ns() - start)
+
+    Updates take no lock. Each metric is meant to be updated from one
+    thread at a time; snapshot() may be called from any thread.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = kind()
+        if not isinstance(metric, kind):
+            raise TypeError("Metric %s is a %s, not a %s" % (name, type(metric).__name__, kind.__name__))
+        return metric
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, **labels):
+        return self._get(Gauge, name, labels)
+
+    def histogram(self, name, **labels):
+        return self._get(Histogram, name, labels)
+
+    def clear(self):
+        with self._lock:
+            self._metrics = {}
+
+    def _items(self):
+        with self._lock:
+            items = list(self._metrics.items())
+        return sorted(items, key=lambda item: (item[0][0], [str(v) for k, v in item[0][1]]))
+
+    def snapshot(self):
+        """Returns {'counters': ..., 'gauges': ..., 'histograms': ...}.
+
+        Each section maps a name such as fifo_fill_bytes{chip=1} to the
+        metric's current value.
+        """
+        sections = {Counter: {}, Gauge: {}, Histogram: {}}
+        for (name, labels), metric in self._items():
+            if labels:
+                name = "%s{%s}" % (name, ','.join("%s=%s" % label for label in labels))
+            sections[type(metric)][name] = metric.snapshot()
+        return {
+            'time': time.time(),
+            'counters': sections[Counter],
+            'gauges': sections[Gauge],
+            'histograms': sections[Histogram],
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_text(self):
+        """Formats the metrics in the Prometheus text exposition format.
+
+        Gauges add a <name>_max series and histograms are written as
+        summaries with quantile labels.
+        """
+        lines = []
+        for (name, labels), metric in self._items():
+            def series(suffix = '', extra = ()):
+                pairs = list(labels) + list(extra)
+                if not pairs:
+                    return name + suffix
+                return "%s%s{%s}" % (name, suffix, ','.join('%s="%s"' % pair for pair in pairs))
+
+            if isinstance(metric, Counter):
+                lines.append("%s %d" % (series(), metric.value))
+            elif isinstance(metric, Gauge):
+                lines.append("%s %s" % (series(), metric.value))
+                lines.append("%s %s" % (series('_max'), metric.max))
+            else:
+                for quantile, percent in (('0.5', 50), ('0.9', 90), ('0.99', 99), ('0.999', 99.9)):
+                    lines.append("%s %d" % (series('', [('quantile', quantile)]), metric.percentile(percent)))
+                lines.append("%s %d" % (series('_sum'), metric.total))
+                lines.append("%s %d" % (series('_count'), metric.count))
+        return "\n".join(lines) + "\n"
+
+# The registry the drivers, threads and senders report to
+METRICS = MetricsRegistry()
+
+# The server classes, defined on first use so that importing the registry
+# does not load http.server and socketserver
+_server_classes = None
+
+def _get_server_classes():
+    global _server_classes
+    if _server_classes is not None:
+        return _server_classes
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHttpHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            registry = self.server.registry
+            if self.path in ('/', '/metrics'):
+                body = registry.to_text().encode()
+                content_type = 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body = registry.to_json().encode()
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class MetricsUnixHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            self.wfile.write(self.server.registry.to_json().encode() + b"\n")
+
+    class UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    _server_classes = (ThreadingHTTPServer, MetricsHttpHandler, UnixMetricsServer, MetricsUnixHandler)
+    return _server_classes
+
+class MetricsServer(object):
+    """Serves a registry from a background thread.
+
+    address -- a (host, port) tuple serves HTTP, with the text format at
+    /metrics and JSON at /metrics.json. A string is taken as the path of a
+    Unix socket which writes one JSON snapshot to each connection.
+    """
+
+    def __init__(self, address = ('127.0.0.1', 9100), registry = None):
+        self._registry = registry if registry is not None else METRICS
+        http_server, http_handler, unix_server, unix_handler = _get_server_classes()
+        if isinstance(address, str):
+            self._server = unix_server(address, unix_handler)
+        else:
+            self._server = http_server(address, http_handler)
+        self._server.registry = self._registry
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class MetricsDumpThread(threading.Thread):
+    """Writes a JSON snapshot of a registry, one per line, every interval seconds."""
+
+    def __init__(self, interval = 10.0, stream = None, registry = None):
+        super(MetricsDumpThread, self).__init__(daemon=True)
+        self._interval = interval
+        self._stream = stream
+        self._registry = registry if registry is not None else METRICS
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            stream = self._stream if self._stream is not None else sys.stderr
+            stream.write(self._registry.to_json() + "\n")
+            stream.flush()
@@ -0,0 +1,436 @@
+import functools
+import multiprocessing
+import os
+import signal
+import time
+from abc import ABC, abstractmethod
+from multiprocessing import shared_memory
+from queue import Empty, Full
+import numpy as np
+from icm20689 import DataCollectionThread, init_spi_chips
+from icm20689_data import DEFAULT_UNITS, SampleBatch, SampleScale
+from icm20689_metrics import METRICS, MetricsServer
+from icm20689_thread import Interruptable
+
+class SharedSampleRing(object):
+    """Single-producer, multi-consumer ring of sample batches in shared memory.
+
+    The multiprocess counterpart of SampleRingBuffer. The producer copies
+    the raw FIFO frames of each batch into a fixed-size slot of a
+    multiprocessing.shared_memory block, and readers in other processes
+    copy them out again, so only the bytes read off the bus cross the
+    process boundary; scaling, filtering and sending all happen in the
+    reading process.
+
+    A slot's header holds the sequence number of the batch in it. The
+    producer clears it before copying a batch in, and a reader checks it
+    again after copying out, so a reader that was overtaken in the middle
+    of a copy drops the slot instead of returning a torn batch. Overflow
+    works as in SampleRingBuffer: 'overwrite' never makes the producer
+    wait, 'block' waits for the slowest reader.
+
+    There is no condition variable across processes, so waiting readers,
+    and a producer waiting in 'block' mode, poll every poll_interval
+    seconds.
+
+    The creating process hands the ring to others as a Process argument,
+    which attaches them to the same block, and calls unlink() once every
+    process is done with it.
+    """
+
+    # Header words: ring geometry, the next sequence number to be written,
+    # then one cursor per reader, -1 when the reader slot is free
+    SLOTS, SLOT_SAMPLES, MAX_READERS, WRITE_SEQ, CURSORS = range(0, 5)
+
+    SLOT_DTYPE = np.dtype([('seq', '<i8'), ('chip_id', '<i8'), ('count', '<i8'), ('timestamp', '<f8'),
+                           ('sample_period', '<f8'), ('accel_scale', '<f8'), ('gyro_scale', '<f8'),
+                           ('scale', '<f8', (6,)), ('offset', '<f8', (6,))])
+
+    def __init__(self, slots = 256, slot_samples = 341, overflow = 'overwrite', max_readers = 8, name = 'samples',
+                 poll_interval = .001):
+        """slot_samples -- samples per slot; larger batches span several
+        slots. The default holds a full 4 KB FIFO.
+        max_readers -- readers that can be subscribed at the same time.
+        name -- labels the ring's metrics.
+        """
+        if overflow not in ('overwrite', 'block'):
+            raise ValueError("overflow must be 'overwrite' or 'block', not %r" % (overflow,))
+        size = ((self.CURSORS + max_readers) * 8 + slots * self.SLOT_DTYPE.itemsize
+                + slots * slot_samples * 6 * 2)
+        self._shm = shared_memory.SharedMemory(create=True, size=size)
+        self._lock = multiprocessing.Lock()
+        self._overflow = overflow
+        self._name = name
+        self._poll_interval = poll_interval
+        self._map(slots, slot_samples, max_readers)
+
+        self._header[self.SLOTS] = slots
+        self._header[self.SLOT_SAMPLES] = slot_samples
+        self._header[self.MAX_READERS] = max_readers
+        self._header[self.WRITE_SEQ] = 0
+        self._cursors[:] = -1
+        self._slot_headers['seq'] = -1
+
+    def _map(self, slots, slot_samples, max_readers):
+        buf = self._shm.buf
+        self._slots = slots
+        self._slot_samples = slot_samples
+        self._header = np.ndarray((self.CURSORS + max_readers,), dtype='<i8', buffer=buf)
+        self._cursors = self._header[self.CURSORS:]
+        offset = self._header.nbytes
+        self._slot_headers = np.ndarray((slots,), dtype=self.SLOT_DTYPE, buffer=buf, offset=offset)
+        offset += self._slot_headers.nbytes
+        self._frames = np.ndarray((slots, slot_samples, 6), dtype='>i2', buffer=buf, offset=offset)
+        self._dropped_samples = METRICS.counter('ring_dropped_samples', ring=self._name)
+        self.dropped = 0
+
+    def __getstate__(self):
+        return {
+            'shm_name': self._shm.name,
+            'lock': self._lock,
+            'overflow': self._overflow,
+            'name': self._name,
+            'poll_interval': self._poll_interval,
+        }
+
+    def __setstate__(self, state):
+        self._shm = shared_memory.SharedMemory(name=state['shm_name'])
+        self._lock = state['lock']
+        self._overflow = state['overflow']
+        self._name = state['name']
+        self._poll_interval = state['poll_interval']
+        geometry = np.ndarray((self.CURSORS,), dtype='<i8', buffer=self._shm.buf)
+        slots, slot_samples, max_readers = (int(value) for value in geometry[:self.WRITE_SEQ])
+        del geometry
+        self._map(slots, slot_samples, max_readers)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def slots(self):
+        return self._slots
+
+    def subscribe(self):
+        """Returns a new reader that sees every batch put from now on.
+
+        Raises RuntimeError when max_readers readers are already subscribed.
+        """
+        with self._lock:
+            free = np.flatnonzero(self._cursors < 0)
+            if not len(free):
+                raise RuntimeError("All %d readers of ring %s are in use" % (len(self._cursors), self._name))
+            index = int(free[0])
+            self._cursors[index] = self._header[self.WRITE_SEQ]
+        return SharedRingReader(self, index)
+
+    def unsubscribe(self, reader):
+        with self._lock:
+            self._cursors[reader._index] = -1
+
+    def _has_room(self):
+        cursors = self._cursors[self._cursors >= 0]
+        if not len(cursors):
+            return True
+        # Keep the slot a reader may still be copying out of intact
+        return self._header[self.WRITE_SEQ] - cursors.min() < self._slots - 1
+
+    def _wait_for_room(self, block, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._has_room():
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                return False
+            time.sleep(self._poll_interval)
+        return True
+
+    def put(self, batch, block = True, timeout = None):
+        """Publishes a batch, splitting it over as many slots as needed.
+
+        Only one process may put into a ring. In 'block' mode a full ring
+        waits for the slowest reader for up to timeout seconds, then
+        raises Full and counts the rest of the batch as dropped.
+        """
+        while len(batch):
+            part = batch[:self._slot_samples]
+            batch = batch[self._slot_samples:]
+
+            if self._overflow == 'block' and not self._wait_for_room(block, timeout):
+                self.dropped += len(part) + len(batch)
+                self._dropped_samples.inc(len(part) + len(batch))
+                raise Full
+
+            seq = int(self._header[self.WRITE_SEQ])
+            slot = seq % self._slots
+            # Readers that copy the slot from here on see it as overwritten
+            # Calibrated batches carry their scale and offset vectors, others zeros
+            scale = part.scale.with_units(*DEFAULT_UNITS) if part.calibrated else None
+            self._slot_headers[slot] = (-1, part.chip_id, len(part), part.timestamp, part.sample_period,
+                                        part.accel_scale, part.gyro_scale,
+                                        scale.scale if scale is not None else 0.0,
+                                        scale.offset if scale is not None else 0.0)
+            self._frames[slot, :len(part)] = part.raw
+            self._slot_headers['seq'][slot] = seq
+            self._header[self.WRITE_SEQ] = seq + 1
+
+    def close(self):
+        """Detaches this process from the ring."""
+        del self._header, self._cursors, self._slot_headers, self._frames
+        self._shm.close()
+
+    def unlink(self):
+        """Frees the shared memory; called once, by the creating process."""
+        self._shm.unlink()
+
+class SharedRingReader(object):
+    """A consumer cursor into a SharedSampleRing.
+
+    get() returns copies, so batches stay valid however far the producer
+    moves on. Like RingReader it can stand in for a queue.Queue.
+    """
+
+    def __init__(self, ring, index):
+        self._ring = ring
+        self._index = index
+        self._depth = METRICS.gauge('ring_depth', ring=ring.name, reader=index)
+        self._dropped_slots = METRICS.counter('ring_dropped_slots', ring=ring.name, reader=index)
+        self.dropped = 0
+
+    def qsize(self):
+        return int(self._ring._header[SharedSampleRing.WRITE_SEQ] - self._ring._cursors[self._index])
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def _drop(self, slots):
+        self.dropped += slots
+        self._dropped_slots.inc(slots)
+
+    def get(self, block = True, timeout = None):
+        """Returns the next batch.
+
+        Raises Empty if no batch arrives within timeout seconds.
+        """
+        ring = self._ring
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            cursor = int(ring._cursors[self._index])
+            lag = int(ring._header[SharedSampleRing.WRITE_SEQ]) - cursor
+            if lag == 0:
+                if not block or (deadline is not None and time.monotonic() >= deadline):
+                    raise Empty
+                time.sleep(ring._poll_interval)
+                continue
+
+            self._depth.set(lag)
+            if lag > ring._slots - 1:
+                # Overwritten before this reader got to them
+                self._drop(lag - (ring._slots - 1))
+                cursor += lag - (ring._slots - 1)
+
+            slot = cursor % ring._slots
+            header = ring._slot_headers[slot].copy()
+            frames = ring._frames[slot, :max(header['count'], 0)].copy()
+            ring._cursors[self._index] = cursor + 1
+            if header['seq'] != cursor or ring._slot_headers['seq'][slot] != cursor:
+                # The producer lapped this reader during the copy
+                self._drop(1)
+                continue
+
+            accel_scale, gyro_scale = float(header['accel_scale']), float(header['gyro_scale'])
+            scale = None
+            if header['scale'].any():
+                scale = SampleScale.from_vectors(accel_scale, gyro_scale, header['scale'], header['offset'])
+            return SampleBatch(int(header['chip_id']), float(header['timestamp']), float(header['sample_period']),
+                               frames, accel_scale, gyro_scale, scale)
+
+    def close(self):
+        self._ring.unsubscribe(self)
+
+class MergedRingReader(object):
+    """Reads several rings, one per acquisition process, as a single queue."""
+
+    def __init__(self, readers, poll_interval = .001):
+        self._readers = list(readers)
+        self._poll_interval = poll_interval
+        self._next = 0
+
+    def qsize(self):
+        return sum(reader.qsize() for reader in self._readers)
+
+    def empty(self):
+        return all(reader.empty() for reader in self._readers)
+
+    def get(self, block = True, timeout = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # Take turns so a busy ring cannot starve the others
+            for i in range(0, len(self._readers)):
+                reader = self._readers[(self._next + i) % len(self._readers)]
+                try:
+                    batch = reader.get(block=False)
+                except Empty:
+                    continue
+                self._next = (self._next + i + 1) % len(self._readers)
+                return batch
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                raise Empty
+            time.sleep(self._poll_interval)
+
+    def close(self):
+        for reader in self._readers:
+            reader.close()
+
+def configure_process(cpu = None, realtime_priority = None):
+    """Pins the calling thread to a CPU and/or schedules it SCHED_FIFO.
+
+    Threads started afterwards inherit both settings. Real-time priority
+    needs root or CAP_SYS_NICE; without it a warning is printed and the
+    normal scheduler is kept.
+    """
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    if realtime_priority is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(realtime_priority))
+        except PermissionError:
+            print ('No permission for SCHED_FIFO, keeping the default scheduler')
+
+class InterruptableProcess(Interruptable, multiprocessing.Process, ABC):
+    """A daemon process with a stop event, as InterruptableThread.
+
+    The process ignores SIGINT, which the terminal sends to the whole
+    process group; the parent decides when to stop it.
+    """
+
+    def __init__(self, cpu = None, realtime_priority = None, metrics_address = None):
+        super(InterruptableProcess, self).__init__(daemon=True)
+        self._stop_event = multiprocessing.Event()
+        self._cpu = cpu
+        self._realtime_priority = realtime_priority
+        self._metrics_address = metrics_address
+
+    def _run_threads(self, threads):
+        """Runs threads until the process is stopped or all of them have ended."""
+        for thread in threads:
+            thread.start()
+        try:
+            while not self._stop_event.wait(.5):
+                if not any(thread.is_alive() for thread in threads):
+                    break
+        finally:
+            for thread in threads:
+                thread.stop()
+            for thread in threads:
+                thread.join()
+
+    def run(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        configure_process(self._cpu, self._realtime_priority)
+        # Each process has its own registry, so each serves it separately
+        server = MetricsServer(self._metrics_address).start() if self._metrics_address is not None else None
+        try:
+            self._run()
+        finally:
+            if server is not None:
+                server.stop()
+
+    @abstractmethod
+    def _run(self):
+        pass
+
+class AcquisitionProcess(InterruptableProcess):
+    """Reads a group of chips in a process of its own.
+
+    A DataCollectionThread drains the chips into a SharedSampleRing, and
+    nothing else runs in the process, so its timing does not depend on
+    the work done with the samples.
+
+    make_chips -- called in the new process to open and configure the
+    chips, such as functools.partial(init_spi_chips, [22, 23]). The chips
+    of a group share a bus and are read one after the other; a separate
+    group needs a bus of its own.
+    cpu, realtime_priority -- see configure_process().
+    metrics_address -- serves the process's metrics with a MetricsServer.
+    collection_options -- passed on to DataCollectionThread.
+    """
+
+    def __init__(self, ring, make_chips, cpu = None, realtime_priority = None, metrics_address = None,
+                 **collection_options):
+        super(AcquisitionProcess, self).__init__(cpu, realtime_priority, metrics_address)
+        self._ring = ring
+        self._make_chips = make_chips
+        self._collection_options = collection_options
+
+    def _run(self):
+        try:
+            chips = self._make_chips()
+            self._run_threads([DataCollectionThread(self._ring, chips, **self._collection_options)])
+        finally:
+            self._ring.close()
+
+class WorkerProcess(InterruptableProcess):
+    """Runs consumers of the acquisition rings in a process of its own.
+
+    make_consumers -- each is called in the new process with a reader of
+    all the rings and returns an InterruptableThread taking batches from
+    it, e.g. UdpNetworkSenderThread or functools.partial(Write2FileThread,
+    directory='data'). Each consumer gets a reader of its own.
+    """
+
+    def __init__(self, rings, make_consumers, cpu = None, metrics_address = None):
+        super(WorkerProcess, self).__init__(cpu, None, metrics_address)
+        self._rings = list(rings)
+        self._make_consumers = list(make_consumers)
+
+    def _run(self):
+        readers = []
+        consumers = []
+        for make_consumer in self._make_consumers:
+            ring_readers = [ring.subscribe() for ring in self._rings]
+            reader = ring_readers[0] if len(ring_readers) == 1 else MergedRingReader(ring_readers)
+            readers.append(reader)
+            consumers.append(make_consumer(reader))
+
+        try:
+            self._run_threads(consumers)
+        finally:
+            for reader in readers:
+                reader.close()
+            for ring in self._rings:
+                ring.close()
+
+
+if __name__ == "__main__":
+    from icm20689_net import UdpNetworkSenderThread
+
+    # CS pins of the chips on each SPI bus; every bus gets a reader process
+    GROUPS = [[22, 23, 24, 25]]
+
+    rings = []
+    processes = []
+    first_id = 1
+    for bus, gpios in enumerate(GROUPS):
+        ring = SharedSampleRing(name='bus%d' % bus)
+        rings.append(ring)
+        make_chips = functools.partial(init_spi_chips, gpios, bus=bus, first_id=first_id)
+        # Readers take the last cores, away from the workers and the kernel's housekeeping on core 0
+        processes.append(AcquisitionProcess(ring, make_chips, cpu=os.cpu_count() - 1 - bus, realtime_priority=50))
+        first_id += len(gpios)
+    processes.append(WorkerProcess(rings, [UdpNetworkSenderThread]))
+
+    for process in processes:
+        process.start()
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print ('Stopping processes')
+    for process in processes:
+        process.stop()
+    for process in processes:
+        process.join()
+    for ring in rings:
+        ring.close()
+        ring.unlink()
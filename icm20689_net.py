@@ -0,0 +1,295 @@
+import logging
+import socket
+import struct
+import time
+from collections import deque
+from queue import Empty
+from icm20689_data import CALIBRATION, MpuDataPacket, count_samples
+from icm20689_metrics import METRICS
+from icm20689_thread import InterruptableThread
+
+logger = logging.getLogger(__name__)
+
+class PacketBatcher(object):
+    """Groups queued SampleBatch objects into size-limited, numbered packets.
+
+    collect() returns as soon as max_bytes worth of samples is pending or
+    max_latency seconds have passed since the first one arrived, so a
+    lightly loaded link sends small packets quickly and a busy one sends
+    full ones. make_packets() then splits the data so that no packet
+    serializes to more than max_bytes, and gives every packet the next
+    sequence number.
+    """
+
+    # IPv4 + UDP payload that fits a 1500 byte Ethernet MTU
+    MTU_PAYLOAD = 1472
+
+    def __init__(self, max_bytes = MTU_PAYLOAD, max_latency = .005):
+        min_bytes = MpuDataPacket.HEADER.size + MpuDataPacket.BLOCK_HEADER.size + CALIBRATION.size + MpuDataPacket.FRAME_BYTES
+        if max_bytes < min_bytes:
+            raise ValueError("max_bytes must be at least %d" % min_bytes)
+        self._max_bytes = max_bytes
+        self._max_latency = max_latency
+        self._sequence = 0
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @property
+    def max_latency(self):
+        return self._max_latency
+
+    @staticmethod
+    def block_size(batch):
+        """Returns the bytes a batch adds to a packet, block header included."""
+        return MpuDataPacket.block_header_size(batch) + len(batch) * MpuDataPacket.FRAME_BYTES
+
+    def begin(self, batch):
+        """Starts gathering data with batch, for callers that wait on their own.
+
+        Returns a PendingData; add batches to it while remaining() is
+        positive, then send its data. collect() uses it with a queue.Queue.
+        """
+        return PendingData(self, batch)
+
+    def collect(self, queue, timeout = 1):
+        """Waits up to timeout seconds for data and gathers a batch of it.
+
+        Returns a list of SampleBatch. Raises Empty if nothing arrived.
+        """
+        pending = self.begin(queue.get(timeout=timeout))
+        while True:
+            remaining = pending.remaining()
+            if remaining <= 0:
+                break
+            try:
+                pending.add(queue.get(timeout=remaining))
+            except Empty:
+                break
+        return pending.data
+
+    def make_packets(self, data):
+        """Splits a list of SampleBatch into packets of at most max_bytes."""
+        packets = []
+        current = []
+        free = self._max_bytes - MpuDataPacket.HEADER.size
+
+        for batch in data:
+            header_size = MpuDataPacket.block_header_size(batch)
+            while len(batch):
+                room = (free - header_size) // MpuDataPacket.FRAME_BYTES
+                if room <= 0:
+                    packets.append(MpuDataPacket(current, self._sequence))
+                    self._sequence += 1
+                    current = []
+                    free = self._max_bytes - MpuDataPacket.HEADER.size
+                    continue
+
+                part = batch[:room]
+                current.append(part)
+                free -= header_size + len(part) * MpuDataPacket.FRAME_BYTES
+                batch = batch[room:]
+
+        if current:
+            packets.append(MpuDataPacket(current, self._sequence))
+            self._sequence += 1
+
+        return packets
+
+class PendingData(object):
+    """The batches gathered so far by PacketBatcher.begin()."""
+
+    def __init__(self, batcher, batch):
+        self._batcher = batcher
+        self.data = [batch]
+        self._size = MpuDataPacket.HEADER.size + batcher.block_size(batch)
+        self._deadline = time.monotonic() + batcher.max_latency
+
+    def add(self, batch):
+        self.data.append(batch)
+        self._size += self._batcher.block_size(batch)
+
+    def remaining(self):
+        """Returns the seconds left to wait for more data, 0 or less once done."""
+        if self._size >= self._batcher.max_bytes:
+            return 0
+        return self._deadline - time.monotonic()
+
+class UdpNetworkSenderThread(InterruptableThread):
+    def __init__(self, queue, ip_addr='192.168.0.200', port = 1025, max_bytes = PacketBatcher.MTU_PAYLOAD, max_latency = .005):
+        super(UdpNetworkSenderThread, self).__init__()
+        self._data_queue = queue
+        self._ip_addr = ip_addr
+        self._port = port
+        self._batcher = PacketBatcher(max_bytes, max_latency)
+        self._queue_depth = METRICS.gauge('queue_depth', consumer='udp_sender')
+        self._samples_sent = METRICS.counter('net_samples_sent', transport='udp')
+        self._packets_sent = METRICS.counter('net_packets_sent', transport='udp')
+        self._bytes_sent = METRICS.counter('net_bytes_sent', transport='udp')
+        self._send_ns = METRICS.histogram('net_send_ns', transport='udp')
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        while not self.stopped():
+            try:
+                data = self._batcher.collect(self._data_queue)
+                self._queue_depth.set(self._data_queue.qsize())
+                self._samples_sent.inc(count_samples(data))
+                for packet in self._batcher.make_packets(data):
+                    start = time.perf_counter_ns()
+                    self._bytes_sent.inc(sock.sendto(packet.serialize(), (self._ip_addr, self._port)))
+                    self._send_ns.record(time.perf_counter_ns() - start)
+                    self._packets_sent.inc()
+            except Empty:
+                pass
+
+class TcpNetworkSenderThread(InterruptableThread):
+    """Streams packets over TCP as length-prefixed frames.
+
+    Every packet is sent as a 4 byte big-endian length followed by the
+    serialized MpuDataPacket. Frames wait in a bounded outbound buffer and
+    are written with scatter-gather sendmsg calls. When the connection
+    drops the thread reconnects with exponential backoff; if the buffer
+    fills up meanwhile, overflow='drop' discards the oldest frames and
+    overflow='block' stops taking data from the queue until it drains.
+    """
+
+    FRAME_PREFIX = struct.Struct('!I')
+    # Frames handed to a single sendmsg call
+    MAX_IOV = 64
+
+    def __init__(self, queue, ip_addr='192.168.0.200', port = 1025, max_bytes = 65536, max_latency = .005,
+                 nodelay = True, max_buffered_frames = 256, overflow = 'drop',
+                 reconnect_delay = .1, max_reconnect_delay = 10.0, timeout = 1.0):
+        super(TcpNetworkSenderThread, self).__init__()
+        if overflow not in ('drop', 'block'):
+            raise ValueError("overflow must be 'drop' or 'block', not %r" % (overflow,))
+        self._data_queue = queue
+        self._ip_addr = ip_addr
+        self._port = port
+        self._batcher = PacketBatcher(max_bytes, max_latency)
+        self._nodelay = nodelay
+        self._max_buffered_frames = max_buffered_frames
+        self._overflow = overflow
+        self._reconnect_delay = reconnect_delay
+        self._max_reconnect_delay = max_reconnect_delay
+        self._timeout = timeout
+        self._outbound = deque()
+        # Samples in each outbound frame, counted once the frame is sent
+        self._outbound_samples = deque()
+        self._sent_offset = 0
+        self._sock = None
+        self._next_connect = 0
+        self._failures = 0
+        self._connected_before = False
+        self._queue_depth = METRICS.gauge('queue_depth', consumer='tcp_sender')
+        self._outbound_frames = METRICS.gauge('net_outbound_frames', transport='tcp')
+        self._samples_sent = METRICS.counter('net_samples_sent', transport='tcp')
+        self._packets_sent = METRICS.counter('net_packets_sent', transport='tcp')
+        self._bytes_sent = METRICS.counter('net_bytes_sent', transport='tcp')
+        self._dropped_counter = METRICS.counter('net_dropped_frames', transport='tcp')
+        self._reconnect_counter = METRICS.counter('net_reconnects', transport='tcp')
+        self.dropped_frames = 0
+        self.reconnects = 0
+
+    def _connect(self):
+        now = time.monotonic()
+        if now < self._next_connect:
+            return False
+        try:
+            sock = socket.create_connection((self._ip_addr, self._port), timeout=self._timeout)
+        except OSError as e:
+            delay = min(self._reconnect_delay * (2 ** self._failures), self._max_reconnect_delay)
+            self._failures += 1
+            self._next_connect = now + delay
+            logger.warning("TCP connect to %s:%d failed (%s), retrying in %0.1f s", self._ip_addr, self._port, e, delay)
+            return False
+
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self._nodelay else 0)
+        sock.settimeout(self._timeout)
+        if self._connected_before:
+            self.reconnects += 1
+            self._reconnect_counter.inc()
+        self._connected_before = True
+        self._failures = 0
+        self._sock = sock
+        # A frame cut off by the old connection is resent whole
+        self._sent_offset = 0
+        return True
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self._next_connect = time.monotonic() + self._reconnect_delay
+
+    def _buffer_packets(self, packets):
+        for packet in packets:
+            size = packet.packed_size()
+            frame = bytearray(self.FRAME_PREFIX.size + size)
+            self.FRAME_PREFIX.pack_into(frame, 0, size)
+            packet.serialize_into(frame, self.FRAME_PREFIX.size)
+
+            if self._overflow == 'drop' and len(self._outbound) >= self._max_buffered_frames:
+                # A partly written frame has to be finished, so drop the one after it
+                index = 1 if self._sent_offset else 0
+                if index < len(self._outbound):
+                    del self._outbound[index]
+                    del self._outbound_samples[index]
+                    self.dropped_frames += 1
+                    self._dropped_counter.inc()
+            self._outbound.append(frame)
+            self._outbound_samples.append(count_samples(packet.data))
+        self._outbound_frames.set(len(self._outbound))
+
+    def _flush(self):
+        """Writes as much of the outbound buffer as the socket accepts."""
+        while self._outbound:
+            buffers = []
+            for i, frame in enumerate(self._outbound):
+                if i == self.MAX_IOV:
+                    break
+                buffers.append(memoryview(frame)[self._sent_offset:] if i == 0 else frame)
+
+            sent = self._sock.sendmsg(buffers)
+            self._bytes_sent.inc(sent)
+
+            sent += self._sent_offset
+            while self._outbound and sent >= len(self._outbound[0]):
+                sent -= len(self._outbound.popleft())
+                self._samples_sent.inc(self._outbound_samples.popleft())
+                self._packets_sent.inc()
+            self._sent_offset = sent
+        self._outbound_frames.set(len(self._outbound))
+
+    def run(self):
+        while not self.stopped():
+            if self._sock is None:
+                self._connect()
+
+            if self._overflow == 'drop' or len(self._outbound) < self._max_buffered_frames:
+                try:
+                    data = self._batcher.collect(self._data_queue, timeout=.1 if self._outbound else 1)
+                    self._queue_depth.set(self._data_queue.qsize())
+                    self._buffer_packets(self._batcher.make_packets(data))
+                except Empty:
+                    pass
+            elif self._sock is None:
+                # Blocked on a full buffer until the connection is back
+                self._stop_event.wait(.05)
+
+            if self._sock is None:
+                continue
+
+            try:
+                self._flush()
+            except socket.timeout:
+                pass
+            except OSError as e:
+                logger.warning("TCP connection to %s:%d lost (%s)", self._ip_addr, self._port, e)
+                self._disconnect()
+
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
@@ -0,0 +1,251 @@
+import socket
+import select
+import threading
+import numpy as np
+from icm20689_data import DEFAULT_UNITS, MpuDataPacket
+from icm20689_thread import InterruptableThread
+
+class ChipStream(object):
+    """Bounded per-chip store of received samples.
+
+    Samples are kept as an (N, 6) float array in m/s^2 and deg/s alongside
+    an (N,) array of sample timestamps. Storage grows as needed so that
+    appending a batch is amortised O(1) numpy copies.
+
+    At most max_samples are kept: once a consumer falls that far behind,
+    the oldest samples are dropped and counted in discarded. The receiver
+    thread appends while a consumer calls take() from another thread, so
+    both hold a lock; the samples and timestamps views are only for use
+    from the appending thread.
+    """
+
+    def __init__(self, chip_id, capacity = 4096, max_samples = 1 << 20):
+        self.chip_id = chip_id
+        self.max_samples = max_samples
+        self.discarded = 0
+        self._samples = np.empty((capacity, 6), dtype=np.float64)
+        self._timestamps = np.empty(capacity, dtype=np.float64)
+        # The stored samples are [_start, _end) of the arrays
+        self._start = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._end - self._start
+
+    def _reserve(self, count):
+        """Makes room for count more samples, dropping the oldest beyond max_samples."""
+        end = self._end + count
+        start = max(self._start, end - self.max_samples)
+        self.discarded += start - self._start
+        self._start = start
+        capacity = len(self._timestamps)
+        if end <= capacity:
+            return
+
+        # Move the kept samples to the front, leaving at least as much room
+        # again so the next move is as many appends away
+        kept = self._end - start
+        samples = self._samples
+        timestamps = self._timestamps
+        if capacity < 2 * (kept + count):
+            while capacity < 2 * (kept + count):
+                capacity *= 2
+            samples = np.empty((capacity, 6), dtype=np.float64)
+            timestamps = np.empty(capacity, dtype=np.float64)
+        samples[:kept] = self._samples[start:self._end]
+        timestamps[:kept] = self._timestamps[start:self._end]
+        self._samples = samples
+        self._timestamps = timestamps
+        self._start = 0
+        self._end = kept
+
+    def append(self, batch):
+        with self._lock:
+            if len(batch) > self.max_samples:
+                self.discarded += len(batch) - self.max_samples
+                batch = batch[len(batch) - self.max_samples:]
+            count = len(batch)
+            self._reserve(count)
+            end = self._end + count
+            if batch.calibrated:
+                batch.scale.with_units(*DEFAULT_UNITS).apply(batch.raw, out=self._samples[self._end:end])
+            else:
+                self._samples[self._end:end, :3] = batch.raw[:, :3]
+                self._samples[self._end:end, :3] *= batch.accel_scale
+                self._samples[self._end:end, 3:] = batch.raw[:, 3:]
+                self._samples[self._end:end, 3:] *= batch.gyro_scale
+            self._timestamps[self._end:end] = batch.timestamps()
+            self._end = end
+
+    @property
+    def samples(self):
+        """A view of the received samples as an (N, 6) float array."""
+        return self._samples[self._start:self._end]
+
+    @property
+    def timestamps(self):
+        """A view of the received sample timestamps as an (N,) array."""
+        return self._timestamps[self._start:self._end]
+
+    def take(self):
+        """Returns copies of (timestamps, samples) and empties the stream."""
+        with self._lock:
+            timestamps = self.timestamps.copy()
+            samples = self.samples.copy()
+            self._start = self._end = 0
+        return timestamps, samples
+
+class ReceiverStats(object):
+
+    __slots__ = ('packets', 'bytes', 'samples', 'dropped', 'reordered', 'duplicates', 'invalid')
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.samples = 0
+        self.dropped = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.invalid = 0
+
+    def __repr__(self):
+        return "packets: %d bytes: %d samples: %d dropped: %d reordered: %d duplicates: %d invalid: %d" % (
+            self.packets, self.bytes, self.samples, self.dropped, self.reordered, self.duplicates, self.invalid)
+
+class UdpPacketReceiver(object):
+    """Receives MpuDataPacket datagrams and decodes them into per-chip arrays.
+
+    Datagrams are drained with recv_into into a preallocated ring of fixed
+    size slots, so a burst of packets costs no allocations before decoding.
+    Sequence numbers are tracked per sender to count dropped, reordered
+    and duplicated packets. Each chip's ChipStream keeps at most
+    max_samples.
+    """
+
+    # Largest payload a UDP datagram can carry
+    MAX_DATAGRAM = 65507
+    # A sequence number this far behind the expected one means the sender restarted
+    RESTART_WINDOW = 1024
+
+    def __init__(self, ip_addr = '', port = 1025, slots = 64, slot_size = MAX_DATAGRAM, rcvbuf = 4 * 1024 * 1024,
+                 max_samples = 1 << 20):
+        self._address = (ip_addr, port)
+        self._slot_size = slot_size
+        self._ring = bytearray(slots * slot_size)
+        self._slots = [memoryview(self._ring)[i * slot_size:(i + 1) * slot_size] for i in range(0, slots)]
+        self._next_slot = 0
+        self._rcvbuf = rcvbuf
+        self._max_samples = max_samples
+        self._sock = None
+        # Per sender: [next expected sequence number, recently missed ones]
+        self._senders = {}
+        self.streams = {}
+        self.stats = ReceiverStats()
+
+    def open(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._rcvbuf)
+        self._sock.bind(self._address)
+        self._sock.setblocking(False)
+        return self
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def getsockname(self):
+        return self._sock.getsockname()
+
+    def _track_sequence(self, addr, sequence):
+        state = self._senders.get(addr)
+        if state is None:
+            self._senders[addr] = [(sequence + 1) & 0xFFFFFFFF, set()]
+            return
+        expected, missing = state
+
+        ahead = (sequence - expected) & 0xFFFFFFFF
+        if ahead < 0x80000000:
+            # In order, or ahead after a gap of lost packets
+            self.stats.dropped += ahead
+            # Remember the most recent gaps, so a late packet can be told from a duplicate
+            missing.update((expected + i) & 0xFFFFFFFF for i in range(max(ahead - self.RESTART_WINDOW, 0), ahead))
+            state[0] = (sequence + 1) & 0xFFFFFFFF
+            if len(missing) > self.RESTART_WINDOW:
+                state[1] = set(missed for missed in missing if (state[0] - missed) & 0xFFFFFFFF <= self.RESTART_WINDOW)
+            return
+
+        behind = 0x100000000 - ahead
+        if behind > self.RESTART_WINDOW:
+            self._senders[addr] = [(sequence + 1) & 0xFFFFFFFF, set()]
+        elif sequence in missing:
+            # A late packet fills a gap that was already counted as dropped
+            missing.discard(sequence)
+            self.stats.reordered += 1
+            self.stats.dropped -= 1
+        else:
+            self.stats.duplicates += 1
+
+    def _decode(self, view, addr):
+        try:
+            packet = MpuDataPacket.deserialize(view)
+        except ValueError:
+            self.stats.invalid += 1
+            return
+
+        self.stats.packets += 1
+        self.stats.bytes += len(view)
+        self._track_sequence(addr, packet.sequence)
+
+        for batch in packet.data:
+            stream = self.streams.get(batch.chip_id)
+            if stream is None:
+                # Replaced rather than changed, so another thread can iterate it
+                streams = dict(self.streams)
+                stream = streams[batch.chip_id] = ChipStream(batch.chip_id, max_samples=self._max_samples)
+                self.streams = streams
+            stream.append(batch)
+            self.stats.samples += len(batch)
+
+    def poll(self, timeout = None):
+        """Waits up to timeout seconds for data, then drains the socket.
+
+        Datagrams are read into the ring until the socket is empty or every
+        slot is filled, and then decoded. Returns the number of datagrams
+        received.
+        """
+        readable, _, _ = select.select([self._sock], [], [], timeout)
+        if not readable:
+            return 0
+
+        received = []
+        for i in range(0, len(self._slots)):
+            slot = self._slots[self._next_slot]
+            try:
+                size, addr = self._sock.recvfrom_into(slot)
+            except BlockingIOError:
+                break
+            received.append((slot[:size], addr))
+            self._next_slot = (self._next_slot + 1) % len(self._slots)
+
+        for view, addr in received:
+            self._decode(view, addr)
+
+        return len(received)
+
+class UdpReceiverThread(InterruptableThread):
+    def __init__(self, receiver, poll_timeout = .100):
+        super(UdpReceiverThread, self).__init__()
+        self._receiver = receiver
+        self._poll_timeout = poll_timeout
+
+    def run(self):
+        while not self.stopped():
+            self._receiver.poll(self._poll_timeout)
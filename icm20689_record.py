@@ -0,0 +1,444 @@
+"""Binary recording files for sample batches.
+
+A recording file (.icmr) holds:
+
+    file header   FILE_HEADER: magic b'ICMR', version, reserved, length of
+                  the JSON header that follows. The JSON describes the
+                  session, the segment number and the chips, including
+                  their sample rates, ranges and scale factors.
+    blocks        BLOCK_HEADER then count frames of six big-endian int16
+                  words (ax, ay, az, gx, gy, gz) exactly as read from the
+                  FIFO. Each block is one SampleBatch of one chip and
+                  carries its timestamp, sample period and scales. With
+                  BLOCK_CALIBRATED set the CALIBRATION vectors of the
+                  batch's SampleScale sit between header and frames.
+    index         one INDEX_ENTRY per block, followed by TRAILER, written
+                  when the file is closed.
+
+The header and every block start on an 8 byte boundary so the frames
+can be mapped as int16 arrays in place. A file that was not closed has
+no index, but its blocks can still be found by walking the headers.
+
+RecordingWriter writes these files and RecordingReader maps them for
+random access.
+"""
+
+import json
+import mmap
+import os
+import struct
+import time
+import numpy as np
+from icm20689_data import CALIBRATION, SampleBatch, SampleScale
+
+FILE_MAGIC = b'ICMR'
+BLOCK_MAGIC = b'ICMB'
+INDEX_MAGIC = b'ICMI'
+VERSION = 2
+
+# magic, version, reserved, header JSON bytes
+FILE_HEADER = struct.Struct('!4sHHI')
+# magic, chip id, flags, sample count, block number, timestamp, sample period, accel scale, gyro scale
+BLOCK_HEADER = struct.Struct('!4sHHIIdddd')
+# Block flags; version 1 files always have 0 here
+BLOCK_CALIBRATED = 0x1
+# block offset, chip id, sample count, first sample time, last sample time
+INDEX_ENTRY = struct.Struct('!QHIdd')
+# magic, index offset, index entries
+TRAILER = struct.Struct('!4sQI')
+
+FRAME_BYTES = 12
+ALIGNMENT = 8
+FILE_EXTENSION = '.icmr'
+
+def _padding(size):
+    return -size % ALIGNMENT
+
+def _block_size(calibrated, count):
+    """Returns the bytes of a block before padding."""
+    return BLOCK_HEADER.size + (CALIBRATION.size if calibrated else 0) + count * FRAME_BYTES
+
+class RecordingWriter(object):
+    """Writes SampleBatch objects to a series of recording files.
+
+    Blocks are collected in memory and written with one large write once
+    buffer_size bytes are pending or flush_interval seconds have passed,
+    whichever comes first. A new segment file is started once the current
+    one holds max_bytes or has been open for max_seconds; either may be
+    None for no limit. Files are named <prefix>_<session>_<segment>.icmr
+    in directory, where session is the local time the writer was created.
+    If another writer already started a session in that second, a counter
+    is appended to the session (20250101_120000-1); files are never
+    overwritten.
+
+    chips -- a list of dicts describing the chips, as returned by
+    Icm20689.describe(), stored in every file header.
+    metadata -- any other JSON serializable values for the header.
+    """
+
+    def __init__(self, directory = '.', prefix = 'imu', chips = None, metadata = None, max_bytes = None,
+                 max_seconds = None, buffer_size = 1 << 20, flush_interval = 1.0):
+        self._directory = directory
+        self._prefix = prefix
+        self._chips = list(chips or [])
+        self._metadata = dict(metadata or {})
+        self._max_bytes = max_bytes
+        self._max_seconds = max_seconds
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+        self._session = time.strftime('%Y%m%d_%H%M%S')
+        self._segment = -1
+        self._file = None
+        self._buffer = bytearray()
+        self._index = []
+        self._offset = 0
+        self._blocks = 0
+        self._opened = 0
+        self._last_flush = 0
+        self.paths = []
+        self.samples = 0
+
+    @property
+    def path(self):
+        """The path of the file being written, or None before the first write."""
+        return self.paths[-1] if self._file is not None else None
+
+    def _open_segment(self):
+        self._segment += 1
+        started = self._session
+        collisions = 0
+        while True:
+            path = os.path.join(self._directory, "%s_%s_%03d%s" % (self._prefix, self._session, self._segment, FILE_EXTENSION))
+            try:
+                self._file = open(path, 'xb', buffering=0)
+                break
+            except FileExistsError:
+                if self._segment:
+                    raise
+                collisions += 1
+                self._session = '%s-%d' % (started, collisions)
+        self.paths.append(path)
+
+        header = dict(self._metadata)
+        header.update(version=VERSION, session=self._session, segment=self._segment, created=time.time(),
+                      chips=self._chips)
+        text = json.dumps(header).encode()
+        self._buffer = bytearray(FILE_HEADER.pack(FILE_MAGIC, VERSION, 0, len(text)))
+        self._buffer += text
+        self._buffer += bytes(_padding(len(self._buffer)))
+        self._index = []
+        self._offset = len(self._buffer)
+        self._blocks = 0
+        self._opened = time.monotonic()
+        # Write the header straight away so a reader can open the segment
+        self.flush()
+
+    def _close_segment(self):
+        index_offset = self._offset
+        for entry in self._index:
+            self._buffer += INDEX_ENTRY.pack(*entry)
+        self._buffer += TRAILER.pack(INDEX_MAGIC, index_offset, len(self._index))
+        self.flush()
+        self._file.close()
+        self._file = None
+
+    def _segment_full(self):
+        if self._max_bytes is not None and self._offset >= self._max_bytes:
+            return True
+        return self._max_seconds is not None and time.monotonic() - self._opened >= self._max_seconds
+
+    def write(self, batch):
+        """Appends one SampleBatch as a block."""
+        count = len(batch)
+        if count == 0:
+            return
+        if self._file is None:
+            self._open_segment()
+
+        frames = np.ascontiguousarray(batch.raw, dtype='>i2')
+        last = batch.timestamp + (count - 1) * batch.sample_period
+        self._index.append((self._offset, batch.chip_id, count, batch.timestamp, last))
+
+        calibrated = batch.calibrated
+        self._buffer += BLOCK_HEADER.pack(BLOCK_MAGIC, batch.chip_id, BLOCK_CALIBRATED if calibrated else 0, count,
+                                          self._blocks, batch.timestamp, batch.sample_period, batch.accel_scale,
+                                          batch.gyro_scale)
+        if calibrated:
+            self._buffer += batch.scale.pack_vectors()
+        self._buffer += frames.data
+        size = _block_size(calibrated, count)
+        self._buffer += bytes(_padding(size))
+        self._offset += size + _padding(size)
+        self._blocks += 1
+        self.samples += count
+
+        if len(self._buffer) >= self._buffer_size or time.monotonic() - self._last_flush >= self._flush_interval:
+            self.flush()
+        if self._segment_full():
+            self._close_segment()
+
+    def flush(self):
+        """Writes out any buffered blocks."""
+        if self._file is not None and self._buffer:
+            view = memoryview(self._buffer)
+            while len(view):
+                view = view[self._file.write(view):]
+            self._buffer = bytearray()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """Writes the index of the current file and closes it."""
+        if self._file is not None:
+            self._close_segment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class RecordingReader(object):
+    """Memory-mapped random access to one or more recording files.
+
+    Pass the segment files of a session (in any order; they are sorted by
+    segment number) to read them as one recording. Opening a file maps it
+    and loads only its block index, so large recordings open instantly;
+    sample data is paged in as it is touched. Files without an index,
+    such as one still being written, are indexed by walking their blocks,
+    and files whose header is not complete yet are left out.
+
+    batches() returns SampleBatch views straight onto the mapped frames.
+    read() and iter_chunks() copy only the requested range.
+    """
+
+    INDEX_DTYPE = np.dtype([('file', 'u2'), ('offset', 'u8'), ('chip', 'u2'), ('count', 'u4'),
+                            ('start', 'f8'), ('end', 'f8')])
+
+    def __init__(self, paths):
+        if isinstance(paths, (str, bytes, os.PathLike)):
+            paths = [paths]
+        self._files = []
+        self._maps = []
+        self.headers = []
+        try:
+            for path in paths:
+                self._open(path)
+        except Exception:
+            self.close()
+            raise
+
+        order = sorted(range(0, len(self.headers)), key=lambda i: self.headers[i].get('segment', 0))
+        self._maps = [self._maps[i] for i in order]
+        self._files = [self._files[i] for i in order]
+        self.headers = [self.headers[i] for i in order]
+        self.paths = [f.name for f in self._files]
+
+        index = [self._load_index(number) for number in range(0, len(self._maps))]
+        self.index = np.concatenate(index) if index else np.empty(0, dtype=self.INDEX_DTYPE)
+        self._chip_blocks = dict((int(chip), np.flatnonzero(self.index['chip'] == chip))
+                                 for chip in np.unique(self.index['chip']))
+        self._no_blocks = np.empty(0, dtype=np.intp)
+
+    def _open(self, path):
+        f = open(path, 'rb')
+        data = None
+        try:
+            head = f.read(FILE_HEADER.size)
+            if len(head) < FILE_HEADER.size:
+                # A segment that has only just been created
+                return
+            magic, version, _, size = FILE_HEADER.unpack(head)
+            if magic != FILE_MAGIC:
+                raise ValueError("%s is not a recording file" % path)
+            if version > VERSION:
+                raise ValueError("%s has unsupported version %d" % (path, version))
+            if os.fstat(f.fileno()).st_size < FILE_HEADER.size + size:
+                return
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            if data is None:
+                f.close()
+        self._files.append(f)
+        self._maps.append(data)
+
+        header = json.loads(bytes(data[FILE_HEADER.size:FILE_HEADER.size + size]).decode())
+        header['data_offset'] = FILE_HEADER.size + size + _padding(FILE_HEADER.size + size)
+        self.headers.append(header)
+
+    def _load_index(self, number):
+        data = self._maps[number]
+        size = len(data)
+        if size >= TRAILER.size:
+            magic, offset, entries = TRAILER.unpack_from(data, size - TRAILER.size)
+            if magic == INDEX_MAGIC and offset + entries * INDEX_ENTRY.size + TRAILER.size == size:
+                stored = np.frombuffer(data, dtype=np.dtype([('offset', '>u8'), ('chip', '>u2'), ('count', '>u4'),
+                                                             ('start', '>f8'), ('end', '>f8')]),
+                                       count=entries, offset=offset)
+                index = np.empty(entries, dtype=self.INDEX_DTYPE)
+                index['file'] = number
+                for name in ('offset', 'chip', 'count', 'start', 'end'):
+                    index[name] = stored[name]
+                return index
+        return self._scan_blocks(number)
+
+    def _scan_blocks(self, number):
+        """Builds the index of a file without one by walking its block headers."""
+        data = self._maps[number]
+        offset = self.headers[number]['data_offset']
+        entries = []
+        while offset + BLOCK_HEADER.size <= len(data):
+            magic, chip_id, flags, count, _, timestamp, period, _, _ = BLOCK_HEADER.unpack_from(data, offset)
+            size = _block_size(flags & BLOCK_CALIBRATED, count)
+            if magic != BLOCK_MAGIC or offset + size > len(data):
+                # The index, or a block that was cut off
+                break
+            entries.append((number, offset, chip_id, count, timestamp, timestamp + (count - 1) * period))
+            offset += size + _padding(size)
+        return np.array(entries, dtype=self.INDEX_DTYPE)
+
+    @property
+    def chips(self):
+        """The ids of the chips with samples in the recording."""
+        return sorted(self._chip_blocks)
+
+    def chip_config(self, chip_id):
+        """Returns the chip's configuration from the first file header, or None."""
+        for chip in self.headers[0].get('chips', []) if self.headers else []:
+            if chip.get('chip_id') == chip_id:
+                return chip
+        return None
+
+    def sample_count(self, chip_id):
+        return int(self.index['count'][self._chip_blocks.get(chip_id, self._no_blocks)].sum())
+
+    def time_range(self, chip_id = None):
+        """Returns the (first, last) sample time, of one chip or of all."""
+        blocks = self.index if chip_id is None else self.index[self._chip_blocks.get(chip_id, self._no_blocks)]
+        if len(blocks) == 0:
+            return None
+        return float(blocks['start'].min()), float(blocks['end'].max())
+
+    def _block(self, entry):
+        data = self._maps[entry['file']]
+        offset = int(entry['offset'])
+        _, chip_id, flags, count, _, timestamp, period, accel_scale, gyro_scale = BLOCK_HEADER.unpack_from(data, offset)
+        offset += BLOCK_HEADER.size
+        scale = None
+        if flags & BLOCK_CALIBRATED:
+            vectors = CALIBRATION.unpack_from(data, offset)
+            scale = SampleScale.from_vectors(accel_scale, gyro_scale, vectors[:6], vectors[6:])
+            offset += CALIBRATION.size
+        raw = np.frombuffer(data, dtype='>i2', count=count * 6, offset=offset).reshape(count, 6)
+        return SampleBatch(chip_id, timestamp, period, raw, accel_scale, gyro_scale, scale)
+
+    def _select(self, chip_id, start, end):
+        blocks = self._chip_blocks.get(chip_id)
+        if blocks is None:
+            return blocks
+        first = 0
+        last = len(blocks)
+        # Blocks of one chip are recorded in time order
+        if start is not None:
+            first = np.searchsorted(self.index['end'][blocks], start, 'left')
+        if end is not None:
+            last = np.searchsorted(self.index['start'][blocks], end, 'left')
+        return blocks[first:last]
+
+    def batches(self, chip_id, start = None, end = None):
+        """Yields SampleBatch views of the chip's blocks in time order.
+
+        start, end -- limit the samples to start <= t < end. The views
+        share memory with the mapped file, so they are read-only and only
+        valid until close().
+        """
+        blocks = self._select(chip_id, start, end)
+        if blocks is None:
+            return
+        for entry in self.index[blocks]:
+            batch = self._block(entry)
+            first = 0
+            last = len(batch)
+            if batch.sample_period > 0:
+                if start is not None and start > batch.timestamp:
+                    first = min(int(np.ceil((start - batch.timestamp) / batch.sample_period)), last)
+                if end is not None:
+                    last = max(min(int(np.ceil((end - batch.timestamp) / batch.sample_period)), last), first)
+            if first != 0 or last != len(batch):
+                batch = batch[first:last]
+            if len(batch):
+                yield batch
+
+    @staticmethod
+    def _join(batches, scaled):
+        timestamps = np.concatenate([batch.timestamps() for batch in batches])
+        if scaled:
+            samples = np.concatenate([batch.to_array() for batch in batches])
+        else:
+            samples = np.concatenate([batch.raw for batch in batches]).astype(np.int16)
+        return timestamps, samples
+
+    def read(self, chip_id, start = None, end = None, scaled = True):
+        """Returns (timestamps, samples) for start <= t < end as new arrays.
+
+        samples is (N, 6): in m/s^2 and deg/s when scaled, otherwise the
+        raw counts as native int16.
+        """
+        batches = list(self.batches(chip_id, start, end))
+        if not batches:
+            return np.empty(0), np.empty((0, 6), dtype=np.float64 if scaled else np.int16)
+        return self._join(batches, scaled)
+
+    def iter_chunks(self, chip_id, chunk_samples = 65536, start = None, end = None, scaled = True):
+        """Yields (timestamps, samples) like read(), chunk_samples at a time.
+
+        Chunks are made of whole blocks, so they can exceed chunk_samples
+        by less than one block. Only one chunk is held in memory at a time.
+        """
+        pending = []
+        pending_samples = 0
+        for batch in self.batches(chip_id, start, end):
+            pending.append(batch)
+            pending_samples += len(batch)
+            if pending_samples >= chunk_samples:
+                yield self._join(pending, scaled)
+                pending = []
+                pending_samples = 0
+        if pending:
+            yield self._join(pending, scaled)
+
+    def close(self):
+        for data in self._maps:
+            try:
+                data.close()
+            except BufferError:
+                # A batch view is still alive; the map is released with it
+                pass
+        for f in self._files:
+            f.close()
+        self._maps = []
+        self._files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_session(directory, prefix = 'imu', session = None):
+    """Opens every segment of a recorded session as one RecordingReader.
+
+    session -- the session time stamp in the file names; the latest
+    session in directory when None.
+    """
+    names = [name for name in os.listdir(directory)
+             if name.startswith(prefix + '_') and name.endswith(FILE_EXTENSION)]
+    sessions = sorted(set(name[len(prefix) + 1:].rsplit('_', 1)[0] for name in names))
+    if not sessions:
+        raise FileNotFoundError("No %s recordings in %s" % (prefix, directory))
+    if session is None:
+        session = sessions[-1]
+    paths = [os.path.join(directory, name) for name in names
+             if name[len(prefix) + 1:].rsplit('_', 1)[0] == session]
+    if not paths:
+        raise FileNotFoundError("No %s recordings of session %s in %s" % (prefix, session, directory))
+    return RecordingReader(paths)
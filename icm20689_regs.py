@@ -57,6 +57,12 @@ class ICM20689Regs(Enum):
     ZA_OFFSET_H = 0X7D
     ZA_OFFSET_L = 0X7E
 
+# High bytes of the x/y/z accelerometer offsets, which are not adjacent
+ACCEL_OFFSET_REGISTERS = (ICM20689Regs.XA_OFFSET_H, ICM20689Regs.YA_OFFSET_H, ICM20689Regs.ZA_OFFSET_H)
+# Offset register steps, in g and deg/s, whatever the configured ranges
+ACCEL_OFFSET_STEP = 0.00098
+GYRO_OFFSET_STEP = 1.0 / 32.8
+
 class EXT_SYNC_SET(Enum):
     DISABLED = 0x0
     TEMP_OUT_L = 0x1
@@ -67,6 +73,10 @@ class EXT_SYNC_SET(Enum):
     ACCEL_YOUT_L = 0x6
     ACCEL_ZOUT_L = 0x7
 
+# LSB per deg/s for each FS_SEL value and per g for each AFS_SEL value
+GYRO_LSB_SENSITIVITY = (131.0, 65.5, 32.8, 16.4)
+ACCEL_LSB_SENSITIVITY = (16384.0, 8192.0, 4096.0, 2048.0)
+
 class FS_SEL(Enum):
     FS_DEG_250 = 0x0
     FS_DEG_500 = 0x1
@@ -74,14 +84,7 @@ class FS_SEL(Enum):
     FS_DEG_2000 = 0x3
     
     def get_lsb_sensitivity(self):
-        if self.value == 0x0:
-            return 131.0
-        elif self.value == 0x1:
-            return 65.5
-        elif self.value == 0x2:
-            return 32.8
-        elif self.value == 0x3:
-            return 16.4
+        return GYRO_LSB_SENSITIVITY[self.value]
 
 class AFS_SEL(Enum):
     FS_2G = 0x0
@@ -90,14 +93,7 @@ class AFS_SEL(Enum):
     FS_16G = 0x3
 
     def get_lsb_sensitivity(self):
-        if self.value == 0x0:
-            return 16384.0
-        elif self.value == 0x1:
-            return 8192.0
-        elif self.value == 0x2:
-            return 4096.0
-        elif self.value == 0x3:
-            return 2048.0
+        return ACCEL_LSB_SENSITIVITY[self.value]
 
 class FIFO_EN(IntEnum):
     SLV0_FIFO_EN = 1 << 0
@@ -109,6 +105,14 @@ class FIFO_EN(IntEnum):
     XG_FIFO_EN = 1 << 6
     TEMP_FIFO_EN = 1 << 7
 
+class INT_PIN_CFG(IntEnum):
+    FSYNC_INT_MODE_EN = 1 << 2
+    FSYNC_INT_LEVEL = 1 << 3
+    INT_RD_CLEAR = 1 << 4
+    LATCH_INT_EN = 1 << 5
+    INT_OPEN = 1 << 6
+    INT_LEVEL = 1 << 7
+
 class INT_ENABLE(IntEnum):
     DATA_RDY_EN = 1 << 0
     I2C_MST_INT_EN = 1 << 3
@@ -117,4 +121,4 @@ class INT_ENABLE(IntEnum):
 class INT_STATUS(IntEnum):
     DATA_RDY_INT = 1 << 0
     I2C_MST_INT_INT = 1 << 3
-    FIFO_OFLOW_INT = 1 << 3
+    FIFO_OFLOW_INT = 1 << 4
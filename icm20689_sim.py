@@ -0,0 +1,453 @@
+import math
+import threading
+import time
+import numpy as np
+from icm20689_regs import *
+
+class SimulatedIcm20689(object):
+    """Register-level model of an ICM-20689 for testing without hardware.
+
+    The chip keeps a 128 byte register file and produces samples at the
+    rate selected by SMPLRT_DIV, scaled by the configured accel and gyro
+    ranges. Samples are generated lazily whenever the chip is accessed,
+    from the clock passed in, so no thread is needed. They update the
+    sensor output registers and are pushed into a 4 KB FIFO in register
+    order (accel, temp, gyro X/Y/Z as enabled in FIFO_EN). When the FIFO is
+    full the oldest bytes are discarded, as with FIFO_MODE 0 on the real
+    part, which can leave the FIFO out of frame alignment, and
+    FIFO_OFLOW_INT is raised.
+
+    motion -- a function taking an (N,) array of times in seconds and
+    returning (accel, gyro), two (N, 3) arrays in g and deg/s. The default
+    is a chip lying flat and still.
+    accel_noise, gyro_noise -- standard deviation of the added white noise
+    in g and deg/s.
+    accel_bias, gyro_bias -- constant offsets in g and deg/s, before any
+    offset register correction.
+    accel_gain -- per-axis sensitivity error of the accelerometer, e.g.
+    (1.01, 1.0, 0.99).
+    clock_error -- relative error of the internal oscillator, e.g. 0.024
+    for a chip whose nominal 1 kHz is really 1024 Hz.
+    """
+
+    FIFO_SIZE = 4096
+    WHO_AM_I = 0x98
+    INTERNAL_SAMPLE_RATE = 1000.0
+
+    _RESET_VALUES = {
+        ICM20689Regs.PWR_MGMT_1.value: 0x40,
+        ICM20689Regs.WHO_AM_I.value: WHO_AM_I,
+    }
+
+    def __init__(self, motion = None, accel_noise = 0.002, gyro_noise = 0.05, accel_bias = (0.0, 0.0, 0.0),
+                 gyro_bias = (0.0, 0.0, 0.0), accel_gain = (1.0, 1.0, 1.0), temperature = 30.0, clock_error = 0.0, seed = None, clock = time.monotonic):
+        self._motion = motion if motion is not None else still_motion
+        self._accel_noise = accel_noise
+        self._gyro_noise = gyro_noise
+        self._accel_bias = np.asarray(accel_bias, dtype=np.float64)
+        self._gyro_bias = np.asarray(gyro_bias, dtype=np.float64)
+        self._accel_gain = np.asarray(accel_gain, dtype=np.float64)
+        self._temperature = temperature
+        self._clock_error = clock_error
+        self._rng = np.random.default_rng(seed)
+        self._clock = clock
+        self._lock = threading.RLock()
+
+        self._regs = bytearray(128)
+        for register, value in self._RESET_VALUES.items():
+            self._regs[register] = value
+        self._fifo = bytearray()
+        self._epoch = clock()
+        self._produced = 0
+        self._edges = 0
+        self.overflows = 0
+
+    # Sampling
+
+    def sample_rate(self):
+        """Returns the true output data rate, including the clock error."""
+        return self.INTERNAL_SAMPLE_RATE * (1.0 + self._clock_error) / (1 + self._regs[ICM20689Regs.SMPLRT_DIV.value])
+
+    def _sleeping(self):
+        return bool(self._regs[ICM20689Regs.PWR_MGMT_1.value] & 0x40)
+
+    def _generate(self, times):
+        accel, gyro = self._motion(times)
+        count = len(times)
+
+        accel = accel * self._accel_gain + self._accel_bias + self._rng.normal(0.0, self._accel_noise, (count, 3))
+        gyro = gyro + self._gyro_bias + self._rng.normal(0.0, self._gyro_noise, (count, 3))
+        # The offset registers are added to the sensor output
+        accel += self._offset_correction('accel') * ACCEL_OFFSET_STEP
+        gyro += self._offset_correction('gyro') * GYRO_OFFSET_STEP
+
+        accel_fs = (self._regs[ICM20689Regs.ACCEL_CONFIG.value] >> 3) & 0x3
+        gyro_fs = (self._regs[ICM20689Regs.GYRO_CONFIG.value] >> 3) & 0x3
+
+        words = np.empty((count, 7), dtype=np.float64)
+        words[:, 0:3] = accel * ACCEL_LSB_SENSITIVITY[accel_fs]
+        words[:, 3] = (self._temperature - 36.53) * 340.0
+        words[:, 4:7] = gyro * GYRO_LSB_SENSITIVITY[gyro_fs]
+        return np.clip(np.rint(words), -32768, 32767).astype('>i2')
+
+    def _offset_correction(self, sensor):
+        """Reads the signed X/Y/Z offset registers of sensor, 'accel' or 'gyro'.
+
+        Accelerometer offsets are 15 bit values in steps of 0.98 mg and the
+        gyroscope offsets are in steps of 1/32.8 deg/s.
+        """
+        if sensor == 'accel':
+            registers = [register.value for register in ACCEL_OFFSET_REGISTERS]
+        else:
+            registers = [ICM20689Regs.XG_OFFS_USRH.value + 2 * axis for axis in range(0, 3)]
+        offsets = np.empty(3, dtype=np.float64)
+        for axis, register in enumerate(registers):
+            value = (self._regs[register] << 8) | self._regs[register + 1]
+            if value >= 0x8000:
+                value -= 0x10000
+            # The low bit of the accelerometer registers is reserved
+            offsets[axis] = value >> 1 if sensor == 'accel' else value
+        return offsets
+
+    def _fifo_frame_columns(self):
+        enabled = self._regs[ICM20689Regs.FIFO_EN.value]
+        columns = []
+        if enabled & FIFO_EN.ACCEL_FIFO_EN:
+            columns.extend([0, 1, 2])
+        if enabled & FIFO_EN.TEMP_FIFO_EN:
+            columns.append(3)
+        if enabled & FIFO_EN.XG_FIFO_EN:
+            columns.append(4)
+        if enabled & FIFO_EN.YG_FIFO_EN:
+            columns.append(5)
+        if enabled & FIFO_EN.ZG_FIFO_EN:
+            columns.append(6)
+        return columns
+
+    def _advance(self):
+        """Produces every sample due since the last access.
+
+        Returns the number of new samples.
+        """
+        now = self._clock()
+        if self._sleeping():
+            self._epoch = now
+            self._produced = 0
+            return 0
+
+        rate = self.sample_rate()
+        due = int((now - self._epoch) * rate)
+        count = due - self._produced
+        if count <= 0:
+            return 0
+        self._produced = due
+
+        # Older samples would be pushed out of the FIFO anyway
+        generated = min(count, self.FIFO_SIZE // 2 + 1)
+        times = self._epoch + np.arange(due - generated + 1, due + 1) / rate
+        words = self._generate(times)
+
+        self._regs[ICM20689Regs.ACCEL_XOUT_H.value:ICM20689Regs.GYRO_ZOUT_L.value + 1] = words[-1].tobytes()
+
+        status = INT_STATUS.DATA_RDY_INT
+        columns = self._fifo_frame_columns()
+        if self._regs[ICM20689Regs.USER_CTRL.value] & (1 << 6) and columns:
+            frame_bytes = 2 * len(columns)
+            self._fifo += words[:, columns].tobytes()
+            lost = len(self._fifo) - self.FIFO_SIZE + (count - generated) * frame_bytes
+            if lost > 0:
+                del self._fifo[:len(self._fifo) - self.FIFO_SIZE]
+                self.overflows += 1
+                status |= INT_STATUS.FIFO_OFLOW_INT
+        self._regs[ICM20689Regs.INT_STATUS.value] |= status
+
+        enabled = self._regs[ICM20689Regs.INT_ENABLE.value]
+        if enabled & INT_ENABLE.DATA_RDY_EN:
+            self._edges += count
+        elif enabled & INT_ENABLE.FIFO_OFLOW_EN and status & INT_STATUS.FIFO_OFLOW_INT:
+            self._edges += 1
+        return count
+
+    def take_edges(self):
+        """Advances the chip and returns the INT pin pulses since the last call."""
+        with self._lock:
+            self._advance()
+            edges = self._edges
+            self._edges = 0
+        return edges
+
+    # Register access
+
+    def read_register(self, register):
+        """Reads one register address, with the side effects of the real chip."""
+        with self._lock:
+            self._advance()
+            if register == ICM20689Regs.FIFO_R_W.value:
+                if not self._fifo:
+                    return 0xFF
+                value = self._fifo[0]
+                del self._fifo[0]
+                return value
+            if register == ICM20689Regs.FIFO_COUNTH.value:
+                return (len(self._fifo) >> 8) & 0x1F
+            if register == ICM20689Regs.FIFO_COUNTL.value:
+                return len(self._fifo) & 0xFF
+            value = self._regs[register]
+            if register == ICM20689Regs.INT_STATUS.value:
+                self._regs[register] = 0
+            return value
+
+    def read_registers(self, register, size):
+        """Burst read: the address auto-increments except on FIFO_R_W."""
+        with self._lock:
+            self._advance()
+            if register == ICM20689Regs.FIFO_R_W.value:
+                data = bytes(self._fifo[:size])
+                del self._fifo[:size]
+                return data + b'\xff' * (size - len(data))
+            if register == ICM20689Regs.FIFO_COUNTH.value and size == 2:
+                return bytes([(len(self._fifo) >> 8) & 0x1F, len(self._fifo) & 0xFF])
+            return bytes([self.read_register((register + i) & 0x7F) for i in range(0, size)])
+
+    def write_register(self, register, value):
+        with self._lock:
+            self._advance()
+            if register == ICM20689Regs.FIFO_R_W.value:
+                return
+            if register == ICM20689Regs.USER_CTRL.value and value & (1 << 2):
+                # FIFO_RST clears itself
+                self._fifo = bytearray()
+                value &= ~(1 << 2)
+            if register == ICM20689Regs.PWR_MGMT_1.value and value & 0x80:
+                # DEVICE_RESET
+                self._regs = bytearray(128)
+                for reset_register, reset_value in self._RESET_VALUES.items():
+                    self._regs[reset_register] = reset_value
+                self._fifo = bytearray()
+                return
+            if register in (ICM20689Regs.SMPLRT_DIV.value, ICM20689Regs.PWR_MGMT_1.value):
+                # Samples up to now were made at the old rate
+                self._epoch = self._clock()
+                self._produced = 0
+            self._regs[register] = value & 0xFF
+
+    def write_registers(self, register, values):
+        """Burst write: the address auto-increments except on FIFO_R_W."""
+        for i, value in enumerate(values):
+            self.write_register(register if register == ICM20689Regs.FIFO_R_W.value else (register + i) & 0x7F, value)
+
+def still_motion(times):
+    """A chip lying flat and motionless: +1 g on Z, no rotation."""
+    accel = np.zeros((len(times), 3))
+    accel[:, 2] = 1.0
+    return accel, np.zeros((len(times), 3))
+
+def make_swing_motion(amplitude = 30.0, frequency = 0.5):
+    """Returns a motion that rocks the chip about X like a pendulum.
+
+    amplitude -- peak tilt in degrees.
+    frequency -- oscillation frequency in Hz.
+    """
+    omega = 2 * math.pi * frequency
+
+    def motion(times):
+        angle = np.radians(amplitude) * np.sin(omega * times)
+        accel = np.zeros((len(times), 3))
+        accel[:, 1] = np.sin(angle)
+        accel[:, 2] = np.cos(angle)
+        gyro = np.zeros((len(times), 3))
+        gyro[:, 0] = amplitude * omega * np.cos(omega * times)
+        return accel, gyro
+
+    return motion
+
+class SimulatedGPIO(object):
+    """Stand-in for the RPi.GPIO module.
+
+    Tracks pin levels so SPI and I2C stand-ins know which chip is selected,
+    and delivers INT pin edges from attached chips to add_event_detect
+    callbacks from a background thread, like RPi.GPIO does.
+    """
+
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+
+    def __init__(self, edge_poll_interval = .0005):
+        self._levels = {}
+        self._interrupts = {}
+        self._callbacks = {}
+        self._edge_poll_interval = edge_poll_interval
+        self._edge_thread = None
+        self._lock = threading.Lock()
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down = None, initial = None):
+        if initial is not None:
+            self._levels[pin] = initial
+
+    def output(self, pin, value):
+        self._levels[pin] = 1 if value else 0
+
+    def input(self, pin):
+        return self._levels.get(pin, 0)
+
+    def level(self, pin, default = 0):
+        return self._levels.get(pin, default)
+
+    def cleanup(self, *pins):
+        self._callbacks = {}
+
+    def attach_interrupt(self, pin, chip):
+        """Wires the INT output of a SimulatedIcm20689 to pin."""
+        self._interrupts[pin] = chip
+
+    def add_event_detect(self, pin, edge, callback = None, bouncetime = None):
+        with self._lock:
+            self._callbacks[pin] = callback
+            if self._edge_thread is None:
+                self._edge_thread = threading.Thread(target=self._deliver_edges, daemon=True)
+                self._edge_thread.start()
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            self._callbacks.pop(pin, None)
+
+    def _deliver_edges(self):
+        while True:
+            with self._lock:
+                callbacks = list(self._callbacks.items())
+            for pin, callback in callbacks:
+                chip = self._interrupts.get(pin)
+                if chip is None or callback is None:
+                    continue
+                for i in range(0, chip.take_edges()):
+                    callback(pin)
+            time.sleep(self._edge_poll_interval)
+
+class SimulatedSpiDev(object):
+    """Stand-in for spidev.SpiDev on a bus shared by chips with GPIO chip selects."""
+
+    def __init__(self, rig):
+        self._rig = rig
+        self.max_speed_hz = 0
+        self.mode = 0
+        self.transfers = 0
+
+    def open(self, bus, device):
+        pass
+
+    def close(self):
+        pass
+
+    def xfer(self, data):
+        self.transfers += 1
+        chip = self._rig.selected_spi_chip()
+        if chip is None or len(data) < 2:
+            return [0xFF] * len(data)
+
+        register = data[0] & 0x7F
+        if data[0] & 0x80:
+            return [0] + list(chip.read_registers(register, len(data) - 1))
+
+        chip.write_registers(register, data[1:])
+        return [0] * len(data)
+
+    xfer2 = xfer
+
+class SimulatedSMBus(object):
+    """Stand-in for smbus.SMBus; the chip with its select pin high answers at 0x69."""
+
+    def __init__(self, rig, bus):
+        self._rig = rig
+        self.transfers = 0
+
+    def _chip(self, address):
+        self.transfers += 1
+        chip = self._rig.selected_i2c_chip()
+        if chip is None or address != 0x69:
+            raise IOError("No device at address 0x%02x" % address)
+        return chip
+
+    def read_byte_data(self, address, register):
+        return self._chip(address).read_register(register)
+
+    def write_byte_data(self, address, register, value):
+        self._chip(address).write_register(register, value)
+
+    def read_i2c_block_data(self, address, register, length = 32):
+        return list(self._chip(address).read_registers(register, length))
+
+    def write_i2c_block_data(self, address, register, values):
+        self._chip(address).write_registers(register, values)
+
+class _SpidevModule(object):
+    def __init__(self, rig):
+        self._rig = rig
+
+    def SpiDev(self):
+        return SimulatedSpiDev(self._rig)
+
+class _SmbusModule(object):
+    def __init__(self, rig):
+        self._rig = rig
+
+    def SMBus(self, bus):
+        return SimulatedSMBus(self._rig, bus)
+
+class SimulatedRig(object):
+    """A set of simulated chips wired to shared SPI/I2C buses and GPIO pins.
+
+    rig = SimulatedRig()
+    rig.add_chip(22)
+    rig.install()
+    chip = Icm20689SPI(1, 0, 0, 22)
+
+    spidev, smbus and GPIO are module-like stand-ins; install() hands them
+    to icm20689.set_hardware_backend.
+    """
+
+    def __init__(self, **gpio_options):
+        self.GPIO = SimulatedGPIO(**gpio_options)
+        self.spidev = _SpidevModule(self)
+        self.smbus = _SmbusModule(self)
+        self.chips = {}
+
+    def add_chip(self, chip_select, int_pin = None, **options):
+        """Adds a SimulatedIcm20689 selected by chip_select and returns it.
+
+        options are passed to SimulatedIcm20689.
+        """
+        chip = SimulatedIcm20689(**options)
+        self.chips[chip_select] = chip
+        if int_pin is not None:
+            self.GPIO.attach_interrupt(int_pin, chip)
+        return chip
+
+    def selected_spi_chip(self):
+        # SPI chip selects are active low
+        selected = [chip for pin, chip in self.chips.items() if self.GPIO.level(pin, 1) == 0]
+        return selected[0] if len(selected) == 1 else None
+
+    def selected_i2c_chip(self):
+        selected = [chip for pin, chip in self.chips.items() if self.GPIO.level(pin, 0) == 1]
+        return selected[0] if len(selected) == 1 else None
+
+    def install(self):
+        import icm20689
+        icm20689.set_hardware_backend(self.spidev, self.smbus, self.GPIO)
+        return self
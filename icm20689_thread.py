@@ -0,0 +1,19 @@
+import threading
+
+class Interruptable(object):
+    """Cooperative stopping for threads and processes.
+
+    Subclasses create self._stop_event, a threading or multiprocessing
+    Event, and check stopped() in their run loop.
+    """
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+class InterruptableThread(Interruptable, threading.Thread):
+    def __init__(self):
+        super(InterruptableThread, self).__init__(daemon=True)
+        self._stop_event = threading.Event()
@@ -0,0 +1,107 @@
+import time
+import numpy as np
+
+class SampleClock(object):
+    """Reconstructs the sample times of one chip from its FIFO drains.
+
+    The chip samples at a fixed rate from its own oscillator, which can
+    be a few percent off the rate set with SMPLRT_DIV (a nominal 1 kHz
+    chip may really run at about 1024 Hz). Sample k since the FIFO was
+    enabled was therefore taken at t0 + k * period for some t0 and
+    period. Each drain gives one observation: the newest of the first K
+    samples existed when the FIFO count was read at monotonic time t.
+
+    stamp() keeps the last window observations. Once they span min_span
+    seconds, the period is the least squares slope of drain time against
+    sample count. The line is then moved down to the lowest observation,
+    because read latency only ever makes a drain later than the sample,
+    never earlier. Until then the nominal period is used and each batch
+    ends at its drain time.
+
+    Timestamps are monotonic times moved to the epoch by an offset fixed
+    when the clock is created, so they read as time.time() values but
+    do not jump when the wall clock is adjusted.
+    """
+
+    # Estimates further than this from the nominal period are ignored
+    MAX_DRIFT = 0.1
+
+    def __init__(self, nominal_period, window = 256, min_span = 1.0, clock = time.monotonic):
+        self._clock = clock
+        self._window = window
+        self._min_span = min_span
+        self._counts = np.empty(window)
+        self._times = np.empty(window)
+        self._epoch_offset = time.time() - clock()
+        self.set_nominal_period(nominal_period)
+
+    def now(self):
+        """The clock's monotonic time, to be taken when the FIFO count is read."""
+        return self._clock()
+
+    @property
+    def nominal_period(self):
+        return self._nominal_period
+
+    @property
+    def period(self):
+        """The estimated sample period in seconds, or the nominal one until there is an estimate."""
+        return self._period if self._period is not None else self._nominal_period
+
+    @property
+    def rate(self):
+        return 1.0 / self.period
+
+    @property
+    def drift(self):
+        """Relative error of the chip's oscillator, e.g. 0.024 for 1024 Hz at a nominal 1 kHz."""
+        return self._nominal_period / self.period - 1.0
+
+    def set_nominal_period(self, nominal_period):
+        """Sets the period configured on the chip and forgets the estimate."""
+        self._nominal_period = nominal_period
+        self._period = None
+        self.reset()
+
+    def reset(self):
+        """Starts over after the sample sequence was broken, by a FIFO reset or overflow.
+
+        The period estimate is kept until a new one is made.
+        """
+        self._samples = 0
+        self._filled = 0
+        self._next = 0
+        self._offset = None
+
+    def _fit(self):
+        counts = self._counts[:self._filled]
+        times = self._times[:self._filled]
+        if times.max() - times.min() >= self._min_span:
+            k = counts - counts.mean()
+            period = np.dot(k, times - times.mean()) / np.dot(k, k)
+            if abs(period / self._nominal_period - 1.0) <= self.MAX_DRIFT:
+                self._period = period
+        if self._period is not None:
+            # Time of sample 0, with the line through the earliest observed drain
+            self._offset = np.min(times - self._period * counts)
+
+    def stamp(self, drain_time, count):
+        """Records a drain of count samples whose FIFO count was read at drain_time.
+
+        Returns (timestamp, period): the epoch time of the first sample
+        drained and the sample period.
+        """
+        first = self._samples
+        self._samples += count
+        if count:
+            self._counts[self._next] = self._samples - 1
+            self._times[self._next] = drain_time
+            self._next = (self._next + 1) % self._window
+            self._filled = min(self._filled + 1, self._window)
+            self._fit()
+
+        if self._offset is None:
+            timestamp = drain_time - max(count - 1, 0) * self._nominal_period
+        else:
+            timestamp = self._offset + first * self._period
+        return timestamp + self._epoch_offset, self.period
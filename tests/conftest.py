@@ -0,0 +1,55 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from icm20689_data import SampleBatch
+from icm20689_sim import SimulatedRig
+
+class FakeClock(object):
+    """A clock for the simulated chips that only moves when told to."""
+
+    def __init__(self, now = 1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+@pytest.fixture
+def rig():
+    """A simulated rig installed as the hardware backend of icm20689."""
+    return SimulatedRig().install()
+
+@pytest.fixture
+def make_batch():
+    """Returns a factory for SampleBatch objects.
+
+    make_batch(chip_id, first, count) gives count samples stamped from
+    first sample periods on, with the raw ax column counting up from first
+    so that samples can be told apart after a round trip. fill='random'
+    fills every column with random words seeded by first instead, and a
+    number fills every word with that number.
+    """
+    def make(chip_id = 1, first = 0, count = 10, fill = 'ramp', timestamp = None, sample_period = .001,
+             accel_scale = 1.0, gyro_scale = 1.0, scale = None):
+        if fill == 'ramp':
+            raw = np.zeros((count, 6), dtype='>i2')
+            raw[:, 0] = np.arange(first, first + count)
+        elif fill == 'random':
+            raw = np.random.default_rng(first).integers(-32768, 32768, (count, 6)).astype('>i2')
+        else:
+            raw = np.full((count, 6), fill, dtype='>i2')
+        if timestamp is None:
+            timestamp = first * sample_period
+        return SampleBatch(chip_id, timestamp, sample_period, raw, accel_scale, gyro_scale, scale)
+    return make
@@ -0,0 +1,122 @@
+import time
+from queue import Queue
+import numpy as np
+import pytest
+from icm20689 import DataCollectionThread, InterruptCollectionThread, SimulatedEdgeSource, init_spi_chips
+
+def collect(thread, queue, seconds):
+    thread.start()
+    time.sleep(seconds)
+    thread.stop()
+    thread.join(2)
+    counts = {}
+    while not queue.empty():
+        batch = queue.get()
+        counts.setdefault(batch.chip_id, []).append(len(batch))
+    return counts
+
+def test_drain_interval_follows_rate(rig):
+    rig.add_chip(22)
+    rig.add_chip(23)
+    fast, slow = init_spi_chips([22, 23], sample_frequency=1000)
+    slow.set_sample_frequency(50)
+    thread = DataCollectionThread(Queue(), [fast, slow], wait_sleep=.002, target_fill=.25, max_interval=2)
+    # A quarter of 341 frames
+    assert thread.drain_interval(fast) == pytest.approx(.25 * 4096 / 12 / 1000)
+    assert thread.drain_interval(slow) == pytest.approx(.25 * 4096 / 12 / 50)
+    assert DataCollectionThread(Queue(), [fast], max_interval=.05).drain_interval(slow) == .05
+    assert DataCollectionThread(Queue(), [fast], wait_sleep=.2, max_interval=1).drain_interval(fast) == .2
+
+def test_drains_each_chip_on_its_schedule(rig):
+    rig.add_chip(22)
+    rig.add_chip(23)
+    fast, slow = init_spi_chips([22, 23], sample_frequency=1000)
+    slow.set_sample_frequency(100)
+    queue = Queue()
+    thread = DataCollectionThread(queue, [fast, slow], target_fill=.1, max_interval=.1)
+    counts = collect(thread, queue, .5)
+
+    assert thread.fifo_overflows == {1: 0, 2: 0}
+    assert 400 <= sum(counts[1]) <= 600
+    assert 40 <= sum(counts[2]) <= 60
+    # The fast chip is drained at about 34 frames, the slow one every max_interval
+    assert max(counts[1]) < 100
+    assert len(counts[2]) <= 6
+    assert thread.fifo_high_water[1] < 100 * 12
+
+def test_polling_recovers_from_an_overflow(rig, clock):
+    rig.add_chip(22, accel_noise=0, gyro_noise=0, clock=clock)
+    chip = init_spi_chips([22], sample_frequency=1000)[0]
+    queue = Queue()
+    thread = DataCollectionThread(queue, [chip], wait_sleep=.005, max_interval=.005)
+    thread.start()
+    try:
+        time.sleep(.05)
+        clock.advance(1.0)
+        deadline = time.monotonic() + 2
+        while not thread.fifo_overflows[1] and time.monotonic() < deadline:
+            time.sleep(.01)
+        assert thread.fifo_overflows == {1: 1}
+        assert thread.fifo_high_water[1] == 341 * 12
+        # The misaligned frames are dropped
+        assert queue.empty()
+
+        clock.advance(.0105)
+        batch = queue.get(timeout=2)
+        assert len(batch) == 10
+        np.testing.assert_allclose(batch.to_array(), np.tile([0, 0, 9.80665, 0, 0, 0], (10, 1)), atol=2e-3)
+    finally:
+        thread.stop()
+        thread.join(2)
+
+def test_interrupts_drain_after_frames_per_drain(rig):
+    rig.add_chip(22, int_pin=5)
+    chip = init_spi_chips([22], sample_frequency=1000)[0]
+    queue = Queue()
+    thread = InterruptCollectionThread(queue, [chip], [5], frames_per_drain=20, max_interval=1)
+    counts = collect(thread, queue, .5)
+
+    assert thread.fifo_overflows == {1: 0}
+    assert 400 <= sum(counts[1]) <= 600
+    # Drains follow the edges, not max_interval
+    assert len(counts[1]) >= 10
+    assert max(counts[1]) < 60
+
+def test_missing_edges_fall_back_to_max_interval(rig):
+    rig.add_chip(22)
+    chip = init_spi_chips([22], sample_frequency=1000)[0]
+    queue = Queue()
+    thread = InterruptCollectionThread(queue, [chip], [5], SimulatedEdgeSource(), max_interval=.1)
+    counts = collect(thread, queue, .55)
+    assert 4 <= len(counts[1]) <= 6
+    assert 100 * len(counts[1]) - 10 <= sum(counts[1]) <= 100 * len(counts[1]) + 10
+
+def test_overflow_resets_the_fifo(rig, clock):
+    rig.add_chip(22, clock=clock)
+    chip = init_spi_chips([22], sample_frequency=1000)[0]
+    edges = SimulatedEdgeSource()
+    queue = Queue()
+    thread = InterruptCollectionThread(queue, [chip], [5], edges, frames_per_drain=1, max_interval=.5)
+    thread.start()
+    try:
+        time.sleep(.05)
+        clock.advance(1.0)
+        edges.trigger(5)
+        deadline = time.monotonic() + 2
+        while not thread.fifo_overflows[1] and time.monotonic() < deadline:
+            time.sleep(.01)
+        assert thread.fifo_overflows == {1: 1}
+        assert queue.empty()
+
+        clock.advance(.0105)
+        edges.trigger(5)
+        batch = queue.get(timeout=2)
+        assert len(batch) == 10
+    finally:
+        thread.stop()
+        thread.join(2)
+
+def test_one_int_pin_per_chip(rig):
+    rig.add_chip(22)
+    with pytest.raises(ValueError):
+        InterruptCollectionThread(Queue(), init_spi_chips([22]), [5, 6], SimulatedEdgeSource())
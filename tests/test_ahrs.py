@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+from icm20689_data import SampleBatch
+from icm20689_filter import (MadgwickFilter, MahonyFilter, QuaternionFilter, euler_to_quaternion,
+                             quaternion_to_euler, quaternion_to_matrix)
+
+def quaternion_product(p, q):
+    w1, x1, y1, z1 = p
+    w2, x2, y2, z2 = q
+    return np.array([w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2, w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                     w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2, w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2])
+
+def madgwick_step(q, gyro, accel, dt, beta):
+    """One step of Madgwick's IMU update as written in the paper."""
+    w, x, y, z = q
+    rate = .5 * quaternion_product(q, [0.0] + list(gyro))
+    a = accel / np.linalg.norm(accel)
+    f = np.array([2 * (x * z - w * y) - a[0], 2 * (w * x + y * z) - a[1], 2 * (.5 - x * x - y * y) - a[2]])
+    jacobian = np.array([[-2 * y, 2 * z, -2 * w, 2 * x], [2 * x, 2 * w, 2 * z, 2 * y], [0, -4 * x, -4 * y, 0]])
+    step = jacobian.T @ f
+    q = q + (rate - beta * step / np.linalg.norm(step)) * dt
+    return q / np.linalg.norm(q)
+
+def mahony_step(q, integral, gyro, accel, dt, kp, ki):
+    """One step of Mahony's IMU update."""
+    w, x, y, z = q
+    predicted = np.array([2 * (x * z - w * y), 2 * (w * x + y * z), w * w - x * x - y * y + z * z])
+    error = np.cross(accel / np.linalg.norm(accel), predicted)
+    integral = integral + ki * error * dt
+    rate = gyro + kp * error + integral
+    q = q + .5 * quaternion_product(q, [0.0] + list(rate)) * dt
+    return q / np.linalg.norm(q), integral
+
+def noisy_samples(count, seed = 1):
+    rng = np.random.default_rng(seed)
+    samples = np.zeros((count, 6))
+    samples[:, :3] = rng.normal(0, 1, (count, 3)) + [0, 3, 9]
+    samples[:, 3:] = rng.normal(0, 30, (count, 3))
+    return np.arange(count) * .001, samples
+
+def test_madgwick_matches_scalar_reference():
+    timestamps, samples = noisy_samples(3000)
+    quaternions = MadgwickFilter(beta=.5).filter(timestamps, samples)
+    q = quaternions[0]
+    for k in range(1, len(samples)):
+        q = madgwick_step(q, np.radians(samples[k, 3:]), samples[k, :3], .001, .5)
+        np.testing.assert_allclose(quaternions[k], q, atol=1e-7)
+
+def test_mahony_matches_scalar_reference():
+    timestamps, samples = noisy_samples(3000, seed=2)
+    mahony = MahonyFilter(kp=2.0, ki=.3)
+    quaternions = mahony.filter(timestamps, samples)
+    q = quaternions[0]
+    integral = np.zeros(3)
+    for k in range(1, len(samples)):
+        q, integral = mahony_step(q, integral, np.radians(samples[k, 3:]), samples[k, :3], .001, 2.0, .3)
+        np.testing.assert_allclose(quaternions[k], q, atol=1e-6)
+    np.testing.assert_allclose(mahony.bias(0), integral, atol=1e-6)
+
+def still_tilted(count, gyro_bias = 0.0):
+    samples = np.zeros((count, 6))
+    samples[:, 1] = 9.80665 * np.sin(np.radians(30))
+    samples[:, 2] = 9.80665 * np.cos(np.radians(30))
+    samples[:, 3] = gyro_bias
+    return np.arange(1, count + 1) * .001, samples
+
+@pytest.mark.parametrize('ahrs', [MadgwickFilter(beta=1.0), MahonyFilter(kp=2.0)])
+def test_converges_to_the_accelerometer_tilt(ahrs):
+    # Start level rather than from the first sample
+    ahrs._states[0] = np.zeros(ahrs.STATE_SIZE)
+    ahrs._states[0][0] = 1.0
+    ahrs._last_times[0] = 0.0
+    timestamps, samples = still_tilted(5000)
+    euler = quaternion_to_euler(ahrs.filter(timestamps, samples)[-1:])[0]
+    np.testing.assert_allclose(euler, [30, 0, 0], atol=.1)
+
+def test_mahony_integral_learns_the_gyro_bias():
+    mahony = MahonyFilter(kp=2.0, ki=.5)
+    timestamps, samples = still_tilted(30000, gyro_bias=2.0)
+    euler = quaternion_to_euler(mahony.filter(timestamps, samples, chip_id=3)[-1:])[0]
+    np.testing.assert_allclose(euler, [30, 0, 0], atol=.05)
+    np.testing.assert_allclose(mahony.bias(3), [-np.radians(2.0), 0, 0], atol=1e-3)
+    assert mahony.bias(4) is None
+
+@pytest.mark.parametrize('ahrs', [MadgwickFilter(), MahonyFilter(ki=.1)])
+def test_yaw_follows_a_constant_rate(ahrs):
+    samples = np.zeros((1001, 6))
+    samples[:, 2] = 9.80665
+    samples[:, 5] = 90.0
+    euler = quaternion_to_euler(ahrs.filter(np.arange(1001) * .001, samples)[-1:])[0]
+    np.testing.assert_allclose(euler, [0, 0, 90], atol=1e-6)
+
+def test_streaming_and_chips_match_single_pass():
+    timestamps, samples = noisy_samples(1000)
+    whole = MadgwickFilter().filter(timestamps, samples, chip_id=1)
+    streaming = MadgwickFilter()
+    parts = [streaming.filter(timestamps[i:i + 85], samples[i:i + 85], chip_id=1) for i in range(0, 1000, 85)]
+    np.testing.assert_allclose(np.concatenate(parts), whole, atol=1e-12)
+
+    # Chips filtered together, with batches of different lengths, match filtering each alone
+    raw = np.random.default_rng(3).integers(-3000, 3000, (200, 6)).astype('>i2')
+    batches = [SampleBatch(1, 0.0, .001, raw[:120], .0024, .061), SampleBatch(2, 0.0, .001, raw[120:], .0024, .061),
+               SampleBatch(1, .12, .001, raw[120:], .0024, .061)]
+    together = MahonyFilter(ki=.1).update_batches(batches)
+    alone = MahonyFilter(ki=.1)
+    expected = [alone.update(batches[0]), MahonyFilter(ki=.1).update(batches[1]), alone.update(batches[2])]
+    for got, want in zip(together, expected):
+        np.testing.assert_allclose(got, want, atol=1e-12)
+
+def test_conversions():
+    euler = np.array([[30.0, 20.0, 10.0], [-170.0, 80.0, -45.0]])
+    q = euler_to_quaternion(euler)
+    np.testing.assert_allclose(np.linalg.norm(q, axis=1), 1.0)
+    np.testing.assert_allclose(quaternion_to_euler(q), euler, atol=1e-9)
+    m = quaternion_to_matrix(q)
+    np.testing.assert_allclose(m @ m.transpose(0, 2, 1), np.broadcast_to(np.eye(3), (2, 3, 3)), atol=1e-12)
+    # A 90 degree yaw turns x into y
+    np.testing.assert_allclose(quaternion_to_matrix(euler_to_quaternion([[0, 0, 90]]))[0] @ [1, 0, 0], [0, 1, 0],
+                               atol=1e-12)
+
+def test_filter_base_is_abstract():
+    with pytest.raises(TypeError):
+        QuaternionFilter()
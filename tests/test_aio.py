@@ -0,0 +1,126 @@
+import asyncio
+import numpy as np
+import pytest
+from icm20689 import init_spi_chips
+from icm20689_aio import AsyncAcquisitionRuntime, AsyncFileSink, AsyncPacketSink, AsyncSink
+from icm20689_data import MpuDataPacket, SampleBatch
+from icm20689_net import PacketBatcher
+from icm20689_record import RecordingReader
+
+class ListSink(AsyncSink):
+    def __init__(self, max_queued = 1024):
+        super(ListSink, self).__init__(max_queued)
+        self.data = []
+
+    async def write(self, data):
+        self.data.extend(data)
+
+class FailingSink(ListSink):
+    async def write(self, data):
+        raise ValueError('sink broke')
+
+def run(runtime, stop_after = None):
+    async def main():
+        if stop_after is not None:
+            asyncio.get_running_loop().call_later(stop_after, runtime.stop)
+        await asyncio.wait_for(runtime.run(), 5)
+    asyncio.run(main())
+
+def test_sink_base_is_abstract():
+    with pytest.raises(TypeError):
+        AsyncSink()
+
+def test_offer_drops_oldest_when_full():
+    async def main():
+        sink = ListSink(max_queued=2)
+        for chip_id in range(1, 4):
+            sink.offer(SampleBatch(chip_id, 0.0, .001, np.zeros((1, 6), dtype='>i2'), 1.0, 1.0))
+        return sink, await sink._collect()
+    sink, data = asyncio.run(main())
+    assert sink.dropped_batches == 1
+    assert [batch.chip_id for batch in data] == [2, 3]
+
+def test_packet_sink_collects_up_to_max_bytes(make_batch):
+    class PacketSink(AsyncPacketSink):
+        async def write(self, data):
+            pass
+
+    async def main():
+        # Three batches fill a packet
+        sink = PacketSink(MpuDataPacket.HEADER.size + 3 * PacketBatcher.block_size(make_batch()), .05)
+        for first in range(0, 40, 10):
+            sink.offer(make_batch(1, first, 10))
+        return await sink._collect(), await sink._collect()
+    first, second = asyncio.run(main())
+    assert [batch.raw[0, 0] for batch in first] == [0, 10, 20]
+    assert [batch.raw[0, 0] for batch in second] == [30]
+
+def test_runtime_fans_out_to_sinks(rig):
+    rig.add_chip(22)
+    rig.add_chip(23)
+    sinks = [ListSink(), ListSink()]
+    run(AsyncAcquisitionRuntime(init_spi_chips([22, 23], sample_frequency=1000), sinks), stop_after=.3)
+    for sink in sinks:
+        assert {batch.chip_id for batch in sink.data} == {1, 2}
+        assert sum(len(batch) for batch in sink.data if batch.chip_id == 1) > 100
+
+def test_polling_recovers_from_an_overflow(rig, clock):
+    rig.add_chip(22, accel_noise=0, gyro_noise=0, clock=clock)
+    sink = ListSink()
+    runtime = AsyncAcquisitionRuntime(init_spi_chips([22], sample_frequency=1000), [sink], wait_sleep=.005, max_interval=.005)
+
+    async def drive():
+        await asyncio.sleep(.05)
+        clock.advance(1.0)
+        while not runtime.fifo_overflows[1]:
+            await asyncio.sleep(.01)
+        clock.advance(.0105)
+        await asyncio.sleep(.1)
+        runtime.stop()
+
+    async def main():
+        await asyncio.wait_for(asyncio.gather(runtime.run(), drive()), 5)
+    asyncio.run(main())
+    assert runtime.fifo_overflows == {1: 1}
+    # Only the frames written after the reset arrive
+    assert [len(batch) for batch in sink.data] == [10]
+    np.testing.assert_allclose(sink.data[0].to_array(), np.tile([0, 0, 9.80665, 0, 0, 0], (10, 1)), atol=2e-3)
+
+def test_file_sink_records_batches(rig, tmp_path):
+    rig.add_chip(22)
+    chips = init_spi_chips([22], sample_frequency=1000)
+    sink = AsyncFileSink(str(tmp_path), chips=chips)
+    run(AsyncAcquisitionRuntime(chips, [sink]), stop_after=.3)
+    with RecordingReader(sink.paths) as reader:
+        assert reader.chip_config(1)['sample_frequency'] == 1000
+        assert reader.sample_count(1) > 100
+
+def test_runtime_runs_again(rig):
+    rig.add_chip(22)
+    sink = ListSink()
+    runtime = AsyncAcquisitionRuntime(init_spi_chips([22], sample_frequency=1000), [sink])
+    run(runtime, stop_after=.2)
+    count = len(sink.data)
+    run(runtime, stop_after=.2)
+    assert count > 0 and len(sink.data) > count
+
+def test_polling_failure_stops_and_raises(rig, monkeypatch):
+    rig.add_chip(22)
+    chip = init_spi_chips([22], sample_frequency=1000)[0]
+    reads = []
+    read = chip.read_fifo_batch
+
+    def failing_read():
+        reads.append(None)
+        if len(reads) > 5:
+            raise OSError('bus gone')
+        return read()
+    monkeypatch.setattr(chip, 'read_fifo_batch', failing_read)
+
+    with pytest.raises(OSError, match='bus gone'):
+        run(AsyncAcquisitionRuntime([chip], [ListSink()]))
+
+def test_sink_failure_stops_and_raises(rig):
+    rig.add_chip(22)
+    with pytest.raises(ValueError, match='sink broke'):
+        run(AsyncAcquisitionRuntime(init_spi_chips([22], sample_frequency=1000), [FailingSink()]))
@@ -0,0 +1,109 @@
+import time
+from queue import Queue
+import numpy as np
+import pytest
+from icm20689_align import AlignmentThread, ChipAligner, interpolate
+from icm20689_data import SampleBatch
+
+def test_interpolate_is_exact_on_lines_and_parabolas():
+    times = np.sort(np.random.default_rng(0).uniform(0, 1, 40))
+    data = np.column_stack((3 * times - 1, times * times - 2 * times))
+    grid = np.linspace(-.1, 1.1, 200)
+    inside = (grid >= times[0]) & (grid <= times[-1])
+
+    linear = interpolate(times, data, grid)
+    np.testing.assert_allclose(linear[inside, 0], 3 * grid[inside] - 1, atol=1e-12)
+    assert np.isnan(linear[~inside]).all()
+    # Both ends are inside
+    np.testing.assert_allclose(interpolate(times, data, times[[0, -1]]), data[[0, -1]], atol=1e-12)
+
+    # Central difference slopes are exact for a parabola away from the ends
+    cubic = interpolate(times, data, grid, 'cubic')
+    interior = (grid >= times[1]) & (grid <= times[-2])
+    np.testing.assert_allclose(cubic[interior, 1], grid[interior] ** 2 - 2 * grid[interior], atol=1e-12)
+    assert not np.allclose(linear[interior, 1], cubic[interior, 1], atol=1e-6)
+
+    assert np.isnan(interpolate(times[:1], data[:1], grid)).all()
+    with pytest.raises(ValueError):
+        interpolate(times, data, grid, 'spline')
+
+def ramp_batches(chip_id, rate, start, count, per_batch):
+    """Batches whose first column rises by one count per sample, with chip_id in the gyro x column."""
+    raw = np.zeros((count, 6), '>i2')
+    raw[:, 0] = np.arange(count)
+    raw[:, 3] = chip_id
+    return [SampleBatch(chip_id, start + k / rate, 1.0 / rate, raw[k:k + per_batch], .01, 1.0)
+            for k in range(0, count, per_batch)]
+
+def ramp(rate, start, times):
+    return (times - start) * rate * .01
+
+@pytest.mark.parametrize('method', ['linear', 'cubic'])
+def test_aligns_free_running_chips(method):
+    chips = {1: (1024.0, 100.0003), 2: (1000.0, 100.0011), 3: (995.0, 100.0)}
+    streams = dict((chip_id, ramp_batches(chip_id, rate, start, 2000, 70)) for chip_id, (rate, start) in chips.items())
+    aligner = ChipAligner([1, 2, 3], 1000, method)
+    with pytest.raises(ValueError):
+        aligner.add(ramp_batches(4, 1000, 100.0, 10, 10)[0])
+
+    times = []
+    frames = []
+    for step in range(120):
+        now = 100.0 + step * .02
+        for stream in streams.values():
+            while stream and stream[0].timestamps()[-1] <= now:
+                aligner.add(stream.pop(0))
+        t, f = aligner.pop()
+        times.append(t)
+        frames.append(f)
+    t, f = aligner.pop(flush=True)
+    times = np.concatenate(times + [t])
+    frames = np.concatenate(frames + [f])
+
+    # One grid time per millisecond, on whole milliseconds, none twice
+    np.testing.assert_allclose(np.diff(times), .001)
+    np.testing.assert_allclose(times * 1000, np.round(times * 1000), atol=1e-6)
+    assert len(times) > 1900
+    for column, (chip_id, (rate, start)) in enumerate(chips.items()):
+        # The flush runs to the newest sample, past the end of the other chips
+        covered = times <= start + 1999 / rate
+        np.testing.assert_allclose(frames[covered, column, 0], ramp(rate, start, times[covered]), atol=1e-9)
+        np.testing.assert_allclose(frames[covered, column, 3], chip_id)
+        assert np.isnan(frames[~covered, column]).all()
+
+def test_a_stalled_chip_is_filled_with_nan():
+    aligner = ChipAligner([1, 2], 1000, max_latency=.1)
+    for batch in ramp_batches(1, 1000, 100.0, 500, 50):
+        aligner.add(batch)
+    # Nothing until the other chip has been quiet for max_latency
+    assert len(aligner.pop()[0]) == 400
+    for batch in ramp_batches(2, 1000, 100.0, 100, 50):
+        aligner.add(batch)
+    assert len(aligner.pop()[0]) == 0
+
+    aligner = ChipAligner([1, 2], 1000, max_latency=.1)
+    for batch in ramp_batches(1, 1000, 100.0, 500, 50) + ramp_batches(2, 1000, 100.0, 100, 50):
+        aligner.add(batch)
+    times, frames = aligner.pop()
+    # The grid runs max_latency behind chip 1's newest sample; chip 2 stops at 100.099
+    assert times[-1] == pytest.approx(100.399)
+    assert not np.isnan(frames[:, 0]).any()
+    assert np.isnan(frames[:, 1, 0]).sum() == len(times) - 100
+
+def test_alignment_thread():
+    queue = Queue()
+    out_queue = Queue()
+    thread = AlignmentThread(queue, out_queue, ChipAligner([1, 2], 1000))
+    thread.start()
+    # Chip 3 is not being aligned and is skipped
+    batches = ramp_batches(1, 1000, 100.0, 300, 100) + ramp_batches(3, 1000, 100.0, 100, 100) + ramp_batches(2, 1000, 100.0, 300, 100)
+    for batch in batches:
+        queue.put(batch)
+    deadline = time.monotonic() + 5
+    frames = 0
+    while frames < 300 and time.monotonic() < deadline:
+        frames += len(out_queue.get(timeout=5)[0])
+    thread.stop()
+    thread.join(2)
+    assert frames == 300
+    assert thread.unknown_batches == 1
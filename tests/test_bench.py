@@ -0,0 +1,37 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH = os.path.join(ROOT, 'benchmarks', 'bench_pipeline.py')
+
+def run_bench(*args):
+    return subprocess.run([sys.executable, BENCH, '--chips', '1', '--samples', '2000', '--duration', '.2',
+                           '--repeat', '1'] + list(args), capture_output=True, text=True, timeout=300)
+
+def test_every_stage_reports_json():
+    result = run_bench('--rates', '1000,4000')
+    assert result.returncode == 0, result.stderr
+    report = json.loads(result.stdout)
+    stages = [(entry['stage'], entry['rate']) for entry in report['results']]
+    assert len(stages) == 16
+    for entry in report['results']:
+        assert entry['samples_per_s'] > 0
+    handoff = [entry for entry in report['results'] if entry['stage'] == 'queue_handoff']
+    # The fast row really runs the chip at 4 kHz
+    assert handoff[1]['samples_per_s'] > 2 * handoff[0]['samples_per_s']
+
+def test_baseline_comparison(tmp_path):
+    baseline = tmp_path / 'base.json'
+    assert run_bench('--rates', '1000', '--stages', 'serialize', '--output', str(baseline)).returncode == 0
+    data = json.loads(baseline.read_text())
+    data['results'][0]['samples_per_s'] *= 100
+    baseline.write_text(json.dumps(data))
+
+    result = run_bench('--rates', '1000', '--stages', 'serialize', '--baseline', str(baseline))
+    assert result.returncode == 1
+    assert json.loads(result.stdout)['comparison'][0]['regressed']
+
+def test_unknown_stage():
+    assert run_bench('--stages', 'nope').returncode == 2
@@ -0,0 +1,125 @@
+import os
+import time
+import numpy as np
+import pytest
+from icm20689 import AFS_SEL, FS_SEL, init_spi_chips
+from icm20689_calib import (SIX_POSITIONS, CalibrationProfile, ProfileStore, apply_profile, calibrate_six_position,
+                            calibrate_still, fit_accel)
+from icm20689_regs import ACCEL_OFFSET_STEP, GYRO_OFFSET_STEP
+
+BIAS = np.array([300.0, -150.0, 80.0])
+GAIN = np.array([1.02, .99, 1.01])
+
+def readings(directions, one_g = 4096.0):
+    return BIAS + np.asarray(directions, dtype=np.float64) * one_g / GAIN
+
+def test_fit_accel_recovers_bias_and_gain():
+    directions = [gravity for gravity, description in SIX_POSITIONS]
+    bias, gain = fit_accel(readings(directions), 4096.0)
+    np.testing.assert_allclose(bias, BIAS, atol=1e-6)
+    np.testing.assert_allclose(gain, GAIN, atol=1e-9)
+
+    # More orientations than six, not along the axes
+    tilted = directions + [np.array([1, 1, 1]) / np.sqrt(3), np.array([-1, 0, 1]) / np.sqrt(2)]
+    bias, gain = fit_accel(readings(tilted), 4096.0)
+    np.testing.assert_allclose(bias, BIAS, atol=1e-6)
+    np.testing.assert_allclose(gain, GAIN, atol=1e-9)
+
+def test_fit_accel_rejects_too_few_orientations():
+    directions = [gravity for gravity, description in SIX_POSITIONS]
+    with pytest.raises(ValueError, match='At least 6'):
+        fit_accel(readings(directions[:5]), 4096.0)
+    # Six readings that never leave the z axis
+    with pytest.raises(ValueError):
+        fit_accel(readings([(0, 0, 1), (0, 0, -1)] * 3), 4096.0)
+
+def test_profile_dict_and_store(tmp_path):
+    profile = CalibrationProfile(0x98, 2, [1, 2, 3], [-4, 5, 6], (.01, 0, 0), (.5, 0, 0), (1.01, 1, 1), 'test', 123.0)
+    assert vars(CalibrationProfile.from_dict(profile.to_dict())) == vars(profile)
+
+    store = ProfileStore(str(tmp_path / 'profiles'))
+    assert store.load(0x98, 2) is None
+    path = store.save(profile)
+    assert os.path.basename(path) == 'icm_98_chip2.json'
+    assert os.listdir(str(tmp_path / 'profiles')) == ['icm_98_chip2.json']
+    assert vars(store.load(0x98, 2)) == vars(profile)
+    assert store.load(0x98, 3) is None
+
+def test_correction_makes_up_changed_registers():
+    profile = CalibrationProfile(0x98, 1, [10, 0, 0], [0, 0, 4], (.001, 0, 0), (0, 0, .01))
+    bias, gain = profile.correction([10, 0, 0], [0, 0, 4])
+    np.testing.assert_allclose(bias, [.001 * 9.80665, 0, 0, 0, 0, .01])
+    assert gain is None
+    # Two register steps lower leave two steps more bias
+    bias, gain = profile.correction([8, 0, 0], [0, 0, 3])
+    np.testing.assert_allclose(bias, [(.001 - 2 * ACCEL_OFFSET_STEP) * 9.80665, 0, 0, 0, 0, .01 - GYRO_OFFSET_STEP])
+    assert CalibrationProfile(0x98, 1).correction([0] * 3, [0] * 3) == (None, None)
+
+class Turntable(object):
+    """Motion for a simulated chip that holds whatever orientation it was last turned to."""
+
+    def __init__(self):
+        self.gravity = np.array([0.0, 0.0, 1.0])
+
+    def __call__(self, t):
+        return np.tile(self.gravity, (len(t), 1)), np.zeros((len(t), 3))
+
+    def turn(self, index, description):
+        self.gravity = np.array(SIX_POSITIONS[index][0], dtype=np.float64)
+
+def mean_reading(chip, seconds = .05):
+    chip.enable_fifo()
+    time.sleep(seconds)
+    return chip.read_fifo_batch().to_array(('g', 'deg/s')).mean(axis=0)
+
+def faulty_chip(rig, turntable, **options):
+    rig.add_chip(22, motion=turntable, accel_noise=0, gyro_noise=0, accel_bias=(.05, -.03, .02),
+                 gyro_bias=(1, 2, -3), **options)
+    return init_spi_chips([22], sample_frequency=1000, accel_range=AFS_SEL.FS_2G)[0]
+
+def test_six_position_calibration(rig, tmp_path):
+    turntable = Turntable()
+    chip = faulty_chip(rig, turntable, accel_gain=(1.02, .99, 1.01))
+    profile = calibrate_six_position(chip, seconds=.05, wait=turntable.turn, verify=True)
+    assert profile.method == 'six_position'
+    np.testing.assert_allclose(profile.accel_gain, 1 / np.array([1.02, .99, 1.01]), atol=1e-3)
+    # Most of the bias went into the offset registers
+    accel_offsets, gyro_offsets = chip.read_offset_registers()
+    assert (accel_offsets, gyro_offsets) == (profile.accel_offsets, profile.gyro_offsets)
+    np.testing.assert_allclose(np.array(accel_offsets) * ACCEL_OFFSET_STEP, [-.05, .03, -.02], atol=ACCEL_OFFSET_STEP)
+    np.testing.assert_allclose(np.array(gyro_offsets) * GYRO_OFFSET_STEP, [-1, -2, 3], atol=GYRO_OFFSET_STEP)
+
+    for index, (gravity, description) in enumerate(SIX_POSITIONS):
+        turntable.turn(index, description)
+        np.testing.assert_allclose(mean_reading(chip), list(gravity) + [0, 0, 0], atol=2e-3)
+
+    # Stored, forgotten and applied again
+    store = ProfileStore(str(tmp_path))
+    store.save(profile)
+    chip.write_offset_registers([0] * 3, [0] * 3)
+    chip.set_calibration()
+    assert mean_reading(chip)[5] == pytest.approx(-3, abs=.1)
+    assert vars(store.apply(chip, verify=True)) == vars(profile)
+    np.testing.assert_allclose(mean_reading(chip), list(turntable.gravity) + [0, 0, 0], atol=2e-3)
+
+def assert_level(reading):
+    np.testing.assert_allclose(reading[:3], [0, 0, 1], atol=3e-3)
+    # Without noise a bias in whole counts is off by up to one 2000 deg/s step
+    np.testing.assert_allclose(reading[3:], [0, 0, 0], atol=1 / 16.4)
+
+def test_software_correction_survives_range_changes(rig):
+    turntable = Turntable()
+    chip = faulty_chip(rig, turntable)
+    profile = calibrate_still(chip, seconds=.05, gravity=(0, 0, 1), hardware=False)
+    # The registers are recorded as they were, and left alone
+    assert (profile.accel_offsets, profile.gyro_offsets) == ([0] * 3, [0] * 3)
+    assert chip.read_offset_registers() == ([0] * 3, [0] * 3)
+    for accel_range, gyro_range in [(AFS_SEL.FS_2G, FS_SEL.FS_DEG_2000), (AFS_SEL.FS_16G, FS_SEL.FS_DEG_250)]:
+        chip.set_accel_range(accel_range.value)
+        chip.set_gyro_range(gyro_range.value)
+        assert_level(mean_reading(chip))
+
+    # The same profile applied without the registers on a chip that lost its correction
+    chip.set_calibration()
+    apply_profile(chip, profile, hardware=False)
+    assert_level(mean_reading(chip))
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from icm20689_data import SampleBatch
+from icm20689_filter import ComplementaryFilter, accel_tilt, solve_recurrence
+
+def recurrence_loop(a, b, y0):
+    y = np.empty_like(b)
+    previous = np.asarray(y0, dtype=np.float64)
+    for k in range(len(a)):
+        previous = y[k] = a[k] * previous + b[k]
+    return y
+
+@pytest.mark.parametrize('low', [.999, .9, .5, .01])
+def test_recurrence_matches_loop(low):
+    rng = np.random.default_rng(1)
+    a = rng.uniform(low, 1.0, 5000)
+    b = rng.normal(0, 1, (5000, 2))
+    np.testing.assert_allclose(solve_recurrence(a, b, [3.0, -1.0]), recurrence_loop(a, b, [3.0, -1.0]),
+                               rtol=1e-9, atol=1e-9)
+
+def test_recurrence_without_decay():
+    b = np.ones((10, 1))
+    np.testing.assert_allclose(solve_recurrence(np.ones(10), b, [0.0])[:, 0], np.arange(1, 11))
+
+def complementary_loop(timestamps, samples, time_constant):
+    """The per-sample complementary filter."""
+    tilt = accel_tilt(samples[:, :3])
+    angles = np.array([tilt[0, 0], tilt[0, 1], 0.0])
+    last = timestamps[0]
+    out = []
+    for t, sample, accel_angles in zip(timestamps, samples, tilt):
+        dt = max(t - last, 0.0)
+        last = t
+        alpha = time_constant / (time_constant + dt)
+        angles[:2] = alpha * (angles[:2] + sample[3:5] * dt) + (1 - alpha) * accel_angles
+        angles[2] += sample[5] * dt
+        out.append(angles.copy())
+    return np.array(out)
+
+def swinging_samples(count, rate = 1000.0):
+    rng = np.random.default_rng(2)
+    timestamps = np.arange(count) / rate + rng.uniform(0, 1e-4, count)
+    angle = np.radians(30) * np.sin(np.pi * timestamps)
+    samples = np.zeros((count, 6))
+    samples[:, 1] = 9.80665 * np.sin(angle)
+    samples[:, 2] = 9.80665 * np.cos(angle)
+    samples[:, 3] = 30 * np.pi * np.cos(np.pi * timestamps) + rng.normal(0, .5, count)
+    samples[:, 5] = .1
+    return timestamps, samples
+
+def test_filter_matches_per_sample_loop():
+    timestamps, samples = swinging_samples(4000)
+    np.testing.assert_allclose(ComplementaryFilter(.5).filter(timestamps, samples),
+                               complementary_loop(timestamps, samples, .5), atol=1e-9)
+
+def test_streaming_matches_one_pass():
+    timestamps, samples = swinging_samples(3000)
+    whole = ComplementaryFilter().filter(timestamps, samples)
+    streaming = ComplementaryFilter()
+    parts = [streaming.filter(timestamps[i:i + 137], samples[i:i + 137]) for i in range(0, 3000, 137)]
+    np.testing.assert_allclose(np.concatenate(parts), whole, atol=1e-9)
+    np.testing.assert_allclose(streaming.angles, whole[-1])
+    assert ComplementaryFilter().filter([], np.empty((0, 6))).shape == (0, 3)
+
+def test_tracks_the_swing_and_integrates_yaw():
+    timestamps, samples = swinging_samples(4000)
+    angles = ComplementaryFilter(.5).filter(timestamps, samples)
+    truth = 30 * np.sin(np.pi * timestamps)
+    assert np.abs(angles[:, 0] - truth).max() < 1.0
+    assert angles[-1, 2] == pytest.approx(.1 * (timestamps[-1] - timestamps[0]), rel=1e-6)
+
+def test_update_takes_a_batch():
+    raw = np.tile([0, 4096, 4096, 0, 0, 0], (10, 1)).astype('>i2')
+    batch = SampleBatch(1, 0.0, .001, raw, 9.80665 / 4096, 1.0)
+    angles = ComplementaryFilter().update(batch)
+    np.testing.assert_allclose(angles[:, 0], 45.0)
+    np.testing.assert_allclose(angles[:, 1:], 0.0, atol=1e-12)
@@ -0,0 +1,77 @@
+import pytest
+from icm20689 import AFS_SEL, FS_SEL, ChipConfig, ICM20689Regs, Icm20689I2C, init_spi_chips
+from icm20689_config import sample_rate_divider
+
+@pytest.mark.parametrize('frequency, divider', [(1000, 0), (500, 1), (300, 2), (250, 3), (100, 9), (4, 249),
+                                                (2000, 0), (1, 255)])
+def test_sample_rate_divider(frequency, divider):
+    assert sample_rate_divider(frequency) == divider
+
+def test_config_registers():
+    config = ChipConfig(300, AFS_SEL.FS_4G, FS_SEL.FS_DEG_500.value, dlpf=9)
+    assert config.actual_sample_frequency == pytest.approx(1000 / 3)
+    registers = config.registers()
+    assert registers[ICM20689Regs.SMPLRT_DIV] == 2
+    assert registers[ICM20689Regs.CONFIG] == 1
+    assert registers[ICM20689Regs.GYRO_CONFIG] == 0x08
+    assert registers[ICM20689Regs.ACCEL_CONFIG] == 0x08
+    assert registers[ICM20689Regs.FIFO_EN] == 0x78
+    assert 'sample_frequency=300' in repr(config)
+
+def record_bursts(monkeypatch, sim):
+    """Returns a list that collects (register, length) for each burst written to sim."""
+    bursts = []
+    write_registers = sim.write_registers
+    def record(register, values):
+        bursts.append((register, len(values)))
+        write_registers(register, values)
+    monkeypatch.setattr(sim, 'write_registers', record)
+    return bursts
+
+def test_apply_config_writes_only_changes(rig, monkeypatch):
+    sim = rig.add_chip(22)
+    chip = init_spi_chips([22], sample_frequency=1000, verify=True)[0]
+    bursts = record_bursts(monkeypatch, sim)
+
+    assert chip.apply_config(ChipConfig(1000)) == 0
+    assert bursts == []
+
+    # SMPLRT_DIV through ACCEL_CONFIG are adjacent, FIFO_EN is not
+    assert chip.apply_config(ChipConfig(200, AFS_SEL.FS_2G, FS_SEL.FS_DEG_250, dlpf=2, fifo_enable=0x08)) == 5
+    assert bursts == [(ICM20689Regs.SMPLRT_DIV.value, 4), (ICM20689Regs.FIFO_EN.value, 1)]
+    assert chip.read_sample_frequency() == 200
+    assert chip.read_accel_range() == AFS_SEL.FS_2G
+    assert chip.read_gyro_range() == FS_SEL.FS_DEG_250
+    assert chip.get_sample_frequency() == 200
+    assert chip.get_sample_clock().nominal_period == pytest.approx(.005)
+    assert chip.get_accel_scale() == pytest.approx(chip.GRAVITIY_MS2 / 16384)
+
+    del bursts[:]
+    chip.set_gyro_range(FS_SEL.FS_DEG_500.value)
+    chip.set_sample_frequency(200)
+    assert bursts == [(ICM20689Regs.GYRO_CONFIG.value, 1)]
+    assert chip.get_gyro_scale() == pytest.approx(1 / 65.5)
+
+    # A forgotten cache writes everything again
+    chip.clear_register_cache()
+    assert chip.apply_config(ChipConfig(200)) == 7
+
+def test_verify_reports_ignored_writes(rig, monkeypatch):
+    sim = rig.add_chip(22)
+    chip = init_spi_chips([22], sample_frequency=1000)[0]
+    write_register = sim.write_register
+    monkeypatch.setattr(sim, 'write_register', lambda register, value: None)
+    with pytest.raises(IOError, match='SMPLRT_DIV reads 0x00 after writing 0x01'):
+        chip.apply_config(ChipConfig(500), verify=True)
+
+    # The failed registers are written again
+    monkeypatch.setattr(sim, 'write_register', write_register)
+    assert chip.apply_config(ChipConfig(500), verify=True) == 1
+    assert chip.read_sample_frequency() == 500
+
+def test_i2c_apply_config(rig):
+    rig.add_chip(17)
+    chip = Icm20689I2C(1, 1, 17)
+    assert chip.apply_config(ChipConfig(250, AFS_SEL.FS_4G), verify=True) > 0
+    assert chip.read_accel_range() == AFS_SEL.FS_4G
+    assert chip.read_sample_frequency() == 250
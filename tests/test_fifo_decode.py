@@ -0,0 +1,46 @@
+import struct
+import numpy as np
+import pytest
+from icm20689 import AFS_SEL, FS_SEL, init_spi_chips
+from icm20689_data import decode_fifo_bytes, scale_fifo_data
+
+def decode_per_word(data):
+    """The per-word loop decode_fifo_bytes replaced."""
+    words = [struct.unpack('>h', bytes(data[i:i + 2]))[0] for i in range(0, len(data) - 1, 2)]
+    frames = len(words) // 6
+    return [words[i * 6:i * 6 + 6] for i in range(frames)]
+
+@pytest.mark.parametrize('size', [0, 11, 12, 13, 1200, 4096])
+def test_decode_matches_per_word_reference(size):
+    data = np.random.default_rng(size).integers(0, 256, size, dtype=np.uint8).tobytes()
+    frames = decode_fifo_bytes(data)
+    assert frames.shape == (size // 12, 6)
+    assert frames.tolist() == decode_per_word(data)
+
+def test_decode_accepts_spidev_lists():
+    data = [0x80, 0x00, 0x7f, 0xff, 0xff, 0xfe, 0, 1, 0, 2, 0, 3]
+    assert decode_fifo_bytes(data).tolist() == [[-32768, 32767, -2, 1, 2, 3]]
+
+def test_scale_matches_per_sample_division():
+    frames = decode_fifo_bytes(np.random.default_rng(1).integers(0, 256, 240, dtype=np.uint8).tobytes())
+    accel_lsb = AFS_SEL.FS_8G.get_lsb_sensitivity() / 9.80665
+    gyro_lsb = FS_SEL.FS_DEG_2000.get_lsb_sensitivity()
+    expected = [[value / accel_lsb for value in row[:3]] + [value / gyro_lsb for value in row[3:]]
+                for row in frames.tolist()]
+    np.testing.assert_allclose(scale_fifo_data(frames, 1 / accel_lsb, 1 / gyro_lsb), expected, rtol=1e-12)
+
+def test_read_fifo_from_simulated_chip(rig, clock):
+    rig.add_chip(22, accel_noise=0, gyro_noise=0, clock=clock)
+    chip = init_spi_chips([22], sample_frequency=1000)[0]
+    chip.enable_fifo()
+    chip.read_fifo_batch()
+    clock.advance(.1)
+
+    batch = chip.read_fifo_batch()
+    assert len(batch) == 100
+    np.testing.assert_allclose(batch.to_array().mean(axis=0), [0, 0, 9.80665, 0, 0, 0], atol=2e-3)
+
+    clock.advance(.01)
+    points = chip.read_fifo_data()
+    assert len(points) == 10
+    assert points[0]._accel_data.z_val == pytest.approx(9.80665, abs=2e-3)
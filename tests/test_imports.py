@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def loaded_modules(statement, names):
+    """Runs statement in a fresh interpreter and returns which of names it loaded."""
+    code = "import sys\n%s\nprint(' '.join(name for name in %r if name in sys.modules))" % (statement, names)
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+HEAVY = ('spidev', 'smbus', 'RPi', 'RPi.GPIO', 'socket', 'icm20689_net', 'http.server', 'socketserver',
+         'matplotlib')
+
+@pytest.mark.parametrize('module', ['icm20689', 'icm20689_data', 'icm20689_record', 'icm20689_filter'])
+def test_import_loads_no_hardware_or_transport(module):
+    assert loaded_modules('import %s' % module, HEAVY) == []
+
+@pytest.mark.parametrize('module', ['icm20689_net', 'icm20689_receiver', 'icm20689_align'])
+def test_threads_do_not_import_the_driver(module):
+    # Running icm20689.py as a script would otherwise load a second copy of it
+    assert loaded_modules('import %s' % module, ('icm20689',)) == []
+
+def test_transport_names_load_on_first_use():
+    assert loaded_modules('import icm20689\nicm20689.UdpNetworkSenderThread', HEAVY) == ['socket', 'icm20689_net']
+
+def test_plot_scripts_import_matplotlib_lazily():
+    statement = "sys.path.insert(0, 'visualizing')\nimport seeRawData"
+    assert 'matplotlib' not in loaded_modules(statement, HEAVY)
+
+def test_metrics_server_loads_http_on_start():
+    statement = "import icm20689_metrics\nicm20689_metrics._get_server_classes()"
+    assert loaded_modules('import icm20689_metrics', HEAVY) == []
+    assert set(loaded_modules(statement, HEAVY)) >= {'http.server', 'socketserver'}
+
+def test_unknown_attribute():
+    import icm20689
+    with pytest.raises(AttributeError):
+        icm20689.NoSuchThread
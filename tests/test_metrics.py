@@ -0,0 +1,101 @@
+import io
+import json
+import socket
+import time
+import urllib.request
+import numpy as np
+import pytest
+from icm20689 import init_spi_chips
+from icm20689_metrics import METRICS, Histogram, MetricsDumpThread, MetricsRegistry, MetricsServer
+
+def test_same_name_and_labels_is_the_same_metric():
+    registry = MetricsRegistry()
+    assert registry.counter('packets', chip=1) is registry.counter('packets', chip=1)
+    assert registry.counter('packets', chip=1) is not registry.counter('packets', chip=2)
+    with pytest.raises(TypeError):
+        registry.gauge('packets', chip=1)
+
+def test_histogram_percentiles_within_a_bucket():
+    values = np.random.default_rng(0).integers(0, 10 ** 7, 20000)
+    histogram = Histogram()
+    for value in values:
+        histogram.record(value)
+    for percent in (50, 90, 99, 99.9):
+        expected = np.percentile(values, percent)
+        assert histogram.percentile(percent) == pytest.approx(expected, rel=1.0 / Histogram.SUB_BUCKETS)
+    assert (histogram.min, histogram.max, histogram.count) == (values.min(), values.max(), len(values))
+
+    small = Histogram()
+    for value in (-5, 0, 3, 3, 31):
+        small.record(value)
+    assert [small.percentile(percent) for percent in (20, 40, 80, 100)] == [0, 0, 3, 31]
+
+def test_snapshot_and_text():
+    registry = MetricsRegistry()
+    registry.counter('sent', transport='udp').inc(3)
+    gauge = registry.gauge('depth')
+    gauge.set(5)
+    gauge.set(2)
+    registry.histogram('decode_ns').record(100)
+
+    snapshot = registry.snapshot()
+    assert snapshot['counters'] == {'sent{transport=udp}': 3}
+    assert snapshot['gauges'] == {'depth': {'value': 2, 'max': 5}}
+    assert snapshot['histograms']['decode_ns']['p50'] == 100
+
+    lines = registry.to_text().splitlines()
+    assert 'sent{transport="udp"} 3' in lines
+    assert 'depth 2' in lines and 'depth_max 5' in lines
+    assert 'decode_ns{quantile="0.99"} 100' in lines and 'decode_ns_count 1' in lines
+
+def test_http_server():
+    registry = MetricsRegistry()
+    registry.counter('sent').inc(7)
+    server = MetricsServer(('127.0.0.1', 0), registry).start()
+    try:
+        url = 'http://%s:%d' % server.address
+        with urllib.request.urlopen(url + '/metrics', timeout=5) as response:
+            assert b'sent 7' in response.read()
+        with urllib.request.urlopen(url + '/metrics.json', timeout=5) as response:
+            assert json.load(response)['counters'] == {'sent': 7}
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + '/other', timeout=5)
+    finally:
+        server.stop()
+
+def test_unix_socket_server(tmp_path):
+    registry = MetricsRegistry()
+    registry.counter('sent').inc(2)
+    path = str(tmp_path / 'metrics.sock')
+    server = MetricsServer(path, registry).start()
+    try:
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(path)
+            data = sock.makefile().readline()
+        assert json.loads(data)['counters'] == {'sent': 2}
+    finally:
+        server.stop()
+
+def test_dump_thread():
+    registry = MetricsRegistry()
+    registry.counter('sent').inc()
+    stream = io.StringIO()
+    thread = MetricsDumpThread(.01, stream, registry)
+    thread.start()
+    time.sleep(.1)
+    thread.stop()
+    thread.join(1)
+    lines = stream.getvalue().splitlines()
+    assert len(lines) >= 2
+    assert json.loads(lines[0])['counters'] == {'sent': 1}
+
+def test_fifo_reads_are_counted(rig, clock):
+    rig.add_chip(22, clock=clock)
+    chip = init_spi_chips([22], sample_frequency=1000, first_id=77)[0]
+    chip.enable_fifo()
+    samples = METRICS.counter('fifo_samples', chip=77).value
+    clock.advance(.0205)
+    chip.read_fifo_batch()
+    assert METRICS.counter('fifo_samples', chip=77).value == samples + 20
+    assert METRICS.gauge('fifo_fill_bytes', chip=77).value == 240
+    assert METRICS.histogram('decode_ns', chip=77).count >= 1
@@ -0,0 +1,145 @@
+import functools
+import time
+from queue import Empty, Full
+import numpy as np
+import pytest
+from icm20689 import init_spi_chips
+from icm20689_data import SampleBatch, SampleScale
+from icm20689_mp import AcquisitionProcess, InterruptableProcess, MergedRingReader, SharedSampleRing
+from icm20689_sim import SimulatedRig
+
+@pytest.fixture
+def make_ring():
+    rings = []
+    def make(**options):
+        rings.append(SharedSampleRing(**options))
+        return rings[-1]
+    yield make
+    for ring in rings:
+        ring.close()
+        ring.unlink()
+
+def drain(reader):
+    batches = []
+    while not reader.empty():
+        batches.append(reader.get(timeout=1))
+    return batches
+
+def test_round_trip_splits_large_batches(make_ring):
+    ring = make_ring(slots=8, slot_samples=10)
+    reader = ring.subscribe()
+    raw = np.arange(25 * 6, dtype='>i2').reshape(25, 6)
+    ring.put(SampleBatch(4, 2.0, .001, raw, .5, .25))
+    parts = drain(reader)
+    assert [len(part) for part in parts] == [10, 10, 5]
+    assert [part.timestamp for part in parts] == pytest.approx([2.0, 2.01, 2.02])
+    whole = SampleBatch.concatenate(parts)
+    np.testing.assert_array_equal(whole.raw, raw)
+    assert (whole.chip_id, whole.sample_period, whole.accel_scale, whole.gyro_scale) == (4, .001, .5, .25)
+    assert not whole.calibrated
+    with pytest.raises(Empty):
+        reader.get(timeout=.01)
+    reader.close()
+
+def test_calibration_crosses_the_ring(make_ring, make_batch):
+    ring = make_ring(slots=4, slot_samples=20)
+    reader = ring.subscribe()
+    scale = SampleScale(.5, .25, bias=(1, 2, 3, 4, 5, 6), gain=(1.1, 1, .9, 1, 1, 1))
+    sent = make_batch(1, 7, 15, accel_scale=.5, gyro_scale=.25, scale=scale)
+    ring.put(sent)
+    got = reader.get(timeout=1)
+    assert got.calibrated
+    np.testing.assert_allclose(got.to_array(), sent.to_array())
+    np.testing.assert_allclose(got.to_array(('g', 'rad/s')), sent.to_array(('g', 'rad/s')))
+
+def test_readers_see_batches_from_their_subscription(make_ring, make_batch):
+    ring = make_ring(slots=8, slot_samples=20)
+    first = ring.subscribe()
+    ring.put(make_batch(1, 1, 15))
+    second = ring.subscribe()
+    ring.put(make_batch(1, 2, 15))
+    assert [int(b.raw[0, 0]) for b in drain(first)] == [1, 2]
+    assert [int(b.raw[0, 0]) for b in drain(second)] == [2]
+
+    first.close()
+    second.close()
+    readers = [ring.subscribe() for i in range(8)]
+    with pytest.raises(RuntimeError):
+        ring.subscribe()
+    readers[0].close()
+    ring.subscribe()
+
+def test_overwrite_drops_the_oldest_slots(make_ring, make_batch):
+    ring = make_ring(slots=4, slot_samples=10)
+    reader = ring.subscribe()
+    for value in range(6):
+        ring.put(make_batch(1, value, 15))
+    got = drain(reader)
+    # 12 slots written, the reader keeps the last slots - 1
+    assert [(len(b), int(b.raw[0, 0])) for b in got] == [(5, 14), (10, 5), (5, 15)]
+    assert reader.dropped == 9
+
+def test_block_raises_full_for_a_slow_reader(make_ring, make_batch):
+    ring = make_ring(slots=4, slot_samples=10, overflow='block')
+    reader = ring.subscribe()
+    ring.put(make_batch(1, 1, 30))
+    with pytest.raises(Full):
+        ring.put(make_batch(1, 2, 20), timeout=.01)
+    assert ring.dropped == 20
+    assert len(SampleBatch.concatenate(drain(reader))) == 30
+    ring.put(make_batch(1, 3, 30), block=False)
+
+    with pytest.raises(ValueError):
+        SharedSampleRing(overflow='drop')
+
+def test_merged_reader_takes_turns(make_ring, make_batch):
+    rings = [make_ring(slots=8, slot_samples=20, name=name) for name in 'ab']
+    merged = MergedRingReader([ring.subscribe() for ring in rings])
+    for value in range(3):
+        rings[0].put(make_batch(1, value, 15))
+    rings[1].put(make_batch(2, 9, 15))
+    assert merged.qsize() == 4
+    assert [b.chip_id for b in drain(merged)] == [1, 2, 1, 1]
+    with pytest.raises(Empty):
+        merged.get(block=False)
+    merged.close()
+
+def test_process_base_is_abstract():
+    with pytest.raises(TypeError):
+        InterruptableProcess()
+
+def sim_chips(pins, first_id):
+    rig = SimulatedRig()
+    for pin in pins:
+        rig.add_chip(pin, seed=pin)
+    rig.install()
+    return init_spi_chips(pins, sample_frequency=1000, first_id=first_id)
+
+def test_acquisition_process_fills_the_ring(make_ring):
+    ring = make_ring()
+    reader = ring.subscribe()
+    process = AcquisitionProcess(ring, functools.partial(sim_chips, [22, 23], 1))
+    process.start()
+    counts = {}
+    deadline = time.monotonic() + 10
+    while min(counts.get(1, 0), counts.get(2, 0)) < 200 and time.monotonic() < deadline:
+        try:
+            got = reader.get(timeout=.1)
+        except Empty:
+            continue
+        counts[got.chip_id] = counts.get(got.chip_id, 0) + len(got)
+    process.stop()
+    process.join(5)
+    assert process.exitcode == 0
+    assert min(counts.values()) >= 200 and set(counts) == {1, 2}
+
+def test_acquisition_process_closes_the_ring_on_failure(make_ring, monkeypatch):
+    ring = make_ring()
+    closed = []
+    monkeypatch.setattr(ring, 'close', lambda: closed.append(ring))
+
+    def make_chips():
+        raise OSError('no bus')
+    with pytest.raises(OSError):
+        AcquisitionProcess(ring, make_chips)._run()
+    assert closed == [ring]
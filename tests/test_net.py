@@ -0,0 +1,65 @@
+import time
+from queue import Empty, Queue
+import numpy as np
+import pytest
+from icm20689_data import MpuDataPacket, SampleScale
+from icm20689_net import PacketBatcher, UdpNetworkSenderThread
+from icm20689_receiver import UdpPacketReceiver
+
+@pytest.mark.parametrize('calibrated', [False, True])
+def test_packets_fit_max_bytes_and_keep_every_sample(calibrated, make_batch):
+    scale = SampleScale(1.0, 1.0, bias=(1, 0, 0, 0, 0, 0)) if calibrated else None
+    batcher = PacketBatcher(max_bytes=500)
+    data = [make_batch(1, 0, 300, scale=scale), make_batch(2, 0, 7, scale=scale), make_batch(1, 300, 45, scale=scale)]
+    packets = batcher.make_packets(data)
+
+    assert [packet.sequence for packet in packets] == list(range(len(packets)))
+    for packet in packets:
+        assert packet.packed_size() <= 500
+        # Every packet but the last is filled up to within one frame or block
+        assert packet is packets[-1] or packet.packed_size() > 500 - MpuDataPacket.block_header_size(data[0]) - 12
+    decoded = [MpuDataPacket.deserialize(packet.serialize()).data for packet in packets]
+    for chip_id, expected in ((1, 345), (2, 7)):
+        raw = np.concatenate([batch.raw[:, 0] for blocks in decoded for batch in blocks if batch.chip_id == chip_id])
+        np.testing.assert_array_equal(raw, np.arange(expected))
+
+def test_max_bytes_must_hold_a_sample():
+    with pytest.raises(ValueError):
+        PacketBatcher(max_bytes=50)
+
+def test_collect_returns_on_size_or_deadline(make_batch):
+    batcher = PacketBatcher(max_bytes=1000, max_latency=.05)
+    queue = Queue()
+    for first in range(0, 200, 10):
+        queue.put(make_batch(1, first, 10))
+    start = time.monotonic()
+    data = batcher.collect(queue)
+    assert time.monotonic() - start < .05
+    size = MpuDataPacket.HEADER.size + sum(map(batcher.block_size, data))
+    assert 1000 <= size < 1000 + batcher.block_size(data[0])
+
+    queue = Queue()
+    queue.put(make_batch(1, 0, 1))
+    start = time.monotonic()
+    assert len(batcher.collect(queue)) == 1
+    assert time.monotonic() - start >= .04
+    with pytest.raises(Empty):
+        batcher.collect(queue, timeout=.01)
+
+def test_udp_sender_reaches_receiver(make_batch):
+    queue = Queue()
+    with UdpPacketReceiver('127.0.0.1', 0) as receiver:
+        sender = UdpNetworkSenderThread(queue, *receiver.getsockname(), max_bytes=600, max_latency=.001)
+        sender.start()
+        try:
+            for first in range(0, 1000, 100):
+                queue.put(make_batch(1, first, 100))
+            deadline = time.monotonic() + 5
+            while receiver.stats.samples < 1000 and time.monotonic() < deadline:
+                receiver.poll(.1)
+        finally:
+            sender.stop()
+            sender.join(2)
+
+    assert receiver.stats.dropped == 0
+    np.testing.assert_array_equal(receiver.streams[1].samples[:, 0], np.arange(1000))
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from icm20689_data import MpuDataPacket, SampleScale
+
+def assert_same_batch(decoded, batch):
+    assert decoded.chip_id == batch.chip_id
+    assert decoded.timestamp == batch.timestamp
+    assert decoded.sample_period == batch.sample_period
+    assert (decoded.accel_scale, decoded.gyro_scale) == (batch.accel_scale, batch.gyro_scale)
+    np.testing.assert_array_equal(decoded.raw, batch.raw)
+    np.testing.assert_array_equal(decoded.to_array(), batch.to_array())
+
+def test_round_trip(make_batch):
+    batches = [make_batch(1, 0, 20, 'random'), make_batch(2, 0, 0, 'random'), make_batch(3, 1, 341, 'random')]
+    packet = MpuDataPacket(batches, sequence=(1 << 32) + 7)
+    data = packet.serialize()
+    assert len(data) == packet.packed_size()
+
+    decoded = MpuDataPacket.deserialize(bytes(data))
+    assert decoded.sequence == 7
+    assert len(decoded.data) == 3
+    for got, batch in zip(decoded.data, batches):
+        assert_same_batch(got, batch)
+        assert not got.calibrated
+
+def test_calibrated_round_trip(make_batch):
+    scale = SampleScale(.0024, .061, bias=(10, -20, 30, 1, 2, 3), gain=(1.02, .99, 1.01, 1, 1, 1))
+    batch = make_batch(1, 0, 50, 'random', accel_scale=.0024, gyro_scale=.061, scale=scale)
+    packet = MpuDataPacket([batch, make_batch(2, 0, 5, 'random')])
+    data = packet.serialize()
+    assert len(data) == packet.packed_size()
+
+    calibrated, plain = MpuDataPacket.deserialize(data).data
+    assert calibrated.calibrated and not plain.calibrated
+    assert_same_batch(calibrated, batch)
+    np.testing.assert_allclose(calibrated.scale.bias, scale.bias)
+    np.testing.assert_allclose(calibrated.to_array(('g', 'rad/s')), batch.to_array(('g', 'rad/s')))
+
+def test_version_1_still_decodes(make_batch):
+    batch = make_batch(4, 0, 3, 'random')
+    data = (MpuDataPacket.HEADER.pack(MpuDataPacket.MAGIC, 1, 0, 1, 9) +
+            MpuDataPacket.BLOCK_HEADER_V1.pack(4, 3, batch.timestamp, .001, 1.0, 1.0) + batch.raw.tobytes())
+    decoded = MpuDataPacket.deserialize(data)
+    assert decoded.sequence == 9
+    assert_same_batch(decoded.data[0], batch)
+
+def test_serialize_into_offset(make_batch):
+    packet = MpuDataPacket([make_batch(1, 0, 10, 'random')])
+    buffer = bytearray(8 + packet.packed_size())
+    assert packet.serialize_into(buffer, 8) == packet.packed_size()
+    assert buffer[8:] == packet.serialize()
+
+@pytest.mark.parametrize('cut', [1, 12, 30])
+def test_truncated_packets_raise(cut, make_batch):
+    data = MpuDataPacket([make_batch(1, 0, 2, 'random')]).serialize()
+    with pytest.raises(ValueError):
+        MpuDataPacket.deserialize(data[:-cut])
+
+def test_bad_header_raises(make_batch):
+    data = MpuDataPacket([make_batch(1, 0, 2, 'random')]).serialize()
+    with pytest.raises(ValueError):
+        MpuDataPacket.deserialize(b'XXXX' + data[4:])
+    data[4] = 99
+    with pytest.raises(ValueError):
+        MpuDataPacket.deserialize(data)
+
+def test_points_use_the_legacy_format(make_batch):
+    batch = make_batch(1, 0, 3, 'random')
+    packet = MpuDataPacket(batch.to_points())
+    assert packet.is_legacy()
+    data = packet.serialize()
+    assert len(data) == packet.packed_size() == 4 + 3 * 52
+    assert data[4:] == batch.serialize()
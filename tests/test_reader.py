@@ -0,0 +1,85 @@
+import os
+import numpy as np
+import pytest
+from icm20689_record import RecordingReader, RecordingWriter, open_session
+
+@pytest.fixture
+def recording(tmp_path, make_batch):
+    """Chip 1 with 3000 samples in blocks of 100, chip 2 with 300, over several segments."""
+    writer = RecordingWriter(str(tmp_path), max_bytes=20000)
+    for first in range(0, 3000, 100):
+        writer.write(make_batch(1, first, 100))
+        if first % 1000 == 0:
+            writer.write(make_batch(2, first // 10, 100))
+    writer.close()
+    reader = RecordingReader(writer.paths)
+    yield reader
+    reader.close()
+
+@pytest.mark.parametrize('start, end', [(None, None), (.25, .75), (.2505, .2515), (1.0, None), (None, .0005),
+                                        (5.0, 6.0)])
+def test_time_range_reads(recording, start, end):
+    timestamps, samples = recording.read(1, start, end)
+    expected = np.arange(3000)
+    if start is not None:
+        expected = expected[expected * .001 >= start - 1e-9]
+    if end is not None:
+        expected = expected[expected * .001 < end - 1e-9]
+    np.testing.assert_array_equal(samples[:, 0], expected)
+    np.testing.assert_allclose(timestamps, expected * .001)
+
+def test_time_range_and_counts(recording):
+    assert len(recording.headers) > 1
+    assert recording.time_range() == pytest.approx((0.0, 2.999))
+    assert recording.time_range(2) == pytest.approx((0.0, .299))
+    assert recording.time_range(3) is None
+    assert recording.sample_count(2) == 300
+    assert recording.read(3)[1].shape == (0, 6)
+
+def test_iter_chunks(recording):
+    chunks = list(recording.iter_chunks(1, chunk_samples=250, start=.5))
+    assert [len(timestamps) for timestamps, samples in chunks] == [300] * 8 + [100]
+    np.testing.assert_array_equal(np.concatenate([samples[:, 0] for _, samples in chunks]), np.arange(500, 3000))
+
+def test_batches_are_read_only_views(recording):
+    batch = next(recording.batches(1))
+    assert not batch.raw.flags.writeable
+    with pytest.raises(ValueError):
+        batch.raw[0, 0] = 1
+
+def test_open_session_picks_the_latest(tmp_path, make_batch):
+    for session, chip_id in (('20250101_000000', 1), ('20250102_000000', 2)):
+        writer = RecordingWriter(str(tmp_path))
+        writer._session = session
+        writer.write(make_batch(chip_id, 0, 10))
+        writer.close()
+    with open_session(str(tmp_path)) as reader:
+        assert reader.chips == [2]
+    with open_session(str(tmp_path), session='20250101_000000') as reader:
+        assert reader.chips == [1]
+    with pytest.raises(FileNotFoundError):
+        open_session(str(tmp_path), session='20250103_000000')
+    with pytest.raises(FileNotFoundError):
+        open_session(str(tmp_path), prefix='other')
+
+def test_writers_started_in_the_same_second_keep_their_files(tmp_path, make_batch):
+    writers = [RecordingWriter(str(tmp_path)) for chip_id in (1, 2, 3)]
+    for chip_id, writer in enumerate(writers, 1):
+        writer._session = '20250101_000000'
+        writer.write(make_batch(chip_id, 0, 10))
+        writer.close()
+    assert [writer._session for writer in writers] == ['20250101_000000', '20250101_000000-1', '20250101_000000-2']
+    for chip_id, writer in enumerate(writers, 1):
+        with open_session(str(tmp_path), session=writer._session) as reader:
+            assert reader.chips == [chip_id]
+
+def test_live_session_with_a_new_segment(tmp_path, make_batch):
+    writer = RecordingWriter(str(tmp_path), max_bytes=2000)
+    for first in range(0, 500, 100):
+        writer.write(make_batch(1, first, 100))
+    writer.flush()
+    # The writer has just created the next segment but written nothing to it
+    open(os.path.join(str(tmp_path), 'imu_%s_099.icmr' % writer._session), 'wb').close()
+    with open_session(str(tmp_path)) as reader:
+        assert reader.sample_count(1) == 500
+    writer.close()
@@ -0,0 +1,75 @@
+import socket
+import threading
+import numpy as np
+from icm20689_data import MpuDataPacket
+from icm20689_receiver import ChipStream, UdpPacketReceiver
+
+def test_stream_keeps_at_most_max_samples(make_batch):
+    stream = ChipStream(1, capacity=4, max_samples=100)
+    for first in range(0, 250, 10):
+        stream.append(make_batch(1, first, 10))
+    assert len(stream) == 100
+    assert stream.discarded == 150
+    np.testing.assert_array_equal(stream.samples[:, 0], np.arange(150, 250))
+    np.testing.assert_allclose(stream.timestamps, np.arange(150, 250) * .001)
+
+    stream.append(make_batch(1, 250, 300))
+    assert stream.discarded == 450
+    timestamps, samples = stream.take()
+    np.testing.assert_array_equal(samples[:, 0], np.arange(450, 550))
+    assert len(stream) == 0
+
+def test_take_while_appending(make_batch):
+    stream = ChipStream(1, capacity=16)
+    total = 20000
+
+    def produce():
+        for first in range(0, total, 50):
+            stream.append(make_batch(1, first, 50))
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    taken = []
+    while producer.is_alive() or len(stream):
+        taken.append(stream.take()[1][:, 0])
+    producer.join()
+    taken.append(stream.take()[1][:, 0])
+    np.testing.assert_array_equal(np.concatenate(taken), np.arange(total))
+
+def test_sequence_accounting(make_batch):
+    receiver = UdpPacketReceiver()
+    addr = ('10.0.0.2', 1025)
+    for sequence in (0, 1, 4, 2, 2, 3, 3, 5, 1):
+        receiver._decode(MpuDataPacket([make_batch(1, sequence, 1)], sequence).serialize(), addr)
+    assert receiver.stats.packets == 9
+    assert receiver.stats.reordered == 2
+    assert receiver.stats.duplicates == 3
+    assert receiver.stats.dropped == 0
+
+    # Another sender has its own sequence, and a restart is not a drop
+    receiver._decode(MpuDataPacket([make_batch(2, 0, 1)], 100).serialize(), ('10.0.0.3', 1025))
+    receiver._decode(MpuDataPacket([make_batch(1, 0, 1)], 0x90000000).serialize(), addr)
+    assert receiver.stats.dropped == 0
+    receiver._decode(MpuDataPacket([make_batch(1, 0, 1)], 0x90000002).serialize(), addr)
+    assert receiver.stats.dropped == 1
+
+    receiver._decode(b'not a packet', addr)
+    assert receiver.stats.invalid == 1
+
+def test_receives_over_udp(make_batch):
+    with UdpPacketReceiver('127.0.0.1', 0, slots=4) as receiver:
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for sequence in range(0, 10):
+                packet = MpuDataPacket([make_batch(1, sequence * 10, 10), make_batch(2, sequence, 1)], sequence)
+                sender.sendto(packet.serialize(), receiver.getsockname())
+            received = 0
+            while received < 10 and receiver.poll(1.0):
+                received = receiver.stats.packets
+        finally:
+            sender.close()
+
+    assert receiver.stats.packets == 10
+    assert receiver.stats.dropped == 0
+    np.testing.assert_array_equal(receiver.streams[1].samples[:, 0], np.arange(100))
+    assert len(receiver.streams[2]) == 10
@@ -0,0 +1,95 @@
+from pathlib import Path
+from queue import Queue
+import numpy as np
+import pytest
+from icm20689 import Write2FileThread, init_spi_chips
+from icm20689_data import SampleBatch, SampleScale
+from icm20689_record import FILE_HEADER, RecordingReader, RecordingWriter
+
+def write(directory, batches, **options):
+    with RecordingWriter(str(directory), chips=[{'chip_id': 1}, {'chip_id': 2}], **options) as writer:
+        for batch in batches:
+            writer.write(batch)
+    return writer.paths
+
+def test_round_trip(tmp_path, make_batch):
+    batches = [make_batch(chip_id, first, 100, 'random') for first in range(0, 1000, 100) for chip_id in (1, 2)]
+    paths = write(tmp_path, batches)
+    assert len(paths) == 1
+
+    with RecordingReader(paths) as reader:
+        assert reader.chips == [1, 2]
+        assert reader.chip_config(2) == {'chip_id': 2}
+        assert reader.sample_count(1) == 1000
+        assert reader.time_range(1) == pytest.approx((0.0, .999))
+        for chip_id in (1, 2):
+            expected = [batch for batch in batches if batch.chip_id == chip_id]
+            timestamps, samples = reader.read(chip_id)
+            np.testing.assert_array_equal(samples, SampleBatch.concatenate(expected).to_array())
+            np.testing.assert_allclose(timestamps, np.arange(1000) * .001)
+            _, raw = reader.read(chip_id, scaled=False)
+            assert raw.dtype == np.int16
+            np.testing.assert_array_equal(raw, np.concatenate([batch.raw for batch in expected]))
+
+def test_calibration_round_trip(tmp_path, make_batch):
+    scale = SampleScale(.0024, .061, bias=(10, -20, 30, 1, 2, 3), gain=(1.02, .99, 1.01, 1, 1, 1))
+    batch = make_batch(1, 0, 50, 'random', accel_scale=.0024, gyro_scale=.061, scale=scale)
+    paths = write(tmp_path, [batch, make_batch(2, 0, 5, 'random')])
+    with RecordingReader(paths) as reader:
+        calibrated, = reader.batches(1)
+        plain, = reader.batches(2)
+        assert calibrated.calibrated and not plain.calibrated
+        np.testing.assert_array_equal(calibrated.to_array(), batch.to_array())
+        np.testing.assert_array_equal(reader.read(1)[1], batch.to_array())
+
+def test_segments_rotate_by_size(tmp_path, make_batch):
+    batches = [make_batch(1, first, 100, 'random') for first in range(0, 2000, 100)]
+    paths = write(tmp_path, batches, max_bytes=5000)
+    assert len(paths) > 3
+    with RecordingReader(reversed(paths)) as reader:
+        np.testing.assert_array_equal(reader.read(1, scaled=False)[1],
+                                      np.concatenate([batch.raw for batch in batches]))
+
+def test_unclosed_file_is_indexed_by_its_blocks(tmp_path, make_batch):
+    writer = RecordingWriter(str(tmp_path))
+    for first in range(0, 300, 100):
+        writer.write(make_batch(1, first, 100, 'random'))
+    writer.flush()
+    with RecordingReader(writer.path) as reader:
+        assert reader.sample_count(1) == 300
+    writer.close()
+
+def test_rejects_other_files(tmp_path, make_batch):
+    path = tmp_path / 'other.icmr'
+    path.write_bytes(b'not a recording at all')
+    with pytest.raises(ValueError):
+        RecordingReader(str(path))
+
+    paths = write(tmp_path, [make_batch(1, 0, 10, 'random')])
+    data = bytearray(Path(paths[0]).read_bytes())
+    FILE_HEADER.pack_into(data, 0, b'ICMR', 99, 0, FILE_HEADER.unpack_from(data)[3])
+    path.write_bytes(bytes(data))
+    with pytest.raises(ValueError):
+        RecordingReader(str(path))
+
+def test_version_1_files_still_read(tmp_path, make_batch):
+    batch = make_batch(1, 0, 10, 'random')
+    paths = write(tmp_path, [batch])
+    data = bytearray(Path(paths[0]).read_bytes())
+    FILE_HEADER.pack_into(data, 0, b'ICMR', 1, 0, FILE_HEADER.unpack_from(data)[3])
+    Path(paths[0]).write_bytes(bytes(data))
+    with RecordingReader(paths) as reader:
+        np.testing.assert_array_equal(reader.read(1)[1], batch.to_array())
+
+def test_write_thread_records_the_queue(rig, tmp_path, make_batch):
+    rig.add_chip(22)
+    chips = init_spi_chips([22], sample_frequency=1000)
+    queue = Queue()
+    for first in range(0, 500, 100):
+        queue.put(make_batch(1, first, 100, 'random'))
+    thread = Write2FileThread(queue, str(tmp_path), chips=chips, duration=.2)
+    thread.start()
+    thread.join(5)
+    with RecordingReader(thread.paths) as reader:
+        assert reader.sample_count(1) == 500
+        assert reader.chip_config(1)['sample_frequency'] == 1000
@@ -0,0 +1,46 @@
+import struct
+import numpy as np
+import pytest
+from icm20689 import Icm20689I2C, init_spi_chips
+from icm20689_regs import ICM20689Regs
+
+def motion(times):
+    accel = np.tile([.5, -.25, 1.0], (len(times), 1))
+    gyro = np.tile([10.0, -20.0, 30.0], (len(times), 1))
+    return accel, gyro
+
+def test_snapshot_is_one_burst(rig, clock):
+    rig.add_chip(22, motion=motion, accel_noise=0, gyro_noise=0, clock=clock)
+    chip = init_spi_chips([22], sample_frequency=1000)[0]
+    clock.advance(.01)
+    transfers = chip._bus.transfers
+
+    data = chip.get_all_data()
+    assert chip._bus.transfers == transfers + 1
+    assert [data['ax'], data['ay'], data['az']] == pytest.approx(np.array([.5, -.25, 1.0]) * 9.80665, abs=.01)
+    assert [data['gx'], data['gy'], data['gz']] == pytest.approx([10, -20, 30], abs=.1)
+    assert data['temp'] == pytest.approx(chip.get_temp()['temp'])
+
+    assert list(chip.get_accel_data(g=True).values()) == pytest.approx([.5, -.25, 1.0], abs=1e-3)
+    assert list(chip.get_gyro_data().values()) == pytest.approx([10, -20, 30], abs=.1)
+    assert chip._bus.transfers == transfers + 4
+
+def test_word_reads_are_signed(rig, clock):
+    rig.add_chip(22, motion=motion, accel_noise=0, gyro_noise=0, clock=clock)
+    chip = init_spi_chips([22], sample_frequency=1000)[0]
+    clock.advance(.01)
+    lsb = chip.GRAVITIY_MS2 / chip.get_accel_scale()
+    assert chip.read_word_data(ICM20689Regs.ACCEL_YOUT_H, ICM20689Regs.ACCEL_YOUT_L) == round(-.25 * lsb)
+    # Registers that are not adjacent are read one at a time
+    high = chip.read_byte_data(ICM20689Regs.ACCEL_YOUT_H)
+    low = chip.read_byte_data(ICM20689Regs.ACCEL_ZOUT_L)
+    expected = struct.unpack('>h', bytes([high, low]))[0]
+    assert expected < 0
+    assert chip.read_word_data(ICM20689Regs.ACCEL_YOUT_H, ICM20689Regs.ACCEL_ZOUT_L) == expected
+
+def test_i2c_reads_match(rig, clock):
+    rig.add_chip(22, motion=motion, accel_noise=0, gyro_noise=0, clock=clock)
+    chip = Icm20689I2C(1, 1, 22)
+    clock.advance(.01)
+    data = chip.get_all_data()
+    assert [data['gx'], data['gy'], data['gz']] == pytest.approx([10, -20, 30], abs=.1)
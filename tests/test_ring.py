@@ -0,0 +1,65 @@
+import threading
+from queue import Empty, Full
+import numpy as np
+import pytest
+from icm20689 import SampleRingBuffer
+from icm20689_data import SampleScale
+
+def test_every_reader_sees_every_batch(make_batch):
+    ring = SampleRingBuffer(slots=8, slot_samples=4)
+    readers = [ring.subscribe(), ring.subscribe()]
+    ring.put(make_batch(1, 0, 10))
+    for reader in readers:
+        assert reader.qsize() == 3
+        parts = [reader.get(block=False) for _ in range(3)]
+        assert [len(part) for part in parts] == [4, 4, 2]
+        assert [part.timestamp for part in parts] == pytest.approx([0, .004, .008])
+        np.testing.assert_array_equal(np.concatenate([part.raw[:, 0] for part in parts]), np.arange(10))
+        assert reader.empty()
+        with pytest.raises(Empty):
+            reader.get(timeout=.01)
+
+def test_overwrite_skips_a_slow_reader_ahead(make_batch):
+    ring = SampleRingBuffer(slots=4, slot_samples=4)
+    reader = ring.subscribe()
+    for first in range(0, 40, 4):
+        ring.put(make_batch(1, first, 4))
+    batch = reader.get()
+    assert batch.raw[0, 0] == 32
+    assert reader.dropped == 8
+    # The view survives the next put
+    ring.put(make_batch(1, 40, 4))
+    assert batch.raw[0, 0] == 32
+    assert [reader.get().raw[0, 0] for _ in range(2)] == [36, 40]
+
+    with pytest.raises(ValueError):
+        SampleRingBuffer(slots=2)
+
+def test_block_waits_for_the_slowest_reader(make_batch):
+    ring = SampleRingBuffer(slots=4, slot_samples=4, overflow='block')
+    reader = ring.subscribe()
+    for first in range(0, 12, 4):
+        ring.put(make_batch(1, first, 4))
+    with pytest.raises(Full):
+        ring.put(make_batch(1, 12, 4), timeout=.01)
+    assert ring.dropped == 4
+
+    consumer = threading.Timer(.05, reader.get)
+    consumer.start()
+    ring.put(make_batch(1, 16, 4), timeout=2)
+    consumer.join()
+    assert [reader.get().raw[0, 0] for _ in range(3)] == [4, 8, 16]
+
+def test_views_keep_the_calibration(make_batch):
+    scale = SampleScale(1.0, 1.0, bias=(1, 2, 3, 0, 0, 0))
+    ring = SampleRingBuffer(slots=4, slot_samples=4)
+    reader = ring.subscribe()
+    batch = make_batch(1, 0, 4, scale=scale)
+    ring.put(batch)
+    view = reader.get()
+    assert view.scale is scale
+    np.testing.assert_array_equal(view.to_array(), batch.to_array())
+
+def test_unknown_overflow_mode():
+    with pytest.raises(ValueError):
+        SampleRingBuffer(overflow='grow')
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from icm20689 import init_spi_chips
+from icm20689_data import SampleBatch
+
+def test_slice_shares_frames_and_shifts_time(make_batch):
+    batch = make_batch(3, timestamp=5.0)
+    part = batch[4:10:2]
+    assert len(part) == 3
+    assert part.timestamp == pytest.approx(5.004)
+    assert part.sample_period == pytest.approx(.002)
+    np.testing.assert_allclose(part.timestamps(), batch.timestamps()[4:10:2])
+    assert np.shares_memory(part.raw, batch.raw)
+
+def test_points_match_array(make_batch):
+    batch = make_batch(3, count=10, fill='random', accel_scale=.01, gyro_scale=.1)
+    values = batch.to_array()
+    for point, row in zip(batch.to_points(), values):
+        accel = point._accel_data
+        gyro = point._gyro_data
+        assert [accel.x_val, accel.y_val, accel.z_val, gyro.x_val, gyro.y_val, gyro.z_val] == pytest.approx(row)
+
+def test_serialize_matches_points(make_batch):
+    batch = make_batch(3, count=4, fill='random', accel_scale=.01, gyro_scale=.1)
+    legacy = b''.join(bytes(point.serialize()) for point in batch.to_points())
+    assert batch.serialize() == legacy
+
+def test_concatenate(make_batch):
+    batch = make_batch(3, timestamp=5.0)
+    joined = SampleBatch.concatenate([batch[:3], batch[3:]])
+    np.testing.assert_array_equal(joined.raw, batch.raw)
+    assert joined.timestamp == batch.timestamp
+
+    with pytest.raises(ValueError):
+        SampleBatch.concatenate([batch, make_batch(4, timestamp=5.0)])
+    other = make_batch(3, timestamp=5.0, accel_scale=2.0)
+    with pytest.raises(ValueError):
+        SampleBatch.concatenate([batch, other])
+
+def test_less_than_a_frame_skips_the_fifo_read(rig, clock, monkeypatch):
+    rig.add_chip(22, clock=clock)
+    chip = init_spi_chips([22], sample_frequency=1000)[0]
+    chip.enable_fifo()
+    reads = []
+    read = chip._get_fifo_data
+    monkeypatch.setattr(chip, '_get_fifo_data', lambda count: reads.append(count) or read(count))
+
+    assert len(chip.read_fifo_batch()) == 0
+    assert reads == []
+    clock.advance(.0105)
+    assert len(chip.read_fifo_batch()) == 10
+    assert reads == [60]
@@ -0,0 +1,89 @@
+import math
+import numpy as np
+import pytest
+from icm20689 import FS_SEL, init_spi_chips
+from icm20689_data import CALIBRATION, DEFAULT_UNITS, SI_UNITS, SampleBatch, SampleScale, scale_fifo_data
+
+RAW = np.random.default_rng(0).integers(-30000, 30000, (50, 6)).astype('>i2')
+
+def test_units():
+    scale = SampleScale(.002, .06)
+    assert not scale.calibrated
+    np.testing.assert_allclose(scale.apply(RAW), scale_fifo_data(RAW, .002, .06))
+    np.testing.assert_allclose(scale.with_units('g', 'rad/s').apply(RAW)[:, :3], RAW[:, :3] * .002 / 9.80665)
+    np.testing.assert_allclose(scale.with_units(*SI_UNITS).apply(RAW)[:, 3:], RAW[:, 3:] * .06 * math.pi / 180)
+
+    # Each set of units is built once and shared
+    assert scale.with_units('g', 'deg/s') is scale.with_units('g', 'deg/s')
+    assert scale.with_units(*DEFAULT_UNITS) is scale
+    with pytest.raises(ValueError):
+        SampleScale(.002, .06, ('ft/s^2', 'deg/s'))
+    with pytest.raises(ValueError):
+        scale.with_units('g', 'rpm')
+
+def test_calibration_math():
+    bias = np.array([10, -20, 30, 1, 2, 3])
+    gain = np.array([1.01, .99, 1.02, 1, 1, .5])
+    scale = SampleScale(.002, .06, bias=bias, gain=gain)
+    assert scale.calibrated
+    expected = (RAW - bias) * np.array([.002] * 3 + [.06] * 3) * gain
+    np.testing.assert_allclose(scale.apply(RAW), expected)
+    # Units keep the calibration
+    np.testing.assert_allclose(scale.with_units('g', 'rad/s').apply(RAW),
+                               expected * ([1 / 9.80665] * 3 + [math.pi / 180] * 3))
+    # The register path converts single readings the same way
+    np.testing.assert_allclose(scale.convert(RAW[0].tolist()), expected[0])
+    np.testing.assert_allclose(scale.convert(RAW[0, 3:].tolist(), 3), expected[0, 3:])
+
+    out = np.empty((len(RAW), 6))
+    assert scale.apply(RAW, out=out) is out
+    np.testing.assert_allclose(out, expected)
+    assert not scale.with_calibration().calibrated
+    assert SampleScale(.002, .06, gain=(1, 1, 1, 1, 1, 2)).calibrated
+
+def test_vectors_round_trip():
+    scale = SampleScale(.002, .06, ('g', 'deg/s'), bias=(10, -20, 30, 1, 2, 3), gain=(1.01, .99, 1, 1, 1, 1))
+    record = scale.pack_vectors()
+    assert len(record) == CALIBRATION.size
+    values = CALIBRATION.unpack(record)
+    rebuilt = SampleScale.from_vectors(.002, .06, values[:6], values[6:])
+    assert rebuilt.units == DEFAULT_UNITS and rebuilt.calibrated
+    np.testing.assert_allclose(rebuilt.apply(RAW), scale.with_units(*DEFAULT_UNITS).apply(RAW))
+    np.testing.assert_allclose(rebuilt.bias, scale.bias)
+    np.testing.assert_allclose(rebuilt.gain, scale.gain)
+    # Decoding a stream of blocks reuses one object
+    assert SampleScale.from_vectors(.002, .06, values[:6], values[6:]) is rebuilt
+
+def test_batches_convert_with_their_scale():
+    scale = SampleScale(.002, .06, bias=(10, -20, 30, 1, 2, 3))
+    batch = SampleBatch(1, 0.0, .001, RAW, .002, .06, scale)
+    assert batch.calibrated and not SampleBatch(1, 0.0, .001, RAW, .002, .06).calibrated
+    np.testing.assert_allclose(batch.to_array(), scale.apply(RAW))
+    np.testing.assert_allclose(batch.accel, scale.apply(RAW)[:, :3])
+    np.testing.assert_allclose(batch.gyro, scale.apply(RAW)[:, 3:])
+    np.testing.assert_allclose(batch.to_array(SI_UNITS), scale.with_units(*SI_UNITS).apply(RAW))
+    points = np.frombuffer(batch.serialize(), SampleBatch.POINT_DTYPE)
+    np.testing.assert_allclose(points['accel'], scale.apply(RAW)[:, :3])
+    # Single points go through the register path's convert
+    point = np.frombuffer(batch[3].serialize(), SampleBatch.POINT_DTYPE)[0]
+    np.testing.assert_allclose(point['gyro'], scale.apply(RAW)[3, 3:])
+
+def test_chip_calibration_follows_the_ranges(rig, clock):
+    rig.add_chip(22, accel_noise=0, gyro_noise=0, accel_bias=(.05, 0, 0), gyro_bias=(1, 2, 3), clock=clock)
+    chip = init_spi_chips([22], sample_frequency=1000)[0]
+    clock.advance(.01)
+    accel = chip.get_accel_data()
+    assert accel['ax'] == pytest.approx(.05 * 9.80665, abs=.01)
+    assert chip.get_gyro_data()['gy'] == pytest.approx(2, abs=.1)
+
+    chip.set_calibration(bias=(.05 * 9.80665, 0, 0, 1, 2, 3))
+    assert chip.get_sample_scale().calibrated
+    for gyro_range in (FS_SEL.FS_DEG_2000, FS_SEL.FS_DEG_250):
+        chip.set_gyro_range(gyro_range.value)
+        clock.advance(.01)
+        assert chip.get_accel_data()['ax'] == pytest.approx(0, abs=.01)
+        assert chip.get_accel_data(g=True)['az'] == pytest.approx(1, abs=.001)
+        assert list(chip.get_gyro_data().values()) == pytest.approx([0, 0, 0], abs=.1)
+
+    chip.set_calibration()
+    assert not chip.get_sample_scale().calibrated
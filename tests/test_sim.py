@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from icm20689 import init_spi_chips
+from icm20689_regs import FIFO_EN, ICM20689Regs, INT_STATUS
+from icm20689_sim import SimulatedIcm20689
+
+def fifo_chip(clock, **options):
+    """A simulated chip, awake and sampling accel and gyro into its FIFO at 1 kHz."""
+    chip = SimulatedIcm20689(accel_noise=0, gyro_noise=0, clock=clock, **options)
+    chip.write_register(ICM20689Regs.PWR_MGMT_1.value, 0)
+    chip.write_register(ICM20689Regs.FIFO_EN.value, FIFO_EN.ACCEL_FIFO_EN | FIFO_EN.XG_FIFO_EN |
+                        FIFO_EN.YG_FIFO_EN | FIFO_EN.ZG_FIFO_EN)
+    chip.write_register(ICM20689Regs.USER_CTRL.value, 1 << 6)
+    return chip
+
+def fifo_count(chip):
+    high, low = chip.read_registers(ICM20689Regs.FIFO_COUNTH.value, 2)
+    return (high << 8) | low
+
+def test_sleeping_chip_makes_no_samples(clock):
+    chip = SimulatedIcm20689(clock=clock)
+    clock.advance(1)
+    assert chip.read_register(ICM20689Regs.WHO_AM_I.value) == 0x98
+    assert fifo_count(chip) == 0
+
+@pytest.mark.parametrize('divider, clock_error, expected', [(0, 0, 100), (9, 0, 10), (0, .024, 102)])
+def test_sample_rate(clock, divider, clock_error, expected):
+    chip = fifo_chip(clock, clock_error=clock_error)
+    chip.write_register(ICM20689Regs.SMPLRT_DIV.value, divider)
+    clock.advance(.1005)
+    assert fifo_count(chip) == expected * 12
+
+def test_fifo_holds_still_frames(clock):
+    chip = fifo_chip(clock)
+    clock.advance(.0105)
+    frames = np.frombuffer(chip.read_registers(ICM20689Regs.FIFO_R_W.value, 120), dtype='>i2').reshape(10, 6)
+    np.testing.assert_array_equal(frames, np.tile([0, 0, 16384, 0, 0, 0], (10, 1)))
+    assert fifo_count(chip) == 0
+
+def test_overflow_keeps_the_newest_bytes(clock):
+    chip = fifo_chip(clock)
+    clock.advance(1)
+    assert fifo_count(chip) == 4096
+    assert chip.overflows == 1
+    assert chip.read_register(ICM20689Regs.INT_STATUS.value) & INT_STATUS.FIFO_OFLOW_INT
+    assert chip.read_register(ICM20689Regs.INT_STATUS.value) == 0
+
+def test_fifo_reset_and_device_reset(clock):
+    chip = fifo_chip(clock)
+    clock.advance(.01)
+    chip.write_register(ICM20689Regs.USER_CTRL.value, (1 << 6) | (1 << 2))
+    assert fifo_count(chip) == 0
+    assert chip.read_register(ICM20689Regs.USER_CTRL.value) == 1 << 6
+    chip.write_register(ICM20689Regs.PWR_MGMT_1.value, 0x80)
+    assert chip.read_register(ICM20689Regs.PWR_MGMT_1.value) == 0x40
+
+def test_chip_selects_route_to_their_chip(rig, clock):
+    rig.add_chip(22, clock=clock, accel_noise=0, gyro_noise=0)
+    rig.add_chip(23, clock=clock, accel_noise=0, gyro_noise=0, gyro_bias=(5, 0, 0))
+    first, second = init_spi_chips([22, 23], sample_frequency=1000)
+    clock.advance(.01)
+    assert first.get_gyro_data()['gx'] == pytest.approx(0)
+    assert second.get_gyro_data()['gx'] == pytest.approx(5, abs=.1)
+    assert first.read_sample_frequency() == second.read_sample_frequency() == 1000
@@ -0,0 +1,100 @@
+import socket
+import struct
+import time
+from queue import Queue
+import numpy as np
+import pytest
+from icm20689_data import MpuDataPacket
+from icm20689_metrics import METRICS
+from icm20689_net import TcpNetworkSenderThread
+
+def read_packets(connection, samples, timeout = 5.0):
+    """Reads length-prefixed packets until they hold at least samples."""
+    buffer = b''
+    packets = []
+    deadline = time.monotonic() + timeout
+    while sum(len(batch) for packet in packets for batch in packet.data) < samples and time.monotonic() < deadline:
+        try:
+            data = connection.recv(65536)
+        except socket.timeout:
+            continue
+        if not data:
+            break
+        buffer += data
+        while len(buffer) >= 4:
+            size, = struct.unpack('!I', buffer[:4])
+            if len(buffer) < 4 + size:
+                break
+            packets.append(MpuDataPacket.deserialize(buffer[4:4 + size]))
+            buffer = buffer[4 + size:]
+    return packets
+
+@pytest.fixture
+def server():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    yield sock
+    sock.close()
+
+def accept(server):
+    server.settimeout(5)
+    connection, _ = server.accept()
+    connection.settimeout(.1)
+    return connection
+
+def test_frames_arrive_in_order(server, make_batch):
+    server.listen()
+    queue = Queue()
+    sender = TcpNetworkSenderThread(queue, *server.getsockname(), max_latency=.001)
+    sender.start()
+    try:
+        connection = accept(server)
+        for first in range(0, 500, 10):
+            queue.put(make_batch(1, first))
+        packets = read_packets(connection, 500)
+        connection.close()
+    finally:
+        sender.stop()
+        sender.join(2)
+    assert [packet.sequence for packet in packets] == list(range(len(packets)))
+    samples = np.concatenate([batch.raw[:, 0] for packet in packets for batch in packet.data])
+    np.testing.assert_array_equal(samples, np.arange(500))
+
+def test_drops_oldest_frames_while_disconnected_and_reconnects(server, make_batch):
+    samples_sent = METRICS.counter('net_samples_sent', transport='tcp')
+    before = samples_sent.value
+    queue = Queue()
+    sender = TcpNetworkSenderThread(queue, *server.getsockname(), max_latency=.001, max_buffered_frames=3,
+                                    reconnect_delay=.02, max_reconnect_delay=.05)
+    sender.start()
+    try:
+        for first in range(0, 100, 10):
+            queue.put(make_batch(1, first))
+            time.sleep(.02)
+        server.listen()
+        connection = accept(server)
+        packets = read_packets(connection, 30)
+        assert [batch.raw[0, 0] for packet in packets for batch in packet.data] == [70, 80, 90]
+        assert sender.dropped_frames == 7
+        # Only the frames that went out count as sent
+        deadline = time.monotonic() + 1
+        while samples_sent.value - before < 30 and time.monotonic() < deadline:
+            time.sleep(.01)
+        assert samples_sent.value - before == 30
+
+        connection.close()
+        for first in range(100, 130, 10):
+            queue.put(make_batch(2, first))
+            time.sleep(.05)
+        connection = accept(server)
+        packets = read_packets(connection, 10)
+        assert packets and packets[-1].data[-1].chip_id == 2
+        assert sender.reconnects == 1
+        connection.close()
+    finally:
+        sender.stop()
+        sender.join(2)
+
+def test_overflow_mode_is_checked():
+    with pytest.raises(ValueError):
+        TcpNetworkSenderThread(Queue(), overflow='wait')
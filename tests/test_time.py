@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from icm20689 import init_spi_chips
+from icm20689_time import SampleClock
+
+TRUE_PERIOD = 1 / 1024.0
+
+def drains(seconds, interval = .01, seed = 0):
+    """Drain times and counts of a 1024 Hz chip read every interval, late by up to 200 us."""
+    rng = np.random.default_rng(seed)
+    taken = 0
+    for k in range(1, int(seconds / interval) + 1):
+        drain_time = 1000.0 + k * interval + rng.uniform(0, 200e-6)
+        # Samples taken at 1000 + n * TRUE_PERIOD up to the drain
+        count = int((drain_time - 1000.0) / TRUE_PERIOD) + 1 - taken
+        taken += count
+        yield drain_time, count
+
+def test_nominal_period_until_min_span(clock):
+    sample_clock = SampleClock(.001, clock=clock)
+    assert sample_clock.now() == clock.now
+    epoch = sample_clock.stamp(1000.0, 1)[0] - 1000.0
+    timestamp, period = sample_clock.stamp(1000.01, 10)
+    # The batch ends at its drain time
+    assert period == .001
+    assert timestamp - epoch == pytest.approx(1000.01 - 9 * .001)
+    assert sample_clock.drift == 0.0
+    # Empty drains change nothing
+    assert sample_clock.stamp(1000.02, 0) == (1000.02 + epoch, .001)
+
+def test_estimates_drift_and_stamps_contiguously():
+    sample_clock = SampleClock(.001, min_span=1.0)
+    epoch = sample_clock.stamp(999.0, 1)[0] - 999.0
+    sample_clock.reset()
+    stamps = [(sample_clock.stamp(drain_time, count), count) for drain_time, count in drains(3.0)]
+    assert sample_clock.period == pytest.approx(TRUE_PERIOD, rel=1e-4)
+    assert sample_clock.rate == pytest.approx(1024, abs=.1)
+    assert sample_clock.drift == pytest.approx(.024, abs=1e-4)
+
+    # After the estimate each batch starts where the one before ended, up to
+    # the small shift of refitting the line
+    last = stamps[-50:]
+    for ((timestamp, period), count), ((next_timestamp, _), _) in zip(last, last[1:]):
+        assert next_timestamp == pytest.approx(timestamp + count * period, abs=20e-6)
+    # and the line runs through the earliest drain, so within the latency of the truth
+    first_sample = 1000.0 + (sum(count for stamp, count in stamps[:-1])) * TRUE_PERIOD
+    assert 0 <= last[-1][0][0] - epoch - first_sample < 250e-6
+
+def test_reset_and_implausible_estimates():
+    sample_clock = SampleClock(.001, window=64, min_span=.5)
+    for drain_time, count in drains(1.0):
+        sample_clock.stamp(drain_time, count)
+    estimate = sample_clock.period
+    assert estimate != .001
+
+    # A broken sequence keeps the estimate but restarts the line
+    sample_clock.reset()
+    assert sample_clock.period == estimate
+    timestamp, period = sample_clock.stamp(2000.0, 5)
+    assert period == estimate
+
+    # A nominal period change forgets it
+    sample_clock.set_nominal_period(.002)
+    assert sample_clock.period == .002 and sample_clock.nominal_period == .002
+    # 1024 Hz is 49% off a nominal 500 Hz, so no estimate is made
+    for drain_time, count in drains(1.0):
+        sample_clock.stamp(drain_time, count)
+    assert sample_clock.period == .002
+
+def test_chip_rate_changes_set_the_nominal_period(rig):
+    rig.add_chip(22)
+    chip = init_spi_chips([22], sample_frequency=1000)[0]
+    assert chip.get_sample_clock().nominal_period == pytest.approx(.001)
+    chip.set_sample_frequency(500)
+    assert chip.get_sample_clock().nominal_period == pytest.approx(.002)
+    chip.set_nominal_sample_frequency(4000)
+    assert chip.get_sample_frequency() == 4000
+    assert chip.get_sample_clock().nominal_period == pytest.approx(.00025)
@@ -1,27 +1,56 @@
-from icm20689 import Icm20689SPI
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-from matplotlib import style
+import argparse
+import numpy as np
+from icm20689_record import RecordingReader, open_session
 
-# This script is incomplete. Currently using as a reference until completion
-style.use('fivethirtyeight')
+# Points drawn per channel; longer recordings are decimated to this
+MAX_POINTS = 20000
 
-fig = plt.figure()
-ax1 = fig.add_subplot(1,1,1)
+def decimated(reader, chip, start, end, max_points):
+    """Reads a chip's samples chunk by chunk, keeping every n-th sample."""
+    total = reader.sample_count(chip)
+    step = max(total // max_points, 1)
+    times = []
+    samples = []
+    skip = 0
+    for ts, data in reader.iter_chunks(chip, start=start, end=end):
+        times.append(ts[skip::step])
+        samples.append(data[skip::step])
+        skip = (skip - len(ts)) % step
+    if not times:
+        return np.empty(0), np.empty((0, 6))
+    return np.concatenate(times), np.concatenate(samples)
 
-def animate(i):
-    graph_data = open('example.txt','r').read()
-    lines = graph_data.split('\n')
-    xs = []
-    ys = []
-    for line in lines:
-        if len(line) > 1:
-            x, y = line.split(',')
-            xs.append(x)
-            ys.append(y)
-            ax1.clear()
-            ax1.plot(xs, ys)
 
-ani = animation.FuncAnimation(fig, animate, interval=1000)
-plt.show()
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+    from matplotlib import style
 
+    parser = argparse.ArgumentParser(description='Plots a recorded session.')
+    parser.add_argument('paths', nargs='*', help='recording files; the latest session in --directory if omitted')
+    parser.add_argument('--directory', default='.')
+    parser.add_argument('--chip', type=int, action='append', help='chip id to plot, may be repeated')
+    parser.add_argument('--start', type=float, help='seconds from the start of the recording')
+    parser.add_argument('--end', type=float, help='seconds from the start of the recording')
+    args = parser.parse_args()
+
+    reader = RecordingReader(args.paths) if args.paths else open_session(args.directory)
+    first, last = reader.time_range()
+    start = first + args.start if args.start is not None else None
+    end = first + args.end if args.end is not None else None
+    chips = args.chip or reader.chips
+
+    style.use('fivethirtyeight')
+    fig = plt.figure()
+    ax1 = fig.add_subplot(2,1,1)
+    ax2 = fig.add_subplot(2,1,2)
+    for chip in chips:
+        ts, data = decimated(reader, chip, start, end, MAX_POINTS)
+        for axis, name in enumerate(('x', 'y', 'z')):
+            ax1.plot(ts - first, data[:, axis], label='%d a%s' % (chip, name))
+            ax2.plot(ts - first, data[:, axis + 3], label='%d g%s' % (chip, name))
+    ax1.set_ylabel('m/s^2')
+    ax2.set_ylabel('deg/s')
+    ax2.set_xlabel('s')
+    ax1.legend(loc='upper right', fontsize='small')
+    ax2.legend(loc='upper right', fontsize='small')
+    plt.show()
@@ -1,19 +1,12 @@
 from icm20689 import Icm20689SPI
-import numpy as np
-from matplotlib.lines import Line2D
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-from matplotlib import style
 import math
 import time
 
-chip = Icm20689SPI(1, 0, 0, 25)
-style.use('fivethirtyeight')
-
 DT = 1
 
 class Scope(object):
     def __init__(self, ax1, maxt=10):
+        from matplotlib.lines import Line2D
         self.ax1 = ax1
         self.tlast = time.time()
         self.maxt = maxt
@@ -87,11 +80,20 @@ def extractor():
     data = chip.get_all_data()
     yield data
 
-fig = plt.figure()
-ax1 = fig.add_subplot(1,1,1)
-scope = Scope(ax1)
 
-# pass a generator in "extractor" to produce data for the update func
-ani = animation.FuncAnimation(fig, scope.update, extractor, interval=100,
-                              blit=True)
-plt.show()
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
+    from matplotlib import style
+
+    chip = Icm20689SPI(1, 0, 0, 25)
+    style.use('fivethirtyeight')
+
+    fig = plt.figure()
+    ax1 = fig.add_subplot(1,1,1)
+    scope = Scope(ax1)
+
+    # pass a generator in "extractor" to produce data for the update func
+    ani = animation.FuncAnimation(fig, scope.update, extractor, interval=100,
+                                  blit=True)
+    plt.show()
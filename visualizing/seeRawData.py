@@ -1,22 +1,13 @@
 from icm20689 import Icm20689SPI
-import numpy as np
-from matplotlib.lines import Line2D
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-from matplotlib import style
-import math
 import time
 
 seeChip = 1
 
-chip1 = Icm20689SPI(1, 0, 0, 25)
-chip2 = Icm20689SPI(1, 0, 0, 24)
-style.use('fivethirtyeight')
-
 DT = 1
 
 class Scope(object):
     def __init__(self, ax1, ax2, maxt=30):
+        from matplotlib.lines import Line2D
         self.ax1 = ax1
         self.ax2 = ax2
         self.tlast = time.time()
@@ -117,12 +108,22 @@ def extractor():
         data = data2
     yield data
 
-fig = plt.figure()
-ax1 = fig.add_subplot(2,1,1)
-ax2 = fig.add_subplot(2,1,2)
-scope = Scope(ax1,ax2)
 
-# pass a generator in "extractor" to produce data for the update func
-ani = animation.FuncAnimation(fig, scope.update, extractor, interval=100,
-                              blit=True)
-plt.show()
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
+    from matplotlib import style
+
+    chip1 = Icm20689SPI(1, 0, 0, 25)
+    chip2 = Icm20689SPI(1, 0, 0, 24)
+    style.use('fivethirtyeight')
+
+    fig = plt.figure()
+    ax1 = fig.add_subplot(2,1,1)
+    ax2 = fig.add_subplot(2,1,2)
+    scope = Scope(ax1,ax2)
+
+    # pass a generator in "extractor" to produce data for the update func
+    ani = animation.FuncAnimation(fig, scope.update, extractor, interval=100,
+                                  blit=True)
+    plt.show()